@@ -0,0 +1,64 @@
+"""
+Measures the latency of serving a cache hit, with the response rebuilt from the stored payload on every hit
+(former behaviour) and with the response cloned from the cached template.
+
+    python -m benchmarks.bench_cache_hit
+"""
+import timeit
+from typing import Callable
+
+from chocs import Application, HttpMethod, HttpRequest, HttpResponse
+
+from chocs_middleware.cache import CacheItem, CacheMiddleware, InMemoryCacheStorage
+from chocs_middleware.cache.cache_storage import generate_cache_id
+from chocs_middleware.cache.http_support import format_date_rfc_1123, load_response
+
+PAYLOAD_SIZES = (100, 10_000, 1_000_000)
+CACHE_VARY = ("accept", "accept-language")
+
+
+def rebuild_response(cache_item: CacheItem) -> HttpResponse:
+    response = load_response(cache_item.body)
+    response.headers["Last-Modified"] = format_date_rfc_1123(cache_item.updated_at)
+    response.headers["Vary"] = ",".join(CACHE_VARY)
+    response.headers["Age"] = str(cache_item.age)
+
+    return response
+
+
+def clone_response(cache_item: CacheItem) -> HttpResponse:
+    response = CacheMiddleware.get_response_template(cache_item, ",".join(CACHE_VARY)).create_response()
+    response.headers.override("age", str(cache_item.age))
+
+    return response
+
+
+def measure(statement: Callable, number: int) -> float:
+    return min(timeit.repeat(statement, number=number, repeat=5)) / number * 1e6
+
+
+def main() -> None:
+    print(f"{'payload':>10}{'rebuild [us]':>15}{'template [us]':>15}{'app hit [us]':>15}{'gain':>8}")
+    for size in PAYLOAD_SIZES:
+        storage = InMemoryCacheStorage()
+        app = Application(CacheMiddleware(storage))
+        body = b"x" * size
+
+        @app.get("/test", cache_expiry=3600)
+        def get_test(req: HttpRequest) -> HttpResponse:
+            return HttpResponse(body, headers={"content-type": "application/json"})
+
+        request = HttpRequest(HttpMethod.GET, "/test")
+        app(request)
+        cache_item = storage.get(generate_cache_id(request, CACHE_VARY))
+        number = max(10, 2_000_000 // (size + 1000))
+
+        before = measure(lambda: rebuild_response(cache_item), number)
+        after = measure(lambda: clone_response(cache_item), number)
+        app_hit = measure(lambda: app(request), number)
+
+        print(f"{size:>10}{before:>15.2f}{after:>15.2f}{app_hit:>15.2f}{before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Compares memory footprint and per-call latency of `CacheItem` against the former datetime based implementation.
+
+    python -m benchmarks.bench_cache_item
+"""
+import gc
+import timeit
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Callable, List
+
+from chocs_middleware.cache import CacheItem
+
+ITEMS = 100_000
+
+
+class LegacyCacheItem:
+    def __init__(self, item_id: str, body: bytes, ttl: int = 30):
+        self._id = item_id
+        self._body = body
+        self.ttl = ttl
+        self._created_at = datetime.utcnow()
+        self._updated_at = datetime.utcnow()
+        self._expires_at = self._updated_at + timedelta(0, self.ttl)
+
+    @property
+    def is_expired(self) -> bool:
+        return self._expires_at < datetime.utcnow()
+
+    @property
+    def body(self) -> bytes:
+        return self._body
+
+    @body.setter
+    def body(self, value: bytes) -> None:
+        self._body = value
+        self._updated_at = datetime.utcnow()
+        self._expires_at = self._updated_at + timedelta(0, self.ttl)
+
+
+def measure_memory(factory: Callable) -> float:
+    ids = [str(index) for index in range(ITEMS)]
+    body = b"body"
+    gc.collect()
+    tracemalloc.start()
+    items: List = [factory(item_id, body) for item_id in ids]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+
+    return current / ITEMS
+
+
+def measure_latency(statement: Callable, number: int = 200_000) -> float:
+    return min(timeit.repeat(statement, number=number, repeat=5)) / number * 1e9
+
+
+def main() -> None:
+    legacy = LegacyCacheItem("1", b"body")
+    current = CacheItem("1", b"body")
+
+    def set_legacy_body() -> None:
+        legacy.body = b"body"
+
+    def set_current_body() -> None:
+        current.body = b"body"
+
+    results = [
+        ("bytes per item", measure_memory(LegacyCacheItem), measure_memory(CacheItem)),
+        (
+            "__init__ [ns]",
+            measure_latency(lambda: LegacyCacheItem("1", b"body")),
+            measure_latency(lambda: CacheItem("1", b"body")),
+        ),
+        ("is_expired [ns]", measure_latency(lambda: legacy.is_expired), measure_latency(lambda: current.is_expired)),
+        ("body setter [ns]", measure_latency(set_legacy_body), measure_latency(set_current_body)),
+    ]
+
+    print(f"{'metric':<20}{'legacy':>12}{'current':>12}{'gain':>8}")
+    for name, before, after in results:
+        print(f"{name:<20}{before:>12.1f}{after:>12.1f}{before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
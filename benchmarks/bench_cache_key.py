@@ -0,0 +1,44 @@
+"""
+Measures the cost of generating cache ids, with the former sha1 over concatenated strings and with
+the incremental blake2b hashing.
+
+    python -m benchmarks.bench_cache_key
+"""
+import hashlib
+import timeit
+from typing import Iterable
+
+from chocs import HttpMethod, HttpRequest
+
+from chocs_middleware.cache.cache_storage import generate_cache_id
+
+CACHE_VARY = ("accept", "accept-language")
+QUERY_STRINGS = ("", "page=2", "sort=name&page=2&filter=active&limit=50")
+
+
+def legacy_generate_cache_id(request: HttpRequest, cache_vary: Iterable[str] = CACHE_VARY) -> str:
+    hash_str = f"{request.path}:{request.query_string}"
+
+    for header in cache_vary:
+        hash_str += "".join(request.headers.get(header))
+
+    return hashlib.sha1(hash_str.encode("utf8")).hexdigest()
+
+
+def main() -> None:
+    number = 50_000
+    print(f"{'query string':>42} {'sha1 (us)':>10} {'blake2b (us)':>13}")
+    for query_string in QUERY_STRINGS:
+        request = HttpRequest(
+            HttpMethod.GET,
+            "/api/v1/users/12345/orders",
+            query_string=query_string,
+            headers={"accept": "application/json", "accept-language": "en-GB,en;q=0.9"},
+        )
+        legacy = min(timeit.repeat(lambda: legacy_generate_cache_id(request), number=number, repeat=5))
+        current = min(timeit.repeat(lambda: generate_cache_id(request, CACHE_VARY), number=number, repeat=5))
+        print(f"{query_string!r:>42} {legacy / number * 1e6:>10.2f} {current / number * 1e6:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Measures throughput of concurrent get/set calls (90% reads) made by many threads, against a single in-memory
+storage guarded by one global lock and against the sharded storage.
+
+    python -m benchmarks.bench_threaded_storage
+
+With the GIL the sharded storage mostly saves on lock contention, free-threaded builds benefit the most.
+"""
+import threading
+import time
+from typing import Callable, List
+
+from chocs_middleware.cache import (
+    CacheError,
+    CacheItem,
+    CollectableInMemoryCacheStorage,
+    ICollectableCacheStorage,
+    ShardedInMemoryCacheStorage,
+)
+
+THREADS = (1, 2, 4, 8, 16)
+OPERATIONS_PER_THREAD = 50_000
+KEYS = [f"item-{i}" for i in range(10_000)]
+
+
+class GloballyLockedStorage(ICollectableCacheStorage):
+    def __init__(self):
+        self._storage = CollectableInMemoryCacheStorage()
+        self._lock = threading.Lock()
+
+    def get(self, item_id: str) -> CacheItem:
+        with self._lock:
+            return self._storage.get(item_id)
+
+    def set(self, item: CacheItem) -> None:
+        with self._lock:
+            self._storage.set(item)
+
+    def collect(self, item: CacheItem) -> None:
+        with self._lock:
+            self._storage.collect(item)
+
+
+def work(storage: ICollectableCacheStorage, offset: int) -> None:
+    items = [CacheItem(key, b"test") for key in KEYS]
+    for i in range(OPERATIONS_PER_THREAD):
+        index = (i * 7919 + offset) % len(KEYS)
+        if i % 10 == 0:
+            storage.set(items[index])
+            continue
+        try:
+            storage.get(KEYS[index])
+        except CacheError:
+            pass
+
+
+def measure(factory: Callable[[], ICollectableCacheStorage], threads_count: int) -> float:
+    storage = factory()
+    for key in KEYS:
+        storage.set(CacheItem(key, b"test"))
+
+    threads: List[threading.Thread] = [
+        threading.Thread(target=work, args=(storage, offset)) for offset in range(threads_count)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return threads_count * OPERATIONS_PER_THREAD / (time.perf_counter() - started)
+
+
+def main() -> None:
+    print(f"{'threads':>8} {'global lock op/s':>18} {'sharded op/s':>14}")
+    for threads_count in THREADS:
+        locked = measure(GloballyLockedStorage, threads_count)
+        sharded = measure(ShardedInMemoryCacheStorage, threads_count)
+        print(f"{threads_count:>8} {locked:>18,.0f} {sharded:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
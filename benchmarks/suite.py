@@ -0,0 +1,289 @@
+"""
+Benchmark suite driving `CacheMiddleware` with synthetic requests, across bundled storages, request paths
+(hit, miss, etag 304, if-match, if-none-match), payload sizes and key cardinalities. Every case runs in a fresh
+process, so reported peak RSS belongs to that case only.
+
+    python -m benchmarks.suite                                  # quick profile
+    python -m benchmarks.suite --profile full                   # up to 10MB payloads and 1M keys
+    python -m benchmarks.suite --storage memory --scenario hit  # selected cases
+    python -m benchmarks.suite --save baseline.json
+    python -m benchmarks.suite --compare baseline.json          # exits with 1 on regression
+
+Redis storage is included when `--redis host:port` is given.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+from chocs import HttpMethod, HttpRequest, HttpResponse, Route
+
+from chocs_middleware.cache import (
+    AsyncInMemoryCacheStorage,
+    BoundedInMemoryCacheStorage,
+    CacheMiddleware,
+    CollectableInMemoryCacheStorage,
+    FileCacheStorage,
+    InMemoryCacheStorage,
+    MmapCacheStorage,
+    RedisCacheStorage,
+    RedisConnectionPool,
+    ShardedInMemoryCacheStorage,
+    TieredCacheStorage,
+)
+
+SCENARIOS = ("hit", "miss", "etag_304", "if_match", "if_none_match")
+STORAGES = ("memory", "bounded", "sharded", "tiered", "mmap", "file", "async_memory", "redis")
+PROFILES: Dict[str, Dict[str, Any]] = {
+    "quick": {"payloads": (100, 10_000, 1_000_000), "cardinalities": (1, 10_000), "operations": 5_000},
+    "full": {
+        "payloads": (100, 10_000, 1_000_000, 10_000_000),
+        "cardinalities": (1, 10_000, 1_000_000),
+        "operations": 50_000,
+    },
+}
+# Cases are skipped when the cached data would not fit in this many bytes.
+MEMORY_BUDGET = 2 * 1024 * 1024 * 1024
+SEED = 1234
+
+
+def create_storage(name: str, payload: int, cardinality: int, redis: Optional[str], directory: str) -> Any:
+    if name == "memory":
+        return InMemoryCacheStorage()
+    # Responses carry an etag, so every cached response comes with its ETag index entry.
+    if name == "bounded":
+        return BoundedInMemoryCacheStorage(max_items=2 * cardinality + 2)
+    if name == "sharded":
+        return ShardedInMemoryCacheStorage()
+    if name == "tiered":
+        return TieredCacheStorage(CollectableInMemoryCacheStorage(), l1_max_items=1024)
+    if name == "async_memory":
+        return AsyncInMemoryCacheStorage()
+    if name == "mmap":
+        block = 1 << (payload + 1024).bit_length()
+        return MmapCacheStorage(
+            os.path.join(directory, "cache.bin"),
+            arena_size=(block + 256) * (cardinality + 16),
+            slots=cardinality * 4 + 64,
+            max_block=block,
+        )
+    if name == "file":
+        return FileCacheStorage(os.path.join(directory, "cache.log"))
+    if name == "redis" and redis:
+        host, port = redis.split(":")
+        return RedisCacheStorage(RedisConnectionPool(host, int(port), timeout=1.0), prefix=f"bench-{time.time()}:")
+
+    raise ValueError(f"Unknown storage `{name}`.")
+
+
+def create_requests(scenario: str, cardinality: int, operations: int) -> Iterator[HttpRequest]:
+    route = Route("/items/{item_id}", {"cache_expiry": 3600})
+    randomizer = random.Random(SEED)
+    for number in range(operations):
+        # Misses always ask for a resource which was not requested before.
+        item_id = cardinality + number if scenario == "miss" else randomizer.randrange(cardinality)
+        method = HttpMethod.GET
+        headers = {"accept": "application/json"}
+        if scenario == "etag_304":
+            headers["etag"] = f'"{item_id}"'
+        elif scenario == "if_none_match":
+            headers["etag"] = f'"{item_id}"'
+            headers["if-none-match"] = f'"{item_id}"'
+        elif scenario == "if_match":
+            headers["etag"] = f'"{item_id}"'
+            headers["if-match"] = f'"{item_id}"'
+
+        request = HttpRequest(method, f"/items/{item_id}", headers=headers)
+        request.route = route
+        request.path_parameters = {"item_id": str(item_id)}
+        yield request
+
+
+def run_case(case: Dict[str, Any]) -> Dict[str, Any]:
+    payload, cardinality = case["payload"], case["cardinality"]
+    with tempfile.TemporaryDirectory(prefix="chocs-cache-bench-") as directory:
+        storage = create_storage(case["storage"], payload, cardinality, case.get("redis"), directory)
+        return _measure(case, storage)
+
+
+def _measure(case: Dict[str, Any], storage: Any) -> Dict[str, Any]:
+    payload, cardinality = case["payload"], case["cardinality"]
+    middleware = CacheMiddleware(storage)
+    body = b"x" * payload
+
+    def handler(request: HttpRequest) -> HttpResponse:
+        return HttpResponse(
+            body, headers={"content-type": "application/json", "etag": f'"{request.path_parameters["item_id"]}"'}
+        )
+
+    if case["storage"] == "async_memory":
+        loop = asyncio.new_event_loop()
+
+        async def async_handler(request: HttpRequest) -> HttpResponse:
+            return handler(request)
+
+        def call(request: HttpRequest) -> HttpResponse:
+            return loop.run_until_complete(middleware.handle_async(request, async_handler))
+
+    else:
+
+        def call(request: HttpRequest) -> HttpResponse:
+            return middleware.handle(request, handler)
+
+    # Every resource is requested once up front, so all but the miss scenario operate on cached items.
+    for request in create_requests("miss", 0, cardinality):
+        call(request)
+
+    requests = list(create_requests(case["scenario"], cardinality, case["operations"]))
+    for request in requests[: min(100, len(requests) // 10)]:
+        call(request)  # warm up
+
+    samples: List[int] = []
+    clock = time.perf_counter_ns
+    started = clock()
+    for request in requests:
+        request_started = clock()
+        call(request)
+        samples.append(clock() - request_started)
+    elapsed = (clock() - started) / 1e9
+
+    samples.sort()
+    return {
+        **case,
+        "ops": len(samples) / elapsed,
+        "p50_us": samples[len(samples) // 2] / 1000,
+        "p99_us": samples[min(len(samples) - 1, len(samples) * 99 // 100)] / 1000,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def case_key(case: Dict[str, Any]) -> str:
+    return f"{case['storage']}/{case['scenario']}/{case['payload']}B/{case['cardinality']}keys"
+
+
+def list_cases(arguments: argparse.Namespace) -> List[Dict[str, Any]]:
+    profile = PROFILES[arguments.profile]
+    cases = []
+    for storage in arguments.storage or STORAGES:
+        if storage == "redis" and not arguments.redis:
+            continue
+        for scenario in arguments.scenario or SCENARIOS:
+            for payload in arguments.payload or profile["payloads"]:
+                for cardinality in arguments.cardinality or profile["cardinalities"]:
+                    operations = arguments.operations or profile["operations"]
+                    # Large payloads get fewer operations, so a case takes a comparable amount of time.
+                    operations = max(50, min(operations, 200_000_000 // payload))
+                    stored = cardinality + (operations if scenario == "miss" else 0)
+                    if stored * payload > MEMORY_BUDGET:
+                        continue
+                    cases.append(
+                        {
+                            "storage": storage,
+                            "scenario": scenario,
+                            "payload": payload,
+                            "cardinality": cardinality,
+                            "operations": operations,
+                            "redis": arguments.redis,
+                        }
+                    )
+
+    return cases
+
+
+def run_isolated(case: Dict[str, Any]) -> Dict[str, Any]:
+    process = subprocess.run(
+        [sys.executable, "-m", "benchmarks.suite", "--run-case", json.dumps(case)],
+        check=True,
+        stdout=subprocess.PIPE,
+    )
+    return json.loads(process.stdout.decode().splitlines()[-1])
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], threshold: float) -> List[str]:
+    regressions = []
+    for result in results:
+        previous = baseline.get(case_key(result))
+        if previous is None:
+            result["change"] = ""
+            continue
+        change = result["ops"] / previous["ops"] - 1
+        result["change"] = f"{change:+.1%}"
+        if change < -threshold:
+            result["change"] += " !"
+            regressions.append(case_key(result))
+
+    return regressions
+
+
+def print_results(results: List[Dict[str, Any]]) -> None:
+    print(f"{'case':<48}{'ops/s':>12}{'p50 [us]':>12}{'p99 [us]':>12}{'peak RSS [MB]':>15}{'change':>10}")
+    for result in results:
+        print(
+            f"{case_key(result):<48}{result['ops']:>12,.0f}{result['p50_us']:>12.1f}{result['p99_us']:>12.1f}"
+            f"{result['peak_rss_mb']:>15.1f}{result.get('change', ''):>10}"
+        )
+
+
+def parse_arguments(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="quick")
+    parser.add_argument("--storage", action="append", choices=STORAGES)
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS)
+    parser.add_argument("--payload", action="append", type=int)
+    parser.add_argument("--cardinality", action="append", type=int)
+    parser.add_argument("--operations", type=int)
+    parser.add_argument("--redis", help="host:port of a Redis server")
+    parser.add_argument("--save", help="stores results in given file, to be used as a baseline")
+    parser.add_argument("--compare", help="compares results with the baseline stored in given file")
+    parser.add_argument("--threshold", type=float, default=0.1, help="ops/s drop reported as a regression")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    arguments = parse_arguments(argv)
+    if arguments.run_case:
+        print(json.dumps(run_case(json.loads(arguments.run_case))))
+        return 0
+
+    results = []
+    for case in list_cases(arguments):
+        results.append(run_isolated(case))
+        print(f"{case_key(case)} done", file=sys.stderr)
+
+    regressions: List[str] = []
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            regressions = compare(
+                results, {case_key(result): result for result in json.load(file)}, arguments.threshold
+            )
+
+    print_results(results)
+
+    if arguments.save:
+        with open(arguments.save, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if regressions:
+        print(f"\n{len(regressions)} case(s) regressed by more than {arguments.threshold:.0%}:", *regressions, sep="\n")
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,31 @@
+from .async_storage import (
+    AsyncInMemoryCacheStorage,
+    IAsyncCacheStorage,
+    IAsyncCollectableCacheStorage,
+    IAsyncTouchableCacheStorage,
+)
 from .cache_storage import (
     CacheItem,
     ICacheStorage,
     ICollectableCacheStorage,
+    IStreamingCacheStorage,
+    IBatchCacheStorage,
+    IBatchCollectableCacheStorage,
+    ITouchableCacheStorage,
     InMemoryCacheStorage,
     CollectableInMemoryCacheStorage,
+    BoundedInMemoryCacheStorage,
+    ShardedInMemoryCacheStorage,
 )
+from .compression import CompressionPolicy, GzipCodec, ICompressionCodec, LzmaCodec, ZlibCodec, register_codec
 from .error import CacheError
-from .middleware import CacheMiddleware
+from .expiry import CacheReaper, ExpiryQueue, IReapableCacheStorage
+from .eviction import IEvictionPolicy, LRUEvictionPolicy, LFUEvictionPolicy, SIEVEEvictionPolicy
+from .file_storage import FileCacheStorage
+from .invalidation import IInvalidatableCacheStorage, InvalidationIndex
+from .metrics import Histogram, ICacheMetrics, InMemoryCacheMetrics
+from .mmap_storage import MmapCacheStorage
+from .middleware import AsyncMiddlewareHandler, CacheMiddleware
+from .redis_storage import RedisCacheStorage, RedisConnectionPool
+from .single_flight import AsyncSingleFlight, SingleFlight
+from .tiered_storage import TieredCacheStorage
@@ -0,0 +1,106 @@
+from abc import abstractmethod
+from typing import Dict, Iterable, Optional, Protocol, runtime_checkable
+
+from chocs_middleware.cache.cache_storage import CacheItem, CollectableInMemoryCacheStorage
+from chocs_middleware.cache.error import CacheError
+
+__all__ = [
+    "IAsyncCacheStorage",
+    "IAsyncCollectableCacheStorage",
+    "IAsyncTouchableCacheStorage",
+    "AsyncInMemoryCacheStorage",
+]
+
+
+@runtime_checkable
+class IAsyncCacheStorage(Protocol):
+    @abstractmethod
+    async def get(self, item_id: str) -> CacheItem:
+        ...
+
+    @abstractmethod
+    async def set(self, item: CacheItem) -> None:
+        ...
+
+    @abstractmethod
+    async def get_many(self, item_ids: Iterable[str]) -> Dict[str, CacheItem]:
+        """
+        Returns found items by their ids, missing items are omitted.
+        """
+        ...
+
+    @abstractmethod
+    async def set_many(self, items: Iterable[CacheItem]) -> None:
+        ...
+
+
+@runtime_checkable
+class IAsyncCollectableCacheStorage(IAsyncCacheStorage, Protocol):
+    @abstractmethod
+    async def collect(self, item: CacheItem) -> None:
+        ...
+
+    @abstractmethod
+    async def collect_many(self, items: Iterable[CacheItem]) -> None:
+        ...
+
+
+@runtime_checkable
+class IAsyncTouchableCacheStorage(IAsyncCacheStorage, Protocol):
+    @abstractmethod
+    async def touch(self, items: Iterable[CacheItem]) -> int:
+        """
+        Asyncio counterpart of `ITouchableCacheStorage.touch`.
+        """
+        ...
+
+
+class AsyncInMemoryCacheStorage(IAsyncCollectableCacheStorage, IAsyncTouchableCacheStorage):
+    def __init__(self, expiry_grace: Optional[int] = None):
+        self._storage = CollectableInMemoryCacheStorage(expiry_grace)
+
+    async def get(self, item_id: str) -> CacheItem:
+        return self._storage.get(item_id)
+
+    async def set(self, item: CacheItem) -> None:
+        self._storage.set(item)
+
+    async def get_many(self, item_ids: Iterable[str]) -> Dict[str, CacheItem]:
+        items = {}
+        for item_id in item_ids:
+            try:
+                items[item_id] = self._storage.get(item_id)
+            except CacheError:
+                continue
+
+        return items
+
+    async def set_many(self, items: Iterable[CacheItem]) -> None:
+        for item in items:
+            self._storage.set(item)
+
+    async def collect(self, item: CacheItem) -> None:
+        self._storage.collect(item)
+
+    async def collect_many(self, items: Iterable[CacheItem]) -> None:
+        for item in items:
+            self._storage.collect(item)
+
+    async def touch(self, items: Iterable[CacheItem]) -> int:
+        return self._storage.touch(items)
+
+    async def invalidate_tag(self, tag: str) -> int:
+        return self._storage.invalidate_tag(tag)
+
+    async def invalidate_prefix(self, path_prefix: str) -> int:
+        return self._storage.invalidate_prefix(path_prefix)
+
+    def reap(self, limit: int = 1000) -> int:
+        return self._storage.reap(limit)
+
+    @property
+    def is_empty(self) -> bool:
+        return self._storage.is_empty
+
+    def __len__(self) -> int:
+        return len(self._storage)
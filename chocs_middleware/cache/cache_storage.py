@@ -1,37 +1,90 @@
 import hashlib
+import struct
+import threading
+import time
 from abc import abstractmethod
 from datetime import datetime, timedelta
-from typing import Protocol, runtime_checkable, Tuple, Iterable
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, Optional, Protocol, Tuple, Union, runtime_checkable
 
 from chocs import HttpRequest
 
 from chocs_middleware.cache.error import CacheError
+from chocs_middleware.cache.eviction import IEvictionPolicy, LRUEvictionPolicy
+from chocs_middleware.cache.expiry import ExpiryQueue, IReapableCacheStorage
+from chocs_middleware.cache.invalidation import IInvalidatableCacheStorage, InvalidationIndex
+from chocs_middleware.cache.metrics import ICacheMetrics
 
 __all__ = [
     "InMemoryCacheStorage",
     "CacheItem",
     "ICacheStorage",
     "generate_cache_id",
+    "normalize_query_string",
     "ICollectableCacheStorage",
+    "IStreamingCacheStorage",
+    "IBatchCacheStorage",
+    "IBatchCollectableCacheStorage",
+    "ITouchableCacheStorage",
     "CollectableInMemoryCacheStorage",
+    "BoundedInMemoryCacheStorage",
+    "ShardedInMemoryCacheStorage",
+    "dump_item",
+    "dump_item_metadata",
+    "load_item",
+    "get_many",
+    "set_many",
+    "collect_many",
 ]
 
 
+_EPOCH = datetime(1970, 1, 1)
+# version, ttl, created, updated, expires, size of tags and path
+_ITEM = struct.Struct("!BidddI")
+_ITEM_VERSION = 2
+_LEGACY_ITEM = struct.Struct("!Biddd")
+# ttl, created, updated, expires - fields following the version in both item formats
+_ITEM_METADATA = struct.Struct("!iddd")
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
 class CacheItem:
+    """
+    Timestamps are kept as seconds since the epoch (UTC), `datetime` objects are only built when
+    `created_at`, `updated_at` or `expires_at` are accessed.
+
+    `decoded` can hold a decoded representation of the body (e.g. response template), it is not persisted
+    and it is reset every time the body changes.
+
+    `tags` and `path` are used to invalidate items in bulk, see `IInvalidatableCacheStorage`.
+
+    Items read with `IStreamingCacheStorage.get_stream` carry no body, only its decoded representation.
+    """
+
+    __slots__ = ("_id", "_body", "ttl", "_created", "_updated", "_expires", "decoded", "tags", "path")
+
     _id: str
     _body: bytes
     ttl: int
-    _created_at: datetime
-    _updated_at: datetime
-    _expires_at: datetime
-
-    def __init__(self, item_id: str, body: bytes, ttl: int = 30):
+    _created: float
+    _updated: float
+    _expires: float
+    decoded: Any
+    tags: Tuple[str, ...]
+    path: str
+
+    def __init__(self, item_id: str, body: bytes, ttl: int = 30, tags: Tuple[str, ...] = (), path: str = ""):
+        now = time.time()
         self._id = item_id
         self._body = body
         self.ttl = ttl
-        self._created_at = datetime.utcnow()
-        self._updated_at = datetime.utcnow()
-        self._expires_at = self.updated_at + timedelta(0, self.ttl)
+        self._created = now
+        self._updated = now
+        self._expires = now + ttl
+        self.decoded = None
+        self.tags = tags
+        self.path = path
 
     @property
     def id(self) -> str:
@@ -39,7 +92,7 @@ class CacheItem:
 
     @property
     def is_expired(self) -> bool:
-        return self.expires_at < datetime.utcnow()
+        return self._expires < time.time()
 
     @property
     def body(self) -> bytes:
@@ -47,29 +100,69 @@ class CacheItem:
 
     @body.setter
     def body(self, value: bytes) -> None:
+        now = time.time()
         self._body = value
-        self._updated_at = datetime.utcnow()
-        self._expires_at = self.updated_at + timedelta(0, self.ttl)
+        self._updated = now
+        self._expires = now + self.ttl
+        self.decoded = None
+
+    @property
+    def age(self) -> int:
+        return int(time.time() - self._updated)
 
     @property
     def created_at(self) -> datetime:
-        return self._created_at
+        return _EPOCH + timedelta(seconds=self._created)
 
     @property
     def updated_at(self) -> datetime:
-        return self._updated_at
+        return _EPOCH + timedelta(seconds=self._updated)
 
     @property
     def expires_at(self) -> datetime:
-        return self._expires_at
+        return _EPOCH + timedelta(seconds=self._expires)
+
+    @property
+    def created_timestamp(self) -> float:
+        return self._created
+
+    @property
+    def updated_timestamp(self) -> float:
+        return self._updated
+
+    @property
+    def expires_timestamp(self) -> float:
+        return self._expires
 
     def __bool__(self) -> bool:
-        return self._body != b""
+        return self._body != b"" or self.decoded is not None
 
     @classmethod
     def empty(cls, cache_id: str) -> "CacheItem":
         return cls(cache_id, b"", 0)
 
+    @classmethod
+    def restore(
+        cls,
+        item_id: str,
+        body: bytes,
+        ttl: int,
+        created: float,
+        updated: float,
+        expires: float,
+        tags: Tuple[str, ...] = (),
+        path: str = "",
+    ) -> "CacheItem":
+        """
+        Recreates an item read back from a persistent storage, keeping its original timestamps.
+        """
+        item = cls(item_id, body, ttl, tags, path)
+        item._created = created
+        item._updated = updated
+        item._expires = expires
+
+        return item
+
 
 @runtime_checkable
 class ICacheStorage(Protocol):
@@ -89,17 +182,194 @@ class ICollectableCacheStorage(ICacheStorage, Protocol):
         ...
 
 
-class InMemoryCacheStorage(ICacheStorage):
-    def __init__(self):
-        self._cache = {}
+@runtime_checkable
+class IStreamingCacheStorage(ICacheStorage, Protocol):
+    """
+    Storage writing and reading item bodies in chunks, so a large body is not copied into a single object
+    on its way to or from the storage.
+    """
+
+    @abstractmethod
+    def set_stream(self, item: CacheItem, chunks: Iterable[Buffer], size: int) -> None:
+        """
+        Stores the item with body made of `chunks` (`size` bytes in total), `item.body` is ignored.
+        """
+        ...
+
+    @abstractmethod
+    def get_stream(self, item_id: str, sink: Callable[[memoryview], Any], chunk_size: int) -> CacheItem:
+        """
+        Passes the item's body to `sink` in chunks of at most `chunk_size` bytes, which are valid only
+        during the call. Returned item has no body.
+        """
+        ...
+
+
+@runtime_checkable
+class IBatchCacheStorage(ICacheStorage, Protocol):
+    """
+    Storage retrieving and storing several items at once (e.g. in a single network round trip). Storages
+    implementing single-item methods only are supported by `get_many`, `set_many` and `collect_many` functions.
+    """
+
+    @abstractmethod
+    def get_many(self, item_ids: Iterable[str]) -> Dict[str, CacheItem]:
+        """
+        Returns found items by their ids, missing items are omitted.
+        """
+        ...
+
+    @abstractmethod
+    def set_many(self, items: Iterable[CacheItem]) -> None:
+        ...
+
+
+@runtime_checkable
+class IBatchCollectableCacheStorage(ICollectableCacheStorage, IBatchCacheStorage, Protocol):
+    @abstractmethod
+    def collect_many(self, items: Iterable[CacheItem]) -> None:
+        ...
+
+
+@runtime_checkable
+class ITouchableCacheStorage(ICacheStorage, Protocol):
+    """
+    Storage updating item's metadata without rewriting its body, e.g. to extend lifetime of a revalidated
+    item whose content has not changed.
+    """
+
+    @abstractmethod
+    def touch(self, items: Iterable[CacheItem]) -> int:
+        """
+        Copies ttl and timestamps of `items` to the stored items with the same ids, bodies, tags and paths are kept.
+        Returns number of touched items, items which are not stored are skipped.
+        """
+        ...
+
+
+class InMemoryCacheStorage(
+    IBatchCacheStorage, ITouchableCacheStorage, IReapableCacheStorage, IInvalidatableCacheStorage
+):
+    """
+    When `expiry_grace` is set, items expired for longer than `expiry_grace` seconds are dropped on read
+    and by `reap`. By default expired items are kept, so they can still be revalidated.
+
+    All operations are guarded with a single lock, so the storage can be shared with a `CacheReaper` thread.
+    """
+
+    def __init__(self, expiry_grace: Optional[int] = None):
+        self._cache: Dict[str, CacheItem] = {}
+        self.expiry_grace = expiry_grace
+        self._expiry_queue = ExpiryQueue()
+        self._index = InvalidationIndex()
+        self._lock = threading.RLock()
 
     def get(self, item_id: str) -> CacheItem:
-        if item_id in self._cache:
-            return self._cache[item_id]
-        raise CacheError.for_not_found(item_id)
+        with self._lock:
+            item = self._lookup(item_id)
+        if item is None:
+            raise CacheError.for_not_found(item_id)
+        return item
 
     def set(self, item: CacheItem) -> None:
-        self._cache[item.id] = item
+        with self._lock:
+            self._cache[item.id] = item
+            self._index.add(item.id, item.tags, item.path)
+            if self.expiry_grace is not None:
+                self._expiry_queue.schedule(item.id, item.expires_timestamp)
+
+    def get_many(self, item_ids: Iterable[str]) -> Dict[str, CacheItem]:
+        items = {}
+        with self._lock:
+            for item_id in item_ids:
+                try:
+                    items[item_id] = self.get(item_id)
+                except CacheError:
+                    continue
+
+        return items
+
+    def set_many(self, items: Iterable[CacheItem]) -> None:
+        with self._lock:
+            for item in items:
+                self.set(item)
+
+    def touch(self, items: Iterable[CacheItem]) -> int:
+        with self._lock:
+            return self._touch(items)
+
+    def _touch(self, items: Iterable[CacheItem]) -> int:
+        touched = 0
+        for item in items:
+            stored = self._lookup(item.id)
+            if stored is None:
+                continue
+            # Stored item is replaced, as it may be in use by other threads.
+            self._cache[item.id] = CacheItem.restore(
+                stored.id,
+                stored.body,
+                item.ttl,
+                stored.created_timestamp,
+                item.updated_timestamp,
+                item.updated_timestamp + item.ttl,
+                stored.tags,
+                stored.path,
+            )
+            touched += 1
+
+        return touched
+
+    def reap(self, limit: int = 1000) -> int:
+        if self.expiry_grace is None:
+            return 0
+
+        deadline = time.time() - self.expiry_grace
+        reaped = 0
+        with self._lock:
+            for item_id, _ in self._expiry_queue.pop_expired(deadline, limit):
+                item = self._cache.get(item_id)
+                if item is None:
+                    continue
+                # Item's lifetime was extended without storing it again.
+                if item.expires_timestamp > deadline:
+                    self._expiry_queue.schedule(item_id, item.expires_timestamp)
+                    continue
+                self._remove(item_id)
+                reaped += 1
+
+        return reaped
+
+    def _lookup(self, item_id: str) -> Optional[CacheItem]:
+        item = self._cache.get(item_id)
+        if item is None or self.expiry_grace is None:
+            return item
+
+        if item.expires_timestamp + self.expiry_grace < time.time():
+            self._remove(item_id)
+            return None
+
+        return item
+
+    def _remove(self, item_id: str) -> None:
+        del self._cache[item_id]
+        self._expiry_queue.discard(item_id)
+        self._index.discard(item_id)
+
+    def invalidate_tag(self, tag: str) -> int:
+        with self._lock:
+            item_ids = self._index.tagged(tag)
+            for item_id in item_ids:
+                self._remove(item_id)
+
+        return len(item_ids)
+
+    def invalidate_prefix(self, path_prefix: str) -> int:
+        with self._lock:
+            item_ids = self._index.prefixed(path_prefix)
+            for item_id in item_ids:
+                self._remove(item_id)
+
+        return len(item_ids)
 
     @property
     def is_empty(self) -> bool:
@@ -109,16 +379,322 @@ class InMemoryCacheStorage(ICacheStorage):
         return len(self._cache)
 
 
-class CollectableInMemoryCacheStorage(InMemoryCacheStorage, ICollectableCacheStorage):
+class CollectableInMemoryCacheStorage(InMemoryCacheStorage, IBatchCollectableCacheStorage):
+    def collect(self, item: CacheItem) -> None:
+        with self._lock:
+            if item.id in self._cache:
+                self._remove(item.id)
+
+    def collect_many(self, items: Iterable[CacheItem]) -> None:
+        with self._lock:
+            for item in items:
+                self.collect(item)
+
+
+class BoundedInMemoryCacheStorage(CollectableInMemoryCacheStorage):
+    """
+    In-memory storage limited by the number of items and/or the total size of their bodies (in bytes).
+    Once either limit is exceeded, items chosen by the eviction policy are dropped. Limit set to 0 is not enforced.
+    When `max_age` is set, items held for longer than `max_age` seconds (regardless of their ttl) are dropped on read.
+    """
+
+    def __init__(
+        self,
+        max_items: int = 1024,
+        max_bytes: int = 0,
+        eviction_policy: Optional[IEvictionPolicy] = None,
+        expiry_grace: Optional[int] = None,
+        max_age: Optional[float] = None,
+        metrics: Optional[ICacheMetrics] = None,
+    ):
+        super().__init__(expiry_grace)
+        if max_items <= 0 and max_bytes <= 0:
+            raise ValueError("At least one of `max_items` or `max_bytes` must be a positive number.")
+
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.metrics = metrics
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        self._eviction_policy = eviction_policy if eviction_policy is not None else LRUEvictionPolicy()
+        self._sizes: Dict[str, int] = {}
+        self._stored_at: Dict[str, float] = {}
+        self._total_bytes = 0
+
+    def get(self, item_id: str) -> CacheItem:
+        with self._lock:
+            item = self._lookup(item_id)
+            if item is not None and self.max_age is not None and self._stored_at[item_id] + self.max_age < time.time():
+                self._remove(item_id)
+                item = None
+
+            if item is None:
+                self.misses += 1
+                raise CacheError.for_not_found(item_id)
+
+            self.hits += 1
+            self._eviction_policy.touch(item_id)
+
+        return item
+
+    def set(self, item: CacheItem) -> None:
+        with self._lock:
+            self._set(item)
+
+    def _set(self, item: CacheItem) -> None:
+        size = len(item.body)
+
+        # Body larger than `max_bytes` would evict everything else and itself, its stale version is dropped instead.
+        if self.max_bytes and size > self.max_bytes:
+            if item.id in self._cache:
+                self._remove(item.id)
+            return
+
+        if item.id in self._cache:
+            self._total_bytes -= self._sizes[item.id]
+            self._eviction_policy.touch(item.id)
+        else:
+            self._eviction_policy.insert(item.id)
+
+        super().set(item)
+        self._sizes[item.id] = size
+        self._stored_at[item.id] = time.time()
+        self._total_bytes += size
+
+        while (self.max_items and len(self._cache) > self.max_items) or (
+            self.max_bytes and self._total_bytes > self.max_bytes
+        ):
+            self._discard(self._eviction_policy.evict())
+            self.evictions += 1
+            if self.metrics is not None:
+                self.metrics.increment("eviction", "")
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def _remove(self, item_id: str) -> None:
+        self._eviction_policy.remove(item_id)
+        self._discard(item_id)
+
+    def _discard(self, item_id: str) -> None:
+        super()._remove(item_id)
+        self._total_bytes -= self._sizes.pop(item_id)
+        del self._stored_at[item_id]
+
+
+class ShardedInMemoryCacheStorage(
+    IBatchCollectableCacheStorage, ITouchableCacheStorage, IReapableCacheStorage, IInvalidatableCacheStorage
+):
+    """
+    In-memory storage with reduced lock contention. Items are spread by their id across `shards` storages, each
+    guarded by its own lock, so threads accessing different shards do not wait for each other.
+    `shard_factory` creates a storage for a single shard, limits of bounded storages are enforced per shard.
+    """
+
+    def __init__(
+        self,
+        shards: int = 16,
+        shard_factory: Optional[Callable[[], CollectableInMemoryCacheStorage]] = None,
+    ):
+        if shards <= 0:
+            raise ValueError("Number of shards must be a positive number.")
+
+        factory = shard_factory if shard_factory is not None else CollectableInMemoryCacheStorage
+        self._shards = tuple(factory() for _ in range(shards))
+
+    def get(self, item_id: str) -> CacheItem:
+        index = hash(item_id) % len(self._shards)
+        return self._shards[index].get(item_id)
+
+    def set(self, item: CacheItem) -> None:
+        index = hash(item.id) % len(self._shards)
+        self._shards[index].set(item)
+
     def collect(self, item: CacheItem) -> None:
-        del self._cache[item.id]
+        index = hash(item.id) % len(self._shards)
+        self._shards[index].collect(item)
+
+    def get_many(self, item_ids: Iterable[str]) -> Dict[str, CacheItem]:
+        items = {}
+        for index, shard_item_ids in self._group(item_ids, lambda item_id: item_id).items():
+            items.update(self._shards[index].get_many(shard_item_ids))
+
+        return items
+
+    def set_many(self, items: Iterable[CacheItem]) -> None:
+        for index, shard_items in self._group(items, lambda item: item.id).items():
+            self._shards[index].set_many(shard_items)
+
+    def collect_many(self, items: Iterable[CacheItem]) -> None:
+        for index, shard_items in self._group(items, lambda item: item.id).items():
+            self._shards[index].collect_many(shard_items)
+
+    def touch(self, items: Iterable[CacheItem]) -> int:
+        touched = 0
+        for index, shard_items in self._group(items, lambda item: item.id).items():
+            touched += self._shards[index].touch(shard_items)
+
+        return touched
+
+    def _group(self, values: Iterable[Any], get_id: Callable[[Any], str]) -> Dict[int, List[Any]]:
+        # Values are grouped by their shard, so every shard lock is taken once per batch.
+        groups: Dict[int, List[Any]] = {}
+        for value in values:
+            groups.setdefault(hash(get_id(value)) % len(self._shards), []).append(value)
+
+        return groups
+
+    def reap(self, limit: int = 1000) -> int:
+        reaped = 0
+        for shard in self._shards:
+            if reaped >= limit:
+                break
+            reaped += shard.reap(limit - reaped)
+
+        return reaped
+
+    def invalidate_tag(self, tag: str) -> int:
+        invalidated = 0
+        for shard in self._shards:
+            invalidated += shard.invalidate_tag(tag)
+
+        return invalidated
+
+    def invalidate_prefix(self, path_prefix: str) -> int:
+        invalidated = 0
+        for shard in self._shards:
+            invalidated += shard.invalidate_prefix(path_prefix)
+
+        return invalidated
+
+    @property
+    def shards(self) -> Tuple[CollectableInMemoryCacheStorage, ...]:
+        return self._shards
+
+    @property
+    def is_empty(self) -> bool:
+        return len(self) <= 0
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self._shards)
+
+
+def get_many(storage: ICacheStorage, item_ids: Iterable[str]) -> Dict[str, CacheItem]:
+    """
+    Retrieves items with a single call when the storage implements `IBatchCacheStorage`, one by one otherwise.
+    Missing items are omitted.
+    """
+    if isinstance(storage, IBatchCacheStorage):
+        return storage.get_many(item_ids)
+
+    items = {}
+    for item_id in item_ids:
+        try:
+            items[item_id] = storage.get(item_id)
+        except CacheError:
+            continue
+
+    return items
+
+
+def set_many(storage: ICacheStorage, items: Iterable[CacheItem]) -> None:
+    if isinstance(storage, IBatchCacheStorage):
+        storage.set_many(items)
+        return
+
+    for item in items:
+        storage.set(item)
+
+
+def collect_many(storage: ICollectableCacheStorage, items: Iterable[CacheItem]) -> None:
+    if isinstance(storage, IBatchCollectableCacheStorage):
+        storage.collect_many(items)
+        return
+
+    for item in items:
+        storage.collect(item)
+
+
+def dump_item(item: CacheItem) -> bytes:
+    """
+    Serialises the item (without its id) for storages that keep items outside of the process.
+    """
+    labels = "\x00".join((item.path, *item.tags)).encode("utf8")
+    header = _ITEM.pack(
+        _ITEM_VERSION, item.ttl, item.created_timestamp, item.updated_timestamp, item.expires_timestamp, len(labels)
+    )
+    return header + labels + item.body
+
+
+def dump_item_metadata(item: CacheItem) -> bytes:
+    """
+    Serialises item's ttl and timestamps, as they are stored by `dump_item` after the first (version) byte.
+    """
+    return _ITEM_METADATA.pack(item.ttl, item.created_timestamp, item.updated_timestamp, item.expires_timestamp)
+
+
+def load_item(item_id: str, data: bytes) -> CacheItem:
+    if len(data) < _LEGACY_ITEM.size:
+        raise CacheError.for_invalid_payload()
+
+    version = data[0]
+    if version == 1:
+        _, ttl, created, updated, expires = _LEGACY_ITEM.unpack_from(data)
+        return CacheItem.restore(item_id, data[_LEGACY_ITEM.size :], ttl, created, updated, expires)
+
+    if version != _ITEM_VERSION:
+        raise CacheError.for_unsupported_version(version)
+    if len(data) < _ITEM.size:
+        raise CacheError.for_invalid_payload()
+
+    _, ttl, created, updated, expires, labels_size = _ITEM.unpack_from(data)
+    body_offset = _ITEM.size + labels_size
+    path, *tags = data[_ITEM.size : body_offset].decode("utf8").split("\x00")
+
+    return CacheItem.restore(item_id, data[body_offset:], ttl, created, updated, expires, tuple(tags), path)
+
+
+@lru_cache(maxsize=256)
+def _normalize_vary(cache_vary: Tuple[str, ...]) -> Tuple[str, ...]:
+    return tuple(header.strip().lower() for header in cache_vary if header.strip())
+
+
+@lru_cache(maxsize=4096)
+def normalize_query_string(query_string: str) -> str:
+    """
+    Orders query parameters by their names, so reordered parameters produce the same cache id. Order of values
+    of a repeated parameter is kept, as it may be meaningful.
+    """
+    if "&" not in query_string:
+        return query_string
+
+    parameters = [parameter for parameter in query_string.split("&") if parameter]
+    parameters.sort(key=lambda parameter: parameter.partition("=")[0])
 
+    return "&".join(parameters)
 
-def generate_cache_id(request: HttpRequest, cache_vary: Iterable[str] = ("accept", "accept-language")) -> str:
 
-    hash_str = f"{request.path}:{request.query_string}"
+def generate_cache_id(
+    request: HttpRequest,
+    cache_vary: Iterable[str] = ("accept", "accept-language"),
+    digest_size: int = 16,
+    normalize_query: bool = True,
+) -> str:
+    """
+    Hashes request's path, query string and values of `cache_vary` headers with blake2b, parts are separated
+    so values moved between headers do not produce the same id.
+    """
+    key = hashlib.blake2b(request.path.encode("utf8"), digest_size=digest_size)
+    query_string = str(request.query_string)
+    key.update(b"?")
+    key.update((normalize_query_string(query_string) if normalize_query else query_string).encode("utf8"))
 
-    for header in cache_vary:
-        hash_str += "".join(request.headers.get(header))
+    for header in _normalize_vary(tuple(cache_vary)):
+        value = request.headers.get(header)
+        key.update(b"\x00")
+        key.update((value if isinstance(value, str) else ",".join(value)).encode("utf8"))
 
-    return hashlib.sha1(hash_str.encode("utf8")).hexdigest()
+    return key.hexdigest()
@@ -0,0 +1,156 @@
+import lzma
+import zlib
+from abc import abstractmethod
+from typing import Dict, Optional, Protocol, Set, Tuple, runtime_checkable
+
+from chocs import HttpResponse
+
+from chocs_middleware.cache.cache_storage import Buffer
+from chocs_middleware.cache.error import CacheError
+
+__all__ = [
+    "ICompressionCodec",
+    "ZlibCodec",
+    "GzipCodec",
+    "LzmaCodec",
+    "CompressionPolicy",
+    "register_codec",
+    "get_codec",
+    "get_content_encodings",
+]
+
+DEFAULT_COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/xml",
+    "application/javascript",
+    "application/x-ndjson",
+    "image/svg+xml",
+)
+
+
+@runtime_checkable
+class ICompressionCodec(Protocol):
+    """
+    `codec_id` identifies the codec in stored payloads (1-255) and must never change once items are stored.
+    `content_encoding` is a http content-coding token, codecs without one are always decompressed before serving.
+    """
+
+    codec_id: int
+    content_encoding: Optional[str]
+
+    @abstractmethod
+    def compress(self, data: Buffer) -> bytes:
+        ...
+
+    @abstractmethod
+    def decompress(self, data: Buffer) -> bytes:
+        ...
+
+
+class ZlibCodec(ICompressionCodec):
+    codec_id = 1
+    content_encoding = "deflate"
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def compress(self, data: Buffer) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: Buffer) -> bytes:
+        return zlib.decompress(data)
+
+
+class GzipCodec(ICompressionCodec):
+    codec_id = 2
+    content_encoding = "gzip"
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def compress(self, data: Buffer) -> bytes:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: Buffer) -> bytes:
+        return zlib.decompress(data, 31)
+
+
+class LzmaCodec(ICompressionCodec):
+    codec_id = 3
+    content_encoding = None
+
+    def __init__(self, preset: int = 6):
+        self.preset = preset
+
+    def compress(self, data: Buffer) -> bytes:
+        return lzma.compress(data, preset=self.preset)
+
+    def decompress(self, data: Buffer) -> bytes:
+        return lzma.decompress(data)
+
+
+_codecs: Dict[int, ICompressionCodec] = {}
+
+
+def register_codec(codec: ICompressionCodec) -> None:
+    if not 0 < codec.codec_id < 256:
+        raise ValueError("Codec id must be a number between 1 and 255.")
+    _codecs[codec.codec_id] = codec
+
+
+def get_codec(codec_id: int) -> ICompressionCodec:
+    if codec_id not in _codecs:
+        raise CacheError.for_unknown_codec(codec_id)
+    return _codecs[codec_id]
+
+
+def get_content_encodings() -> Set[str]:
+    """
+    Http content-codings of the registered codecs.
+    """
+    return {codec.content_encoding for codec in _codecs.values() if codec.content_encoding}
+
+
+register_codec(ZlibCodec())
+register_codec(GzipCodec())
+register_codec(LzmaCodec())
+
+
+class CompressionPolicy:
+    """
+    Decides which codec (if any) is used to store a response. Bodies smaller than `min_size`, already encoded
+    bodies and bodies of content types not listed in `content_types` are stored as they are.
+    `codecs` maps content type prefixes to codecs that should be used instead of the default one.
+    """
+
+    def __init__(
+        self,
+        codec: Optional[ICompressionCodec] = None,
+        min_size: int = 1024,
+        content_types: Tuple[str, ...] = DEFAULT_COMPRESSIBLE_TYPES,
+        codecs: Optional[Dict[str, ICompressionCodec]] = None,
+    ):
+        self.codec = codec if codec is not None else get_codec(GzipCodec.codec_id)
+        self.min_size = min_size
+        self.content_types = content_types
+        self.codecs = codecs if codecs is not None else {}
+
+        for item in (self.codec, *self.codecs.values()):
+            if _codecs.get(item.codec_id) is not item:
+                register_codec(item)
+
+    def select_codec(self, response: HttpResponse, size: int) -> Optional[ICompressionCodec]:
+        if size < self.min_size or "content-encoding" in response.headers:
+            return None
+
+        content_type = str(response.headers.get("content-type")).split(";")[0].strip().lower()
+        for prefix, codec in self.codecs.items():
+            if content_type.startswith(prefix):
+                return codec
+
+        if content_type.startswith(self.content_types):
+            return self.codec
+
+        return None
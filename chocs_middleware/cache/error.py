@@ -2,3 +2,35 @@ class CacheError(Exception):
     @staticmethod
     def for_not_found(item_id: str) -> "CacheError":
         return CacheError(f"Could not retrieve cache item with given id `{item_id}`")
+
+    @staticmethod
+    def for_empty_eviction_policy() -> "CacheError":
+        return CacheError("Could not evict an item, eviction policy holds no keys")
+
+    @staticmethod
+    def for_invalid_payload() -> "CacheError":
+        return CacheError("Could not decode cached response, payload is malformed")
+
+    @staticmethod
+    def for_unsupported_version(version: int) -> "CacheError":
+        return CacheError(f"Could not decode cached response, unsupported format version `{version}`")
+
+    @staticmethod
+    def for_unknown_codec(codec_id: int) -> "CacheError":
+        return CacheError(f"Could not decode cached response, unknown compression codec `{codec_id}`")
+
+    @staticmethod
+    def for_async_storage() -> "CacheError":
+        return CacheError("Asynchronous cache storage can only be used with `CacheMiddleware.handle_async`")
+
+    @staticmethod
+    def for_invalid_storage_file(path: str, reason: str) -> "CacheError":
+        return CacheError(f"Could not open cache storage file `{path}`, {reason}")
+
+    @staticmethod
+    def for_redis_error(message: str) -> "CacheError":
+        return CacheError(f"Redis server responded with an error `{message}`")
+
+    @staticmethod
+    def for_invalid_cache_tag(tag: str, route: str) -> "CacheError":
+        return CacheError(f"Could not format cache tag `{tag}`, route `{route}` has no such path parameter")
@@ -0,0 +1,106 @@
+import re
+from typing import Dict, Iterable, List, Tuple
+
+from chocs_middleware.cache.cache_storage import CacheItem
+from chocs_middleware.cache.http_support import decode_etag_value, parse_etag_value
+
+__all__ = ["etag_index_id", "etag_index_ids", "create_etag_index_item", "parse_etags", "matches_etags"]
+
+_WEAK = b"W"
+_STRONG = b"S"
+_ETAG_LIST_ITEM = re.compile(r'\s*((?:W/)?"[^"]*"|[^,\s]+)\s*(?:,|$)')
+
+
+def etag_index_id(resource_id: str, etag: str) -> str:
+    """
+    Id of the index entry stating that a variant of the resource identified by `resource_id` (its cache id
+    generated without vary headers) has given entity tag (without quotes).
+    """
+    return f"{resource_id}#etag:{etag}"
+
+
+def etag_index_ids(resource_id: str, etag: str) -> Tuple[str, ...]:
+    """
+    Ids of index entries the entity tag (as sent in a conditional header) may refer to. Entity tags of encoded
+    responses are indexed as the tags of identity ones, but the handler's own tag may end with a content-coding
+    suffix too, so both the tag as it is and the decoded tag are looked up.
+    """
+    value = parse_etag_value(etag)
+    decoded = decode_etag_value(value)
+    if decoded == value:
+        return (etag_index_id(resource_id, value),)
+
+    return etag_index_id(resource_id, value), etag_index_id(resource_id, decoded)
+
+
+def create_etag_index_item(cache_item: CacheItem, etag: str, resource_id: str) -> CacheItem:
+    """
+    Creates an index entry for the item's entity tag (as sent in the `etag` header). Entries are kept per resource,
+    so the tag is found regardless of the variant a request asks for, the body holds the weakness indicator and id
+    of the variant. The entry shares the item's timestamps, tags and path, so it is validated against, expires and
+    is invalidated together with the item, while its body is only a few bytes long.
+    """
+    return CacheItem.restore(
+        etag_index_id(resource_id, parse_etag_value(etag)),
+        (_WEAK if etag.strip().startswith("W/") else _STRONG) + cache_item.id.encode("utf8"),
+        cache_item.ttl,
+        cache_item.created_timestamp,
+        cache_item.updated_timestamp,
+        cache_item.expires_timestamp,
+        cache_item.tags,
+        cache_item.path,
+    )
+
+
+def parse_etags(value: str) -> List[str]:
+    """
+    Splits value of `if-match` or `if-none-match` header into entity tags, quotes and weakness indicators
+    are kept.
+    """
+    return [match.group(1) for match in _ETAG_LIST_ITEM.finditer(value)]
+
+
+def matches_etags(
+    etags: Iterable[str],
+    cache_item: CacheItem,
+    index_items: Dict[str, CacheItem],
+    weak_comparison: bool,
+    resource_id: str,
+    any_variant: bool = False,
+) -> bool:
+    """
+    Tells whether any of `etags` is the current entity tag of `cache_item` (the requested variant of the resource
+    identified by `resource_id`), `*` matches when the variant is cached. Index entries are looked up in
+    `index_items`, an entry is current when it was stored together with the cached item, or (when the item
+    is not available) when it has not expired. With `any_variant` (conditional requests changing the resource)
+    unexpired entries of other variants match too. Strong comparison is used for `if-match` and weak comparison
+    for `if-none-match`.
+    """
+    variant_id = cache_item.id.encode("utf8")
+    for etag in etags:
+        if etag == "*":
+            if cache_item:
+                return True
+            continue
+        if not weak_comparison and etag.startswith("W/"):
+            continue
+
+        for index_id in etag_index_ids(resource_id, etag):
+            entry = index_items.get(index_id)
+            if entry is not None and _matches_entry(entry, cache_item, variant_id, weak_comparison, any_variant):
+                return True
+
+    return False
+
+
+def _matches_entry(
+    entry: CacheItem, cache_item: CacheItem, variant_id: bytes, weak_comparison: bool, any_variant: bool
+) -> bool:
+    if not weak_comparison and entry.body[:1] == _WEAK:
+        return False
+    if entry.body[1:] != variant_id:
+        return any_variant and not entry.is_expired
+    if cache_item:
+        return entry.updated_timestamp == cache_item.updated_timestamp
+
+    return not entry.is_expired
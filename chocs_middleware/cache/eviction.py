@@ -0,0 +1,216 @@
+from abc import abstractmethod
+from collections import OrderedDict
+from typing import Dict, Optional, Protocol, runtime_checkable
+
+from chocs_middleware.cache.error import CacheError
+
+__all__ = [
+    "IEvictionPolicy",
+    "LRUEvictionPolicy",
+    "LFUEvictionPolicy",
+    "SIEVEEvictionPolicy",
+]
+
+
+@runtime_checkable
+class IEvictionPolicy(Protocol):
+    """
+    Keeps track of the keys held by a bounded storage and decides which of them should be dropped first.
+    All operations are expected to run in constant time.
+    """
+
+    @abstractmethod
+    def insert(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def touch(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def remove(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def evict(self) -> str:
+        ...
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+
+class LRUEvictionPolicy(IEvictionPolicy):
+    def __init__(self):
+        self._keys: "OrderedDict[str, None]" = OrderedDict()
+
+    def insert(self, key: str) -> None:
+        self._keys[key] = None
+
+    def touch(self, key: str) -> None:
+        self._keys.move_to_end(key)
+
+    def remove(self, key: str) -> None:
+        del self._keys[key]
+
+    def evict(self) -> str:
+        if not self._keys:
+            raise CacheError.for_empty_eviction_policy()
+        key, _ = self._keys.popitem(last=False)
+        return key
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+class _FrequencyNode:
+    __slots__ = ("frequency", "keys", "higher", "lower")
+
+    def __init__(self, frequency: int):
+        self.frequency = frequency
+        self.keys: "OrderedDict[str, None]" = OrderedDict()
+        self.higher: Optional["_FrequencyNode"] = None
+        self.lower: Optional["_FrequencyNode"] = None
+
+
+class LFUEvictionPolicy(IEvictionPolicy):
+    """
+    Keys are grouped in buckets by their access frequency, within a bucket the least recently used key goes first.
+    Buckets form a list ordered by frequency, so the least frequently used key is always found in the first one.
+    """
+
+    def __init__(self):
+        self._nodes: Dict[str, _FrequencyNode] = {}
+        self._lowest: Optional[_FrequencyNode] = None
+
+    def insert(self, key: str) -> None:
+        node = self._lowest
+        if node is None or node.frequency != 1:
+            node = self._link(_FrequencyNode(1), None, node)
+        node.keys[key] = None
+        self._nodes[key] = node
+
+    def touch(self, key: str) -> None:
+        node = self._nodes[key]
+        higher = node.higher
+        if higher is None or higher.frequency != node.frequency + 1:
+            higher = self._link(_FrequencyNode(node.frequency + 1), node, higher)
+        higher.keys[key] = None
+        self._nodes[key] = higher
+        self._discard(node, key)
+
+    def remove(self, key: str) -> None:
+        self._discard(self._nodes.pop(key), key)
+
+    def evict(self) -> str:
+        node = self._lowest
+        if node is None:
+            raise CacheError.for_empty_eviction_policy()
+
+        key = next(iter(node.keys))
+        self._discard(node, key)
+        del self._nodes[key]
+
+        return key
+
+    def frequency(self, key: str) -> int:
+        node = self._nodes.get(key)
+        return node.frequency if node is not None else 0
+
+    def _link(
+        self, node: _FrequencyNode, lower: Optional[_FrequencyNode], higher: Optional[_FrequencyNode]
+    ) -> _FrequencyNode:
+        node.lower, node.higher = lower, higher
+        if lower is not None:
+            lower.higher = node
+        else:
+            self._lowest = node
+        if higher is not None:
+            higher.lower = node
+
+        return node
+
+    def _discard(self, node: _FrequencyNode, key: str) -> None:
+        del node.keys[key]
+        if node.keys:
+            return
+        if node.lower is not None:
+            node.lower.higher = node.higher
+        else:
+            self._lowest = node.higher
+        if node.higher is not None:
+            node.higher.lower = node.lower
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+
+class _SieveNode:
+    __slots__ = ("key", "visited", "newer", "older")
+
+    def __init__(self, key: str):
+        self.key = key
+        self.visited = False
+        self.newer: Optional["_SieveNode"] = None
+        self.older: Optional["_SieveNode"] = None
+
+
+class SIEVEEvictionPolicy(IEvictionPolicy):
+    """
+    Scan-resistant policy, see https://cachemon.github.io/SIEVE-website/. Hits only flip a bit, so popular keys
+    survive one-hit-wonder scans without the list being reordered on every read.
+    """
+
+    def __init__(self):
+        self._nodes: Dict[str, _SieveNode] = {}
+        self._head: Optional[_SieveNode] = None
+        self._tail: Optional[_SieveNode] = None
+        self._hand: Optional[_SieveNode] = None
+
+    def insert(self, key: str) -> None:
+        node = _SieveNode(key)
+        node.older = self._head
+        if self._head is not None:
+            self._head.newer = node
+        self._head = node
+        if self._tail is None:
+            self._tail = node
+        self._nodes[key] = node
+
+    def touch(self, key: str) -> None:
+        self._nodes[key].visited = True
+
+    def remove(self, key: str) -> None:
+        self._unlink(self._nodes.pop(key))
+
+    def evict(self) -> str:
+        tail = self._tail
+        if tail is None:
+            raise CacheError.for_empty_eviction_policy()
+
+        node = self._hand or tail
+        while node.visited:
+            node.visited = False
+            node = node.newer or tail
+
+        self._hand = node.newer
+        del self._nodes[node.key]
+        self._unlink(node)
+
+        return node.key
+
+    def _unlink(self, node: _SieveNode) -> None:
+        if self._hand is node:
+            self._hand = node.newer
+        if node.newer is not None:
+            node.newer.older = node.older
+        else:
+            self._head = node.older
+        if node.older is not None:
+            node.older.newer = node.newer
+        else:
+            self._tail = node.newer
+        node.newer = node.older = None
+
+    def __len__(self) -> int:
+        return len(self._nodes)
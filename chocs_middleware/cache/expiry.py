@@ -0,0 +1,116 @@
+import heapq
+import threading
+from abc import abstractmethod
+from typing import Dict, List, Optional, Protocol, Tuple, runtime_checkable
+
+__all__ = ["ExpiryQueue", "IReapableCacheStorage", "CacheReaper"]
+
+
+class ExpiryQueue:
+    """
+    Min-heap of item ids ordered by their expiry time. Re-scheduling an item does not remove its previous
+    entry from the heap, outdated entries are skipped when popped and the heap is rebuilt once they pile up.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, str]] = []
+        self._scheduled: Dict[str, float] = {}
+
+    def schedule(self, item_id: str, expires_at: float) -> None:
+        if self._scheduled.get(item_id) == expires_at:
+            return
+
+        self._scheduled[item_id] = expires_at
+        heapq.heappush(self._heap, (expires_at, item_id))
+
+        if len(self._heap) > 2 * len(self._scheduled) + 64:
+            self._heap = [(expiry, key) for key, expiry in self._scheduled.items()]
+            heapq.heapify(self._heap)
+
+    def discard(self, item_id: str) -> None:
+        self._scheduled.pop(item_id, None)
+
+    def pop_expired(self, deadline: float, limit: int) -> List[Tuple[str, float]]:
+        expired: List[Tuple[str, float]] = []
+        while self._heap and len(expired) < limit and self._heap[0][0] <= deadline:
+            expires_at, item_id = heapq.heappop(self._heap)
+            if self._scheduled.get(item_id) != expires_at:
+                continue
+            del self._scheduled[item_id]
+            expired.append((item_id, expires_at))
+
+        return expired
+
+    def __len__(self) -> int:
+        return len(self._scheduled)
+
+
+@runtime_checkable
+class IReapableCacheStorage(Protocol):
+    @abstractmethod
+    def reap(self, limit: int = 1000) -> int:
+        """
+        Removes at most `limit` expired items from the storage, returns number of removed items.
+        """
+        ...
+
+
+class CacheReaper:
+    """
+    Periodically removes expired items from the storage in bounded batches, so a single run never holds
+    the storage for longer than it takes to drop `batch_size` items. Runs that raised are counted in `failures`,
+    the reaper keeps running and retries on the next interval.
+    """
+
+    def __init__(self, storage: IReapableCacheStorage, interval: float = 1.0, batch_size: int = 1000):
+        self.storage = storage
+        self.interval = interval
+        self.batch_size = batch_size
+        self.reaped = 0
+        self.failures = 0
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_once(self) -> int:
+        reaped = 0
+        while not self._stopped.is_set():
+            batch = self.storage.reap(self.batch_size)
+            reaped += batch
+            if batch < self.batch_size:
+                break
+            self._stopped.wait(0)  # let other threads run between batches
+
+        self.reaped += reaped
+        return reaped
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="chocs-cache-reaper", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                self.failures += 1
+
+    def __enter__(self) -> "CacheReaper":
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
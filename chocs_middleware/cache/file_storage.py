@@ -0,0 +1,535 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from chocs_middleware.cache.cache_storage import (
+    Buffer,
+    CacheItem,
+    IBatchCollectableCacheStorage,
+    ICacheStorage,
+    IStreamingCacheStorage,
+    set_many,
+)
+from chocs_middleware.cache.error import CacheError
+from chocs_middleware.cache.expiry import ExpiryQueue, IReapableCacheStorage
+from chocs_middleware.cache.invalidation import IInvalidatableCacheStorage, InvalidationIndex
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore
+
+__all__ = ["FileCacheStorage"]
+
+# magic, version
+_FILE_HEADER = struct.Struct("!4sH")
+_MAGIC = b"CHCL"
+_VERSION = 1
+
+# crc of the remaining fields and data, kind, key size, labels size, body size, ttl, created, updated, expires
+_RECORD = struct.Struct("!IBHIIiddd")
+_CRC = struct.Struct("!I")
+_ITEM = 1
+_TOMBSTONE = 2
+_COPY_CHUNK_SIZE = 1024 * 1024
+_WARM_BATCH_SIZE = 256
+
+
+class _Entry:
+    __slots__ = ("offset", "size", "body_offset", "body_size", "ttl", "created", "updated", "expires", "tags", "path")
+
+    def __init__(
+        self,
+        offset: int,
+        size: int,
+        body_offset: int,
+        body_size: int,
+        ttl: int,
+        created: float,
+        updated: float,
+        expires: float,
+        tags: Tuple[str, ...],
+        path: str,
+    ):
+        self.offset = offset
+        self.size = size
+        self.body_offset = body_offset
+        self.body_size = body_size
+        self.ttl = ttl
+        self.created = created
+        self.updated = updated
+        self.expires = expires
+        self.tags = tags
+        self.path = path
+
+    def moved_by(self, shift: int) -> "_Entry":
+        return _Entry(
+            self.offset + shift,
+            self.size,
+            self.body_offset + shift,
+            self.body_size,
+            self.ttl,
+            self.created,
+            self.updated,
+            self.expires,
+            self.tags,
+            self.path,
+        )
+
+
+def _parse_records(data: memoryview, offset: int, end: int) -> Iterator[Tuple[str, Optional[_Entry], int]]:
+    """
+    Yields item id, index entry (None for tombstones) and end offset of every valid record between `offset`
+    and `end`, stops at the first torn one.
+    """
+    while offset + _RECORD.size <= end:
+        crc, kind, key_size, labels_size, body_size, ttl, created, updated, expires = _RECORD.unpack_from(data, offset)
+        key_offset = offset + _RECORD.size
+        body_offset = key_offset + key_size + labels_size
+        record_end = body_offset + body_size
+        if kind not in (_ITEM, _TOMBSTONE) or record_end > end:
+            return
+        with data[offset + _CRC.size : record_end] as record:
+            if crc != zlib.crc32(record):
+                return
+        try:
+            item_id = str(data[key_offset : key_offset + key_size], "utf8")
+            path, *tags = str(data[key_offset + key_size : body_offset], "utf8").split("\x00")
+        except UnicodeDecodeError:
+            return
+
+        if kind == _TOMBSTONE:
+            yield item_id, None, record_end
+        else:
+            entry = _Entry(
+                offset, record_end - offset, body_offset, body_size, ttl, created, updated, expires, tuple(tags), path
+            )
+            yield item_id, entry, record_end
+        offset = record_end
+
+
+class FileCacheStorage(
+    IBatchCollectableCacheStorage, IStreamingCacheStorage, IReapableCacheStorage, IInvalidatableCacheStorage
+):
+    """
+    Keeps items in an append-only log file, indexed in memory by item id. The index is rebuilt from the file
+    when the storage is opened, so cached items survive restarts (a record torn by a crash is dropped together
+    with everything written after it). Bodies are read through `mmap`.
+
+    Overwritten and collected items leave dead records behind, once they take more than `compaction_threshold`
+    of a file bigger than `min_compaction_size` bytes, live items are copied to a new file in a background thread.
+    When `expiry_grace` is set, items expired for longer than `expiry_grace` seconds are dropped by `reap`,
+    compaction and on load.
+
+    The file can be used by a single process at a time, pre-forking servers should open a storage (with its own
+    path) in every worker after the fork. POSIX systems only.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        expiry_grace: Optional[int] = None,
+        compaction_threshold: float = 0.5,
+        min_compaction_size: int = 16 * 1024 * 1024,
+        background_compaction: bool = True,
+    ):
+        if fcntl is None:  # pragma: no cover
+            raise CacheError.for_invalid_storage_file(path, "file storage requires a POSIX system")
+
+        self.path = path
+        self.expiry_grace = expiry_grace
+        self.compaction_threshold = compaction_threshold
+        self.min_compaction_size = min_compaction_size
+        self.background_compaction = background_compaction
+        self.dead_bytes = 0
+        self._entries: Dict[str, _Entry] = {}
+        self._index = InvalidationIndex()
+        self._expiry_queue = ExpiryQueue()
+        self._lock = threading.RLock()
+        self._compaction_lock = threading.Lock()
+        self._compaction: Optional[threading.Thread] = None
+        self._pid = os.getpid()
+        self._fd = -1
+        self._mmap: Optional[mmap.mmap] = None
+        self._end = 0
+
+        self._lock_file = open(path + ".lock", "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            raise CacheError.for_invalid_storage_file(path, "it is used by another process")
+
+        try:
+            self._load()
+        except BaseException:
+            self.close()
+            raise
+
+    def get(self, item_id: str) -> CacheItem:
+        with self._locked():
+            return self._read_item(item_id, self._lookup(item_id))
+
+    def get_many(self, item_ids: Iterable[str]) -> Dict[str, CacheItem]:
+        items = {}
+        with self._locked():
+            for item_id in item_ids:
+                entry = self._entries.get(item_id)
+                if entry is not None:
+                    items[item_id] = self._read_item(item_id, entry)
+
+        return items
+
+    def get_stream(self, item_id: str, sink: Callable[[memoryview], Any], chunk_size: int = 64 * 1024) -> CacheItem:
+        with self._locked():
+            entry = self._lookup(item_id)
+            end = entry.body_offset + entry.body_size
+            with memoryview(self._view(end)) as data:
+                for start in range(entry.body_offset, end, chunk_size):
+                    with data[start : min(start + chunk_size, end)] as chunk:
+                        sink(chunk)
+
+        return CacheItem.restore(item_id, b"", entry.ttl, entry.created, entry.updated, entry.expires)
+
+    def set(self, item: CacheItem) -> None:
+        self.set_stream(item, (item.body,), len(item.body))
+
+    def set_stream(self, item: CacheItem, chunks: Iterable[Buffer], size: int) -> None:
+        with self._locked():
+            entry = self._append(_ITEM, item, chunks, size)
+            self._replace(item.id, entry)
+        self._compact_if_needed()
+
+    def set_many(self, items: Iterable[CacheItem]) -> None:
+        with self._locked():
+            for item in items:
+                self._replace(item.id, self._append(_ITEM, item, (item.body,), len(item.body)))
+        self._compact_if_needed()
+
+    def collect(self, item: CacheItem) -> None:
+        self.collect_many((item,))
+
+    def collect_many(self, items: Iterable[CacheItem]) -> None:
+        with self._locked():
+            for item in items:
+                if item.id not in self._entries:
+                    continue
+                # Tombstone keeps the item from being loaded again after restart.
+                tombstone = self._append(_TOMBSTONE, CacheItem(item.id, b"", 0), (), 0)
+                self._replace(item.id, None)
+                self.dead_bytes += tombstone.size
+        self._compact_if_needed()
+
+    def reap(self, limit: int = 1000) -> int:
+        if self.expiry_grace is None:
+            return 0
+
+        deadline = time.time() - self.expiry_grace
+        with self._locked():
+            expired = self._expiry_queue.pop_expired(deadline, limit)
+            for item_id, _ in expired:
+                # Expired records are skipped on load, so no tombstone is needed.
+                self._replace(item_id, None)
+        self._compact_if_needed()
+
+        return len(expired)
+
+    def invalidate_tag(self, tag: str) -> int:
+        return self._invalidate(lambda: self._index.tagged(tag))
+
+    def invalidate_prefix(self, path_prefix: str) -> int:
+        return self._invalidate(lambda: self._index.prefixed(path_prefix))
+
+    def warm(self, storage: ICacheStorage, limit: int = 0) -> int:
+        """
+        Copies stored items to another storage (e.g. a fresh in-memory one at startup), the most recently
+        updated ones first, at most `limit` of them when given. Returns number of copied items.
+        """
+        with self._locked():
+            item_ids = sorted(self._entries, key=lambda item_id: self._entries[item_id].updated, reverse=True)
+
+        if limit:
+            item_ids = item_ids[:limit]
+
+        copied = 0
+        for start in range(0, len(item_ids), _WARM_BATCH_SIZE):
+            # Items collected in the meantime are omitted.
+            items = self.get_many(item_ids[start : start + _WARM_BATCH_SIZE])
+            set_many(storage, items.values())
+            copied += len(items)
+
+        return copied
+
+    def compact(self) -> None:
+        """
+        Rewrites the file with live items only. Items are copied without holding the storage, only records
+        appended during the copy are moved while other threads wait.
+        """
+        with self._compaction_lock:
+            with self._locked():
+                snapshot = dict(self._entries)
+                snapshot_end = self._end
+                source = os.dup(self._fd)
+
+            deadline = time.time() - self.expiry_grace if self.expiry_grace is not None else None
+            temporary_path = self.path + ".compact"
+            try:
+                with open(temporary_path, "wb") as target:
+                    target.write(_FILE_HEADER.pack(_MAGIC, _VERSION))
+                    entries: Dict[str, _Entry] = {}
+                    for item_id, entry in sorted(snapshot.items(), key=lambda pair: pair[1].offset):
+                        if deadline is not None and entry.expires < deadline:
+                            continue
+                        entries[item_id] = entry.moved_by(target.tell() - entry.offset)
+                        self._copy(source, entry.offset, entry.size, target)
+
+                    with self._locked():
+                        self._copy_tail(source, snapshot_end, entries, target)
+                        target.flush()
+                        os.fsync(target.fileno())
+                        os.replace(temporary_path, self.path)
+                        self._reopen(entries)
+            finally:
+                os.close(source)
+                if os.path.exists(temporary_path):
+                    os.unlink(temporary_path)
+
+    def clear(self) -> None:
+        with self._compaction_lock, self._locked():
+            os.ftruncate(self._fd, 0)
+            os.pwrite(self._fd, _FILE_HEADER.pack(_MAGIC, _VERSION), 0)
+            self._entries.clear()
+            self._index = InvalidationIndex()
+            self._expiry_queue = ExpiryQueue()
+            self._end = _FILE_HEADER.size
+            self.dead_bytes = 0
+            self._unmap()
+
+    def close(self) -> None:
+        if self._compaction is not None:
+            self._compaction.join()
+        with self._lock:
+            self._unmap()
+            if self._fd >= 0:
+                os.close(self._fd)
+                self._fd = -1
+            if not self._lock_file.closed:
+                self._lock_file.close()
+
+    @property
+    def file_size(self) -> int:
+        return self._end
+
+    @property
+    def is_empty(self) -> bool:
+        return len(self) <= 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __enter__(self) -> "FileCacheStorage":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        with self._lock:
+            if self._fd < 0:
+                raise CacheError.for_invalid_storage_file(self.path, "storage is closed")
+            if os.getpid() != self._pid:
+                raise CacheError.for_invalid_storage_file(self.path, "storage cannot be shared with forked processes")
+            yield
+
+    def _load(self) -> None:
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = os.fstat(self._fd).st_size
+        if size < _FILE_HEADER.size:
+            os.ftruncate(self._fd, 0)
+            os.pwrite(self._fd, _FILE_HEADER.pack(_MAGIC, _VERSION), 0)
+            self._end = _FILE_HEADER.size
+            return
+
+        self._end = size
+        data = self._view(size)
+        magic, version = _FILE_HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise CacheError.for_invalid_storage_file(self.path, "it is not a cache storage file")
+        if version != _VERSION:
+            raise CacheError.for_invalid_storage_file(self.path, f"unsupported version `{version}`")
+
+        deadline = time.time() - self.expiry_grace if self.expiry_grace is not None else None
+        end = _FILE_HEADER.size
+        with memoryview(data) as view:
+            for item_id, entry, end in _parse_records(view, _FILE_HEADER.size, size):
+                if entry is not None and deadline is not None and entry.expires < deadline:
+                    entry = None
+                self._replace(item_id, entry)
+
+        # Everything after the last valid record has been torn by a crash.
+        if end < size:
+            self._unmap()
+            os.ftruncate(self._fd, end)
+        self._end = end
+        self.dead_bytes = end - _FILE_HEADER.size - sum(entry.size for entry in self._entries.values())
+
+    def _read_item(self, item_id: str, entry: _Entry) -> CacheItem:
+        start, end = entry.body_offset, entry.body_offset + entry.body_size
+        body = self._view(end)[start:end]
+
+        return CacheItem.restore(
+            item_id, body, entry.ttl, entry.created, entry.updated, entry.expires, entry.tags, entry.path
+        )
+
+    def _lookup(self, item_id: str) -> _Entry:
+        entry = self._entries.get(item_id)
+        if entry is None:
+            raise CacheError.for_not_found(item_id)
+
+        return entry
+
+    def _replace(self, item_id: str, entry: Optional[_Entry]) -> None:
+        previous = self._entries.pop(item_id, None)
+        if previous is not None:
+            self.dead_bytes += previous.size
+            self._index.discard(item_id)
+            self._expiry_queue.discard(item_id)
+        if entry is not None:
+            self._entries[item_id] = entry
+            self._index.add(item_id, entry.tags, entry.path)
+            if self.expiry_grace is not None:
+                self._expiry_queue.schedule(item_id, entry.expires)
+
+    def _append(self, kind: int, item: CacheItem, chunks: Iterable[Buffer], size: int) -> _Entry:
+        key = item.id.encode("utf8")
+        labels = "\x00".join((item.path, *item.tags)).encode("utf8")
+        offset = self._end
+        body_offset = offset + _RECORD.size + len(key) + len(labels)
+        record_end = body_offset + size
+        header = bytearray(
+            _RECORD.pack(
+                0,
+                kind,
+                len(key),
+                len(labels),
+                size,
+                item.ttl,
+                item.created_timestamp,
+                item.updated_timestamp,
+                item.expires_timestamp,
+            )
+        )
+
+        # Record's data is written first and its checksum last, so a torn record is never loaded.
+        crc = zlib.crc32(memoryview(header)[_CRC.size :])
+        position = self._write(offset + _RECORD.size, key + labels)
+        crc = zlib.crc32(key + labels, crc)
+        for chunk in chunks:
+            if position + len(chunk) > record_end:
+                break
+            position = self._write(position, chunk)
+            crc = zlib.crc32(chunk, crc)
+        if position != record_end:
+            os.ftruncate(self._fd, offset)
+            raise ValueError(f"Chunks of item `{item.id}` do not add up to {size} bytes.")
+
+        _CRC.pack_into(header, 0, crc)
+        self._write(offset, header)
+        self._end = record_end
+
+        return _Entry(
+            offset,
+            record_end - offset,
+            body_offset,
+            size,
+            item.ttl,
+            item.created_timestamp,
+            item.updated_timestamp,
+            item.expires_timestamp,
+            tuple(item.tags),
+            item.path,
+        )
+
+    def _write(self, offset: int, data: Buffer) -> int:
+        with memoryview(data) as view:
+            while view:
+                written = os.pwrite(self._fd, view, offset)
+                offset += written
+                view = view[written:]
+
+        return offset
+
+    def _view(self, end: int) -> mmap.mmap:
+        # File only grows between compactions, so it is mapped again when a record past the mapped part is read.
+        if self._mmap is None or len(self._mmap) < end:
+            self._unmap()
+            self._mmap = mmap.mmap(self._fd, self._end, access=mmap.ACCESS_READ)
+
+        return self._mmap
+
+    def _unmap(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _invalidate(self, find_items: Callable[[], Iterable[str]]) -> int:
+        with self._locked():
+            item_ids = [item_id for item_id in find_items() if item_id in self._entries]
+            self.collect_many(CacheItem(item_id, b"", 0) for item_id in item_ids)
+
+        return len(item_ids)
+
+    def _compact_if_needed(self) -> None:
+        if (
+            not self.background_compaction
+            or self._end < self.min_compaction_size
+            or self.dead_bytes <= self._end * self.compaction_threshold
+            or (self._compaction is not None and self._compaction.is_alive())
+        ):
+            return
+
+        self._compaction = threading.Thread(target=self.compact, name="chocs-cache-compaction", daemon=True)
+        self._compaction.start()
+
+    def _copy(self, source: int, offset: int, size: int, target: IO[bytes]) -> None:
+        while size > 0:
+            data = os.pread(source, min(size, _COPY_CHUNK_SIZE), offset)
+            if not data:
+                raise CacheError.for_invalid_storage_file(self.path, "file has been truncated during compaction")
+            target.write(data)
+            offset += len(data)
+            size -= len(data)
+
+    def _copy_tail(self, source: int, tail_start: int, entries: Dict[str, _Entry], target: IO[bytes]) -> None:
+        # Records appended while live items were copied are replayed on top of them, superseded ones are skipped.
+        with memoryview(self._view(self._end)) as view:
+            for item_id, entry, _ in _parse_records(view, tail_start, self._end):
+                entries.pop(item_id, None)
+                current = self._entries.get(item_id)
+                if entry is not None and current is not None and current.offset == entry.offset:
+                    entries[item_id] = entry.moved_by(target.tell() - entry.offset)
+                    self._copy(source, entry.offset, entry.size, target)
+
+        # Items reaped in the meantime are dropped.
+        for item_id in [item_id for item_id in entries if item_id not in self._entries]:
+            del entries[item_id]
+
+    def _reopen(self, entries: Dict[str, _Entry]) -> None:
+        self._unmap()
+        os.close(self._fd)
+        self._fd = os.open(self.path, os.O_RDWR)
+        self._end = os.fstat(self._fd).st_size
+        self._entries = entries
+        self._index = InvalidationIndex()
+        self._expiry_queue = ExpiryQueue()
+        for item_id, entry in entries.items():
+            self._index.add(item_id, entry.tags, entry.path)
+            if self.expiry_grace is not None:
+                self._expiry_queue.schedule(item_id, entry.expires)
+        self.dead_bytes = self._end - _FILE_HEADER.size - sum(entry.size for entry in entries.values())
@@ -1,9 +1,54 @@
+import hashlib
 import pickle
+import re
+import secrets
+import struct
+from copy import copy
 from datetime import datetime
+from io import BytesIO
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
-from chocs import HttpResponse
+from chocs import HttpHeaders, HttpResponse, HttpStatus
 
-__all__ = ["format_date_rfc_1123", "parse_etag_value", "dump_response", "load_response"]
+from chocs_middleware.cache.cache_storage import Buffer
+from chocs_middleware.cache.compression import CompressionPolicy, ICompressionCodec, get_codec, get_content_encodings
+from chocs_middleware.cache.error import CacheError
+
+__all__ = [
+    "format_date_rfc_1123",
+    "parse_etag_value",
+    "generate_etag",
+    "encode_etag",
+    "decode_etag_value",
+    "dump_response",
+    "dump_response_chunks",
+    "load_response",
+    "copy_response",
+    "encode_response",
+    "decode_response",
+    "iter_headers",
+    "group_headers",
+    "accepts_encoding",
+    "parse_range",
+    "read_response_record",
+    "ResponseRecord",
+    "ResponseRecordReader",
+    "ResponseTemplate",
+]
+
+# Wire format (network byte order):
+#   magic (3s) | version (B) | flags - id of the codec used to compress the body (B) | status (H) | headers count (H) | headers size (I) | body size (Q)
+#   headers: name size (H) | value size (I) | name | value   - repeated for every header value
+#   body: raw (or compressed) bytes
+WIRE_FORMAT_MAGIC = b"CHC"
+WIRE_FORMAT_VERSION = 1
+_PREAMBLE = struct.Struct("!3sBBHHIQ")
+_HEADER = struct.Struct("!HI")
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# Range headers asking for more ranges are ignored, so serving them cannot be used to multiply a response.
+MAX_RANGES = 32
+_BYTE_RANGE = re.compile(r"([0-9]*)\s*-\s*([0-9]*)")
 
 
 def format_date_rfc_1123(value: datetime) -> str:
@@ -25,14 +70,512 @@ def parse_etag_value(value: str) -> str:
     return value
 
 
-def dump_response(response: HttpResponse) -> bytes:
-    response.body.seek(0)
-    result = pickle.dumps((int(response.status_code), response.body.read(), dict(response.headers)))
-    response.body.seek(0)
+def generate_etag(body: Buffer, digest_size: int = 16) -> str:
+    """
+    Strong entity tag of the body, its blake2b hash.
+    """
+    return f'"{hashlib.blake2b(body, digest_size=digest_size).hexdigest()}"'
+
+
+def encode_etag(etag: str, content_encoding: str) -> str:
+    """
+    Entity tag of the response encoded with given content-coding, e.g. `"abc"` becomes `"abc-gzip"`,
+    so it is never taken for a validator of the response's identity bytes.
+    """
+    etag = etag.strip()
+    if etag[-1:] == '"':
+        return f'{etag[:-1]}-{content_encoding}"'
+
+    return f"{etag}-{content_encoding}"
+
+
+def decode_etag_value(value: str) -> str:
+    """
+    Reverses `encode_etag` for a value returned by `parse_etag_value`, other values are returned as they are.
+    """
+    etag, separator, content_encoding = value.rpartition("-")
+    if separator and etag and content_encoding in get_content_encodings():
+        return etag
+
+    return value
+
+
+class ResponseRecord(NamedTuple):
+    status: int
+    headers: List[Tuple[str, str]]
+    body: memoryview
+    codec: Optional[ICompressionCodec]
+
+
+def encode_response(
+    status: int, headers: Iterable[Tuple[str, str]], body: Buffer, codec: Optional[ICompressionCodec] = None
+) -> bytes:
+    body, flags = _compress(body, codec)
+
+    return b"".join((_encode_head(status, headers, flags, len(body)), body))
+
+
+def encode_response_chunks(
+    status: int,
+    headers: Iterable[Tuple[str, str]],
+    body: Buffer,
+    codec: Optional[ICompressionCodec] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> List[Buffer]:
+    """
+    Encodes response like `encode_response` without joining its parts, uncompressed body is returned
+    as slices of passed data (no copy is made).
+    """
+    body, flags = _compress(body, codec)
+    view = memoryview(body)
+    chunks: List[Buffer] = [_encode_head(status, headers, flags, len(view))]
+    chunks.extend(view[offset : offset + chunk_size] for offset in range(0, len(view), chunk_size))
+
+    return chunks
+
+
+def _compress(body: Buffer, codec: Optional[ICompressionCodec]) -> Tuple[Buffer, int]:
+    if codec is not None:
+        compressed = codec.compress(body)
+        # Incompressible bodies are kept as they are, so they don't have to be decompressed on every read.
+        if len(compressed) < len(body):
+            return compressed, codec.codec_id
+
+    return body, 0
+
+
+def _encode_head(status: int, headers: Iterable[Tuple[str, str]], flags: int, body_size: int) -> bytes:
+    parts: List[Buffer] = [b""]
+    headers_count = 0
+    headers_size = 0
+    for name, value in headers:
+        encoded_name = name.encode("utf8")
+        encoded_value = value.encode("utf8")
+        parts.append(_HEADER.pack(len(encoded_name), len(encoded_value)))
+        parts.append(encoded_name)
+        parts.append(encoded_value)
+        headers_count += 1
+        headers_size += _HEADER.size + len(encoded_name) + len(encoded_value)
+
+    parts[0] = _PREAMBLE.pack(
+        WIRE_FORMAT_MAGIC, WIRE_FORMAT_VERSION, flags, status, headers_count, headers_size, body_size
+    )
+
+    return b"".join(parts)
+
+
+def read_response_record(data: Buffer) -> ResponseRecord:
+    """
+    Reads data created by `encode_response`, returned body is a slice of passed data (no copy is made)
+    and it is still compressed with the returned codec (if any).
+    """
+    view = memoryview(data)
+    if len(view) < _PREAMBLE.size:
+        raise CacheError.for_invalid_payload()
+
+    flags, status, headers_count, headers_size, body_size = _read_preamble(view)
+    headers = _read_headers(view, _PREAMBLE.size, headers_count, headers_size)
+    offset = _PREAMBLE.size + headers_size
+    if len(view) != offset + body_size:
+        raise CacheError.for_invalid_payload()
+
+    return ResponseRecord(status, headers, view[offset:], get_codec(flags) if flags else None)
+
+
+def _read_preamble(view: memoryview) -> Tuple[int, int, int, int, int]:
+    magic, version, flags, status, headers_count, headers_size, body_size = _PREAMBLE.unpack_from(view)
+    if magic != WIRE_FORMAT_MAGIC:
+        raise CacheError.for_invalid_payload()
+    if version != WIRE_FORMAT_VERSION:
+        raise CacheError.for_unsupported_version(version)
+
+    return flags, status, headers_count, headers_size, body_size
+
+
+def _read_headers(view: memoryview, offset: int, headers_count: int, headers_size: int) -> List[Tuple[str, str]]:
+    headers = []
+    end = offset + headers_size
+    try:
+        for _ in range(headers_count):
+            name_size, value_size = _HEADER.unpack_from(view, offset)
+            offset += _HEADER.size
+            name = str(view[offset : offset + name_size], "utf8")
+            offset += name_size
+            value = str(view[offset : offset + value_size], "utf8")
+            offset += value_size
+            headers.append((name, value))
+    except (struct.error, UnicodeDecodeError):
+        raise CacheError.for_invalid_payload()
+
+    if offset != end:
+        raise CacheError.for_invalid_payload()
+
+    return headers
+
+
+class ResponseRecordReader:
+    """
+    Reads data created by `encode_response` passed in chunks (e.g. by `IStreamingCacheStorage.get_stream`).
+    Chunks of the body are written to a single buffer, which is then shared with responses created
+    by `create_template`, so the body is copied only once.
+    """
+
+    __slots__ = ("_head", "_head_size", "_body", "_preamble", "_malformed")
+
+    def __init__(self) -> None:
+        self._head = bytearray()
+        self._head_size = _PREAMBLE.size
+        self._body = BytesIO()
+        self._preamble: Optional[Tuple[int, int, int, int, int]] = None
+        self._malformed = False
+
+    def write(self, chunk: Buffer) -> None:
+        view = memoryview(chunk)
+        while view and len(self._head) < self._head_size:
+            missing = self._head_size - len(self._head)
+            self._head += view[:missing]
+            view = view[missing:]
+            if self._preamble is None and not self._malformed and len(self._head) == _PREAMBLE.size:
+                try:
+                    self._preamble = _read_preamble(memoryview(self._head))
+                except CacheError:
+                    self._malformed = True  # reported by `create_template`, the rest is kept as it is
+                    break
+                self._head_size += self._preamble[3]
+
+        if view:
+            self._body.write(view)
+
+    def create_template(self, last_modified: datetime, vary: Optional[str] = None) -> "ResponseTemplate":
+        if self._preamble is None or len(self._head) != self._head_size:
+            raise CacheError.for_invalid_payload()
+
+        flags, status, headers_count, headers_size, body_size = self._preamble
+        if self._body.tell() != body_size:
+            raise CacheError.for_invalid_payload()
+
+        with memoryview(self._head) as head:
+            headers = _read_headers(head, _PREAMBLE.size, headers_count, headers_size)
+
+        return ResponseTemplate.from_record(
+            status, headers, self._body.getvalue(), get_codec(flags) if flags else None, last_modified, vary
+        )
+
+    def getvalue(self) -> bytes:
+        """
+        Returns all data written so far, e.g. to report a payload `create_template` failed to decode.
+        """
+        return bytes(self._head) + self._body.getvalue()
+
+
+def decode_response(data: Buffer) -> Tuple[int, List[Tuple[str, str]], memoryview]:
+    """
+    Decodes data created by `encode_response`, uncompressed body is returned as a slice of passed data.
+    """
+    status, headers, body, codec = read_response_record(data)
+    if codec is not None:
+        body = memoryview(codec.decompress(body))
+
+    return status, headers, body
+
+
+def iter_headers(headers: HttpHeaders) -> Iterator[Tuple[str, str]]:
+    # Values assigned through `headers[name] = "value"` are kept as plain strings by chocs,
+    # so `HttpHeaders.items` cannot be used here as it would iterate over their characters.
+    for name in headers.keys():
+        value = headers[name]
+        if isinstance(value, str):
+            yield name, value
+            continue
+        for item in value:
+            yield name, item
+
+
+def group_headers(headers: Iterable[Tuple[str, str]]) -> Dict[str, List[str]]:
+    grouped: Dict[str, List[str]] = {}
+    for name, value in headers:
+        grouped.setdefault(name, []).append(value)
+
+    return grouped
+
+
+def accepts_encoding(accept_encoding: str, content_encoding: str) -> bool:
+    accepts_any = False
+    for item in accept_encoding.lower().split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip()
+        if coding == content_encoding:
+            return _parse_quality(params) > 0
+        if coding == "*":
+            accepts_any = _parse_quality(params) > 0
+
+    return accepts_any
+
+
+def parse_range(value: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parses `range` header into a list of first and last byte positions within the body of `size` bytes.
+    Returns None when the header should be ignored (malformed, other unit than bytes or too many ranges)
+    and an empty list when none of the ranges can be satisfied.
+    """
+    unit, _, ranges_set = value.partition("=")
+    specs = [spec.strip() for spec in ranges_set.split(",") if spec.strip()]
+    if unit.strip().lower() != "bytes" or not specs or len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        match = _BYTE_RANGE.fullmatch(spec)
+        if match is None or not any(match.groups()):
+            return None
+        first, last = match.groups()
+        if not first:
+            # Suffix range, e.g. `-500` stands for the last 500 bytes.
+            if int(last) > 0 and size > 0:
+                ranges.append((max(0, size - int(last)), size - 1))
+            continue
+        if last and int(last) < int(first):
+            return None
+        if int(first) < size:
+            ranges.append((int(first), min(int(last), size - 1) if last else size - 1))
+
+    return ranges
+
+
+def _parse_quality(params: str) -> float:
+    for param in params.split(";"):
+        name, _, value = param.strip().partition("=")
+        if name == "q":
+            try:
+                return float(value)
+            except ValueError:
+                return 0.0
+
+    return 1.0
+
+
+def dump_response(response: HttpResponse, compression: Optional[CompressionPolicy] = None) -> bytes:
+    with response.body.getbuffer() as body:
+        codec = compression.select_codec(response, len(body)) if compression is not None else None
+        return encode_response(int(response.status_code), iter_headers(response.headers), body, codec)
+
+
+def dump_response_chunks(
+    response: HttpResponse, compression: Optional[CompressionPolicy] = None, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> List[Buffer]:
+    """
+    Streaming counterpart of `dump_response`, the body is passed as slices of the response's buffer.
+    """
+    body = response.body.getvalue()  # shares the buffer as long as the response is not written to
+    codec = compression.select_codec(response, len(body)) if compression is not None else None
+
+    return encode_response_chunks(int(response.status_code), iter_headers(response.headers), body, codec, chunk_size)
+
+
+def copy_response(response: HttpResponse) -> HttpResponse:
+    copied = HttpResponse(status=response.status_code, headers=copy(response.headers))
+    copied.body = BytesIO(response.body.getvalue())  # type: ignore
+
+    return copied
+
+
+def load_response(data: Buffer, allow_pickle: bool = False) -> HttpResponse:
+    """
+    Loads response stored with `dump_response`. Pickled responses stored by former versions are only loaded
+    when `allow_pickle` is set, unpickling data from a storage shared with others can execute arbitrary code.
+    """
+    if bytes(data[0:3]) != WIRE_FORMAT_MAGIC:
+        if not allow_pickle:
+            raise CacheError.for_invalid_payload()
+        # Legacy format used by former versions, kept so already stored items can still be read.
+        response_data = pickle.loads(data)
+        return HttpResponse(status=response_data[0], body=response_data[1], headers=response_data[2])
+
+    status, headers, body = decode_response(data)
+
+    return HttpResponse(status=status, body=body, headers=group_headers(headers))
+
+
+class ResponseTemplate:
+    """
+    Decoded, read-only copy of a cached response. Responses created from the template share its body buffer
+    until they are written to, so serving a cache hit does not require decoding the stored payload again.
+
+    Compressed bodies are decompressed on the first use, bodies compressed with a http content-coding
+    can be served as they are stored, when client accepts their encoding.
+    """
+
+    __slots__ = ("status_code", "headers", "_body", "vary", "encoded_headers", "encoded_body", "codec")
+
+    def __init__(
+        self,
+        status_code: HttpStatus,
+        headers: HttpHeaders,
+        body: Optional[bytes],
+        vary: Optional[str] = None,
+        encoded_headers: Optional[HttpHeaders] = None,
+        encoded_body: Optional[bytes] = None,
+        codec: Optional[ICompressionCodec] = None,
+    ):
+        self.status_code = status_code
+        self.headers = headers
+        self._body = body
+        self.vary = vary
+        self.encoded_headers = encoded_headers
+        self.encoded_body = encoded_body
+        self.codec = codec
+
+    @property
+    def body(self) -> bytes:
+        if self._body is None:
+            assert self.codec is not None and self.encoded_body is not None
+            self._body = self.codec.decompress(self.encoded_body)
+
+        return self._body
+
+    @property
+    def content_encoding(self) -> Optional[str]:
+        return self.codec.content_encoding if self.codec is not None else None
+
+    @classmethod
+    def from_payload(
+        cls, data: Buffer, last_modified: datetime, vary: Optional[str] = None, allow_pickle: bool = False
+    ) -> "ResponseTemplate":
+        if bytes(data[0:3]) != WIRE_FORMAT_MAGIC:
+            response = load_response(data, allow_pickle)
+            return cls.from_record(
+                int(response.status_code),
+                list(iter_headers(response.headers)),
+                response.body.getvalue(),
+                None,
+                last_modified,
+                vary,
+            )
+
+        status, headers, stored_body, codec = read_response_record(data)
+
+        return cls.from_record(status, headers, bytes(stored_body), codec, last_modified, vary)
+
+    @classmethod
+    def from_record(
+        cls,
+        status: int,
+        headers: List[Tuple[str, str]],
+        stored_body: bytes,
+        codec: Optional[ICompressionCodec],
+        last_modified: datetime,
+        vary: Optional[str] = None,
+    ) -> "ResponseTemplate":
+        body: Optional[bytes] = stored_body
+        encoded_body: Optional[bytes] = None
+        if codec is not None:
+            body, encoded_body = None, stored_body
+
+        static_headers = {"last-modified": [format_date_rfc_1123(last_modified)]}
+        if vary is not None:
+            static_headers["vary"] = [vary if not codec or not codec.content_encoding else f"{vary},accept-encoding"]
+
+        response_headers = group_headers(headers)
+        response_headers.update(static_headers)
+
+        encoded_headers = None
+        if codec is not None and codec.content_encoding:
+            encoded_headers = HttpHeaders(
+                {name: value for name, value in response_headers.items() if name != "content-length"}
+            )
+            encoded_headers.override("content-encoding", codec.content_encoding)
+            if "etag" in response_headers:
+                encoded_headers.override("etag", encode_etag(response_headers["etag"][0], codec.content_encoding))
+
+        return cls(
+            HttpStatus.from_int(status),
+            HttpHeaders(response_headers),
+            body,
+            vary,
+            encoded_headers,
+            encoded_body,
+            codec,
+        )
+
+    def accepts(self, accept_encoding: Optional[str]) -> bool:
+        """
+        Tells whether the encoded response (see `create_response`) can be served for given `accept-encoding`.
+        """
+        return (
+            self.encoded_headers is not None
+            and accept_encoding is not None
+            and accepts_encoding(accept_encoding, self.content_encoding)  # type: ignore
+        )
+
+    def matches_if_range(self, if_range: str, encoded: bool = False) -> bool:
+        """
+        Checks `if-range` header, which holds either a strong entity tag or a date of the last modification.
+        Entity tag is compared with the one of the encoded response, when it is the one to be served.
+        """
+        if_range = if_range.strip()
+        if if_range.startswith('"'):
+            headers = self.encoded_headers if encoded and self.encoded_headers is not None else self.headers
+            etag = headers.get("etag")
+            return isinstance(etag, str) and not etag.startswith("W/") and etag.strip() == if_range
+
+        return if_range == self.headers.get("last-modified")
+
+    def create_partial_response(self, ranges: List[Tuple[int, int]], encoded: bool = False) -> HttpResponse:
+        """
+        Creates `206 Partial Content` response holding given byte ranges of the body (see `parse_range`),
+        or `416 Range Not Satisfiable` response when there are none. Only requested slices of the body are copied.
+        Ranges of the encoded body are served when `encoded` is set.
+        """
+        if encoded and self.encoded_headers is not None:
+            body = memoryview(self.encoded_body)  # type: ignore
+            headers = copy(self.encoded_headers)
+        else:
+            body = memoryview(self.body)
+            headers = copy(self.headers)
+        size = len(body)
+        if not ranges:
+            return HttpResponse(
+                status=HttpStatus.REQUESTED_RANGE_NOT_SATISFIABLE, headers={"content-range": f"bytes */{size}"}
+            )
+
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            headers.override("content-range", f"bytes {first}-{last}/{size}")
+            partial_body = BytesIO(body[first : last + 1])
+        else:
+            content_type = self.headers.get("content-type")
+            if not isinstance(content_type, str):
+                content_type = content_type[0]
+            boundary = secrets.token_hex(16)
+            parts: List[Buffer] = []
+            for first, last in ranges:
+                delimiter = f"\r\n--{boundary}" if parts else f"--{boundary}"
+                parts.append(
+                    f"{delimiter}\r\ncontent-type: {content_type}\r\n"
+                    f"content-range: bytes {first}-{last}/{size}\r\n\r\n".encode("utf8")
+                )
+                parts.append(body[first : last + 1])
+            parts.append(f"\r\n--{boundary}--\r\n".encode("utf8"))
+            headers.override("content-type", f"multipart/byteranges; boundary={boundary}")
+            partial_body = BytesIO(b"".join(parts))
+
+        if "content-length" in headers:
+            headers.override("content-length", str(partial_body.getbuffer().nbytes))
+
+        response = HttpResponse(status=HttpStatus.PARTIAL_CONTENT, headers=headers)
+        response.body = partial_body
+
+        return response
 
-    return result
+    def create_response(self, with_body: bool = True, encoded: bool = False) -> HttpResponse:
+        if encoded and self.encoded_headers is not None:
+            response = HttpResponse(status=self.status_code, headers=copy(self.encoded_headers))
+            if with_body:
+                response.body = BytesIO(self.encoded_body)  # type: ignore
+            return response
 
+        response = HttpResponse(status=self.status_code, headers=copy(self.headers))
+        if with_body:
+            response.body = BytesIO(self.body)
 
-def load_response(data: bytes) -> HttpResponse:
-    response_data = pickle.loads(data)
-    return HttpResponse(status=response_data[0], body=response_data[1], headers=response_data[2])
+        return response
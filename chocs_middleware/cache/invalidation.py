@@ -0,0 +1,121 @@
+from abc import abstractmethod
+from typing import Dict, Iterable, List, Protocol, Set, Tuple, runtime_checkable
+
+__all__ = ["IInvalidatableCacheStorage", "InvalidationIndex", "path_prefixes"]
+
+
+@runtime_checkable
+class IInvalidatableCacheStorage(Protocol):
+    @abstractmethod
+    def invalidate_tag(self, tag: str) -> int:
+        """
+        Removes all items stored with the given tag, returns number of removed items.
+        """
+        ...
+
+    @abstractmethod
+    def invalidate_prefix(self, path_prefix: str) -> int:
+        """
+        Removes all items stored for the given path or any path below it (`/users/42` matches `/users/42`
+        and `/users/42/orders`, but not `/users/420`), returns number of removed items.
+        """
+        ...
+
+
+def path_prefixes(path: str) -> List[str]:
+    """
+    Returns the path and all its parents, e.g. `/`, `/users`, `/users/42` for `/users/42`.
+    """
+    segments = [segment for segment in path.split("/") if segment]
+    return ["/"] + ["/" + "/".join(segments[: index + 1]) for index in range(len(segments))]
+
+
+class _PathNode:
+    __slots__ = ("children", "item_ids")
+
+    def __init__(self):
+        self.children: Dict[str, _PathNode] = {}
+        self.item_ids: Set[str] = set()
+
+
+class InvalidationIndex:
+    """
+    Reverse index of item ids by their tags and by segments of their paths (kept in a trie), so items can be
+    found in time proportional to the number of matches.
+    """
+
+    def __init__(self):
+        self._tags: Dict[str, Set[str]] = {}
+        self._paths = _PathNode()
+        self._indexed: Dict[str, Tuple[Tuple[str, ...], str]] = {}
+
+    def add(self, item_id: str, tags: Iterable[str], path: str) -> None:
+        entry = (tuple(tags), path)
+        if self._indexed.get(item_id) == entry:
+            return
+
+        self.discard(item_id)
+        if not entry[0] and not path:
+            return
+
+        self._indexed[item_id] = entry
+        for tag in entry[0]:
+            self._tags.setdefault(tag, set()).add(item_id)
+        if path:
+            node = self._paths
+            for segment in self._segments(path):
+                node = node.children.setdefault(segment, _PathNode())
+            node.item_ids.add(item_id)
+
+    def discard(self, item_id: str) -> None:
+        entry = self._indexed.pop(item_id, None)
+        if entry is None:
+            return
+
+        tags, path = entry
+        for tag in tags:
+            tagged = self._tags[tag]
+            tagged.discard(item_id)
+            if not tagged:
+                del self._tags[tag]
+
+        if path:
+            nodes = [self._paths]
+            for segment in self._segments(path):
+                nodes.append(nodes[-1].children[segment])
+            nodes[-1].item_ids.discard(item_id)
+
+            # Prune branches left empty.
+            segments = self._segments(path)
+            for index in range(len(segments) - 1, -1, -1):
+                node = nodes[index + 1]
+                if node.item_ids or node.children:
+                    break
+                del nodes[index].children[segments[index]]
+
+    def tagged(self, tag: str) -> List[str]:
+        return list(self._tags.get(tag, ()))
+
+    def prefixed(self, path_prefix: str) -> List[str]:
+        node = self._paths
+        for segment in self._segments(path_prefix):
+            child = node.children.get(segment)
+            if child is None:
+                return []
+            node = child
+
+        item_ids: List[str] = []
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            item_ids.extend(node.item_ids)
+            nodes.extend(node.children.values())
+
+        return item_ids
+
+    def __len__(self) -> int:
+        return len(self._indexed)
+
+    @staticmethod
+    def _segments(path: str) -> List[str]:
+        return [segment for segment in path.split("/") if segment]
@@ -0,0 +1,130 @@
+import threading
+from abc import abstractmethod
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional, Protocol, Tuple, runtime_checkable
+
+__all__ = ["ICacheMetrics", "InMemoryCacheMetrics", "Histogram", "DEFAULT_BUCKETS"]
+
+# Upper bounds (in seconds) of latency buckets.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+@runtime_checkable
+class ICacheMetrics(Protocol):
+    """
+    Receives events counted by `CacheMiddleware` (e.g. `hit`, `miss`, `stale`, `storage_error`) and durations
+    of operations (e.g. `storage_get`, `handler`, `serialize`), both labelled with the route's pattern.
+    Methods are called on the request path, so implementations should not block.
+    """
+
+    @abstractmethod
+    def increment(self, event: str, route: str, value: int = 1) -> None:
+        ...
+
+    @abstractmethod
+    def observe(self, operation: str, route: str, seconds: float) -> None:
+        ...
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> List[int]:
+        counts = []
+        total = 0
+        for count in self.counts:
+            total += count
+            counts.append(total)
+
+        return counts
+
+
+class InMemoryCacheMetrics(ICacheMetrics):
+    """
+    Keeps counters and latency histograms per route in process memory. `snapshot` returns their copy,
+    `render_prometheus` formats them in Prometheus text exposition format.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, namespace: str = "chocs_cache"):
+        self.buckets = buckets
+        self.namespace = namespace
+        self._counters: Dict[Tuple[str, str], int] = {}
+        self._histograms: Dict[Tuple[str, str], Histogram] = {}
+        self._lock = threading.Lock()
+
+    def increment(self, event: str, route: str, value: int = 1) -> None:
+        key = (event, route)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, operation: str, route: str, seconds: float) -> None:
+        key = (operation, route)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def count(self, event: str, route: Optional[str] = None) -> int:
+        with self._lock:
+            return sum(
+                value for (name, label), value in self._counters.items() if name == event and route in (None, label)
+            )
+
+    def histogram(self, operation: str, route: str) -> Optional[Histogram]:
+        return self._histograms.get((operation, route))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "histograms": {
+                    key: {
+                        "buckets": histogram.buckets,
+                        "counts": list(histogram.counts),
+                        "sum": histogram.sum,
+                        "count": histogram.count,
+                    }
+                    for key, histogram in self._histograms.items()
+                },
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render_prometheus(self) -> str:
+        events = f"{self.namespace}_events_total"
+        durations = f"{self.namespace}_operation_duration_seconds"
+        lines = [f"# TYPE {events} counter"]
+
+        with self._lock:
+            for (event, route), value in sorted(self._counters.items()):
+                lines.append(f'{events}{{event="{event}",route="{_escape(route)}"}} {value}')
+
+            lines.append(f"# TYPE {durations} histogram")
+            for (operation, route), histogram in sorted(self._histograms.items()):
+                labels = f'operation="{operation}",route="{_escape(route)}"'
+                bounds = [repr(bound) for bound in histogram.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, histogram.cumulative_counts()):
+                    lines.append(f'{durations}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f"{durations}_sum{{{labels}}} {histogram.sum!r}")
+                lines.append(f"{durations}_count{{{labels}}} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
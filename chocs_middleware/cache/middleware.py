@@ -1,167 +1,822 @@
-from copy import copy
-from datetime import datetime
-from typing import Tuple
+import asyncio
+import inspect
+import math
+import random
+import threading
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Generator, Hashable, List, Optional, Set, Tuple, Union
 
 from chocs import HttpMethod, HttpRequest, HttpResponse, HttpStatus
 from chocs.middleware import Middleware, MiddlewareHandler
 
-from .cache_storage import CacheItem, ICacheStorage, ICollectableCacheStorage, generate_cache_id
-from .http_support import load_response, dump_response, format_date_rfc_1123, parse_etag_value
+from .async_storage import IAsyncCacheStorage, IAsyncTouchableCacheStorage
+from .cache_storage import (
+    CacheItem,
+    ICacheStorage,
+    ICollectableCacheStorage,
+    IStreamingCacheStorage,
+    ITouchableCacheStorage,
+    collect_many,
+    generate_cache_id,
+    get_many,
+    set_many,
+)
+from .compression import CompressionPolicy
+from .error import CacheError
+from .etag_index import create_etag_index_item, etag_index_id, etag_index_ids, matches_etags, parse_etags
+from .http_support import (
+    DEFAULT_CHUNK_SIZE,
+    Buffer,
+    ResponseRecordReader,
+    ResponseTemplate,
+    copy_response,
+    dump_response,
+    dump_response_chunks,
+    generate_etag,
+    load_response,
+    parse_etag_value,
+    parse_range,
+)
+from .metrics import ICacheMetrics
+from .single_flight import AsyncSingleFlight, SingleFlight
 
-__all__ = ["CacheMiddleware"]
+__all__ = ["CacheMiddleware", "AsyncMiddlewareHandler"]
+
+AsyncMiddlewareHandler = Callable[[HttpRequest], Awaitable[HttpResponse]]
+_Routine = Generator[Any, Any, Any]
+
+
+# Request processing is written once as a generator yielding the operations below. The operations are executed
+# by `CacheMiddleware._run` (sync storage and handlers) or `CacheMiddleware._run_async` (asyncio).
+class _Get:
+    __slots__ = ("item_id",)
+    metric = "storage_get"
+
+    def __init__(self, item_id: str):
+        self.item_id = item_id
+
+
+class _GetMany:
+    __slots__ = ("item_ids",)
+    metric = "storage_get"
+
+    def __init__(self, item_ids: List[str]):
+        self.item_ids = item_ids
+
+
+class _GetStream:
+    __slots__ = ("item_id", "vary")
+    metric = "storage_get"
+
+    def __init__(self, item_id: str, vary: str):
+        self.item_id = item_id
+        self.vary = vary
+
+
+class _Set:
+    __slots__ = ("item",)
+    metric = "storage_set"
+
+    def __init__(self, item: CacheItem):
+        self.item = item
+
+
+class _SetStream:
+    __slots__ = ("item", "chunks")
+    metric = "storage_set"
+
+    def __init__(self, item: CacheItem, chunks: List[Buffer]):
+        self.item = item
+        self.chunks = chunks
+
+
+class _SetMany:
+    __slots__ = ("items",)
+    metric = "storage_set"
+
+    def __init__(self, items: List[CacheItem]):
+        self.items = items
+
+
+class _Collect:
+    __slots__ = ("item",)
+    metric = "storage_collect"
+
+    def __init__(self, item: CacheItem):
+        self.item = item
+
+
+class _CollectMany:
+    __slots__ = ("items",)
+    metric = "storage_collect"
+
+    def __init__(self, items: List[CacheItem]):
+        self.items = items
+
+
+class _Touch:
+    __slots__ = ("items",)
+    metric = "storage_touch"
+
+    def __init__(self, items: List[CacheItem]):
+        self.items = items
+
+
+class _CallNext:
+    __slots__ = ("request",)
+    metric = "handler"
+
+    def __init__(self, request: HttpRequest):
+        self.request = request
+
+
+class _Coalesce:
+    __slots__ = ("key", "routine")
+    metric = ""
+
+    def __init__(self, key: Hashable, routine: Callable[[], _Routine]):
+        self.key = key
+        self.routine = routine
+
+
+class _RunInBackground:
+    __slots__ = ("routine",)
+    metric = ""
+
+    def __init__(self, routine: _Routine):
+        self.routine = routine
 
 
 class CacheMiddleware(Middleware):
     def __init__(
         self,
-        cache_storage: ICacheStorage,
+        cache_storage: Union[ICacheStorage, IAsyncCacheStorage],
         cache_vary: Tuple[str, ...] = ("accept", "accept-language"),
         safe_methods: Tuple[HttpMethod, ...] = (HttpMethod.GET, HttpMethod.HEAD),
         successful_responses: Tuple[HttpStatus, ...] = (HttpStatus.OK, HttpStatus.CREATED),
+        compression: Optional[CompressionPolicy] = None,
+        coalesce_timeout: Optional[float] = None,
+        revalidation_executor: Optional[Executor] = None,
+        key_generator: Callable[[HttpRequest, Tuple[str, ...]], str] = generate_cache_id,
+        metrics: Optional[ICacheMetrics] = None,
+        cache_max_size: int = 0,
+        cache_etag: bool = False,
+        cache_ttl_jitter: float = 0.0,
+        cache_early_refresh: float = 0.0,
+        allow_pickle: bool = False,
     ):
-        self._cache_vary = cache_vary
+        self._cache_vary = tuple(cache_vary)
+        self._key_generator = key_generator
+        self._metrics = metrics
+        self._cache_max_size = cache_max_size
+        self._cache_etag = cache_etag
+        self._cache_ttl_jitter = cache_ttl_jitter
+        self._cache_early_refresh = cache_early_refresh
+        # Legacy pickled payloads are only read when explicitly allowed, see `load_response`.
+        self._allow_pickle = allow_pickle
+        # Duration of the last handler call storing a response per route, weighing early refreshes of its items.
+        self._recompute_times: Dict[str, float] = {}
         self._cache_storage = cache_storage
         self._safe_methods = safe_methods
         self._successful_responses = successful_responses
+        self._compression = compression
+        self._coalesce_timeout = coalesce_timeout
+        self._single_flight: SingleFlight[Tuple[HttpResponse, Optional[bytes]]] = SingleFlight(coalesce_timeout)
+        self._async_single_flight: AsyncSingleFlight[Tuple[HttpResponse, Optional[bytes]]] = AsyncSingleFlight(
+            coalesce_timeout
+        )
+        self._revalidation_executor = revalidation_executor
+        self._revalidation_lock = threading.Lock()
+        self._revalidating: Set[str] = set()
+        self._background_tasks: Set["asyncio.Future[Any]"] = set()
+        self._is_async_storage = inspect.iscoroutinefunction(getattr(cache_storage, "get", None))
+        self._is_collectable_storage = isinstance(cache_storage, ICollectableCacheStorage)
+        self._is_streaming_storage = not self._is_async_storage and isinstance(cache_storage, IStreamingCacheStorage)
+        self._is_touchable_storage = isinstance(
+            cache_storage, IAsyncTouchableCacheStorage if self._is_async_storage else ITouchableCacheStorage
+        )
 
     def handle(self, request: HttpRequest, next: MiddlewareHandler) -> HttpResponse:
+        if self._is_async_storage:
+            raise CacheError.for_async_storage()
+
+        return self._run(self._process(request), next, request.route.route)
+
+    async def handle_async(self, request: HttpRequest, next: AsyncMiddlewareHandler) -> HttpResponse:
+        """
+        Asyncio counterpart of `handle`, works with both `IAsyncCacheStorage` and (non-blocking) `ICacheStorage`.
+        """
+        return await self._run_async(self._process(request), next, request.route.route)
+
+    def _run(self, routine: _Routine, next: MiddlewareHandler, route: str) -> Any:
+        metrics = self._metrics
+        value: Any = None
+        error: Optional[BaseException] = None
+        while True:
+            try:
+                operation = routine.send(value) if error is None else routine.throw(error)
+            except StopIteration as result:
+                return result.value
+
+            value, error = None, None
+            started = time.perf_counter() if metrics is not None else 0.0
+            try:
+                if isinstance(operation, _Get):
+                    value = self._cache_storage.get(operation.item_id)
+                elif isinstance(operation, _GetMany):
+                    value = get_many(self._cache_storage, operation.item_ids)  # type: ignore
+                elif isinstance(operation, _GetStream):
+                    value = self._get_stream(operation)
+                elif isinstance(operation, _CallNext):
+                    value = next(operation.request)
+                elif isinstance(operation, _Set):
+                    self._cache_storage.set(operation.item)
+                elif isinstance(operation, _SetStream):
+                    self._set_stream(operation)
+                elif isinstance(operation, _SetMany):
+                    set_many(self._cache_storage, operation.items)  # type: ignore
+                elif isinstance(operation, _Collect):
+                    self._cache_storage.collect(operation.item)  # type: ignore
+                elif isinstance(operation, _CollectMany):
+                    collect_many(self._cache_storage, operation.items)  # type: ignore
+                elif isinstance(operation, _Touch):
+                    value = self._cache_storage.touch(operation.items)  # type: ignore
+                elif isinstance(operation, _Coalesce):
+                    value = self._single_flight.do(operation.key, lambda: self._run(operation.routine(), next, route))
+                elif isinstance(operation, _RunInBackground):
+                    self._get_revalidation_executor().submit(self._run, operation.routine, next, route)
+            except Exception as exception:
+                error = exception
+
+            if metrics is not None and operation.metric:
+                metrics.observe(operation.metric, route, time.perf_counter() - started)
+
+    async def _run_async(self, routine: _Routine, next: AsyncMiddlewareHandler, route: str) -> Any:
+        metrics = self._metrics
+        storage: Any = self._cache_storage
+        value: Any = None
+        error: Optional[BaseException] = None
+        while True:
+            try:
+                operation = routine.send(value) if error is None else routine.throw(error)
+            except StopIteration as result:
+                return result.value
+
+            value, error = None, None
+            started = time.perf_counter() if metrics is not None else 0.0
+            try:
+                if isinstance(operation, _Get):
+                    value = storage.get(operation.item_id)
+                    if self._is_async_storage:
+                        value = await value
+                elif isinstance(operation, _GetMany):
+                    if self._is_async_storage:
+                        value = await storage.get_many(operation.item_ids)
+                    else:
+                        value = get_many(storage, operation.item_ids)
+                elif isinstance(operation, _GetStream):
+                    value = self._get_stream(operation)
+                elif isinstance(operation, _CallNext):
+                    value = await next(operation.request)
+                elif isinstance(operation, _Set):
+                    if self._is_async_storage:
+                        await storage.set(operation.item)
+                    else:
+                        storage.set(operation.item)
+                elif isinstance(operation, _SetStream):
+                    self._set_stream(operation)
+                elif isinstance(operation, _SetMany):
+                    if self._is_async_storage:
+                        await storage.set_many(operation.items)
+                    else:
+                        set_many(storage, operation.items)
+                elif isinstance(operation, _Collect):
+                    if self._is_async_storage:
+                        await storage.collect(operation.item)
+                    else:
+                        storage.collect(operation.item)
+                elif isinstance(operation, _CollectMany):
+                    if self._is_async_storage:
+                        await storage.collect_many(operation.items)
+                    else:
+                        collect_many(storage, operation.items)
+                elif isinstance(operation, _Touch):
+                    value = storage.touch(operation.items)
+                    if self._is_async_storage:
+                        value = await value
+                elif isinstance(operation, _Coalesce):
+                    routine_factory = operation.routine
+                    value = await self._async_single_flight.do(
+                        operation.key, lambda: self._run_async(routine_factory(), next, route)
+                    )
+                elif isinstance(operation, _RunInBackground):
+                    task = asyncio.ensure_future(self._run_async(operation.routine, next, route))
+                    self._background_tasks.add(task)
+                    task.add_done_callback(self._background_tasks.discard)
+            except Exception as exception:
+                error = exception
+
+            if metrics is not None and operation.metric:
+                metrics.observe(operation.metric, route, time.perf_counter() - started)
+
+    def _get_stream(self, operation: _GetStream) -> CacheItem:
+        reader = ResponseRecordReader()
+        storage: IStreamingCacheStorage = self._cache_storage  # type: ignore
+        cache_item = storage.get_stream(operation.item_id, reader.write, DEFAULT_CHUNK_SIZE)
+        try:
+            cache_item.decoded = reader.create_template(cache_item.updated_at, operation.vary)
+        except CacheError:
+            # Payload is passed on as it is, so it is reported and dropped as one retrieved with `get`.
+            return CacheItem.restore(
+                cache_item.id,
+                reader.getvalue(),
+                cache_item.ttl,
+                cache_item.created_timestamp,
+                cache_item.updated_timestamp,
+                cache_item.expires_timestamp,
+            )
+
+        return cache_item
+
+    def _set_stream(self, operation: _SetStream) -> None:
+        storage: IStreamingCacheStorage = self._cache_storage  # type: ignore
+        storage.set_stream(operation.item, operation.chunks, sum(len(chunk) for chunk in operation.chunks))
+
+    def _process(self, request: HttpRequest) -> _Routine:
         cache_expiry = request.route.attributes.get("cache_expiry", 0)
         cache_control = request.route.attributes.get("cache_control", "")
-        cache_vary = request.route.attributes.get("cache_vary", tuple(self._cache_vary))
+        cache_vary = request.route.attributes.get("cache_vary", self._cache_vary)
+        stale_while_revalidate = request.route.attributes.get("cache_stale_while_revalidate", 0)
+        stale_if_error = request.route.attributes.get("cache_stale_if_error", 0)
         use_cache = cache_expiry > 0 or request.route.attributes.get("cache", False)
 
         assert isinstance(cache_vary, tuple)
 
         if not use_cache:
-            return next(request)
+            return (yield _CallNext(request))
 
-        # Generate cache_id
-        if "etag" in request.headers:
-            cache_id = parse_etag_value(request.headers["etag"])
-        else:
-            cache_id = generate_cache_id(request, cache_vary)
+        vary_header = ",".join(cache_vary)
+        cache_control = f"{cache_control}, max-age={cache_expiry}" if cache_control else f"max-age={cache_expiry}"
+        if stale_while_revalidate:
+            cache_control += f", stale-while-revalidate={stale_while_revalidate}"
+        if stale_if_error:
+            cache_control += f", stale-if-error={stale_if_error}"
 
+        cache_id = self._key_generator(request, cache_vary)
         cache_item = CacheItem.empty(cache_id)
 
+        # Entity tags sent in `etag` header are treated as `if-none-match` values of GET and HEAD requests.
+        if_none_match: List[str] = []
+        if "if-none-match" in request.headers:
+            if_none_match = parse_etags(self._get_header(request, "if-none-match"))
+        elif "etag" in request.headers and request.method in (HttpMethod.GET, HttpMethod.HEAD):
+            if_none_match = parse_etags(self._get_header(request, "etag"))
+        if_match = parse_etags(self._get_header(request, "if-match")) if "if-match" in request.headers else []
+        found_items: Dict[str, CacheItem] = {}
+        resource_id = self._get_resource_id(request) if if_none_match or if_match else ""
+        any_variant = request.method not in (HttpMethod.GET, HttpMethod.HEAD)
+
         try:
-            cache_item = self._cache_storage.get(cache_id)
+            if not if_none_match and not if_match:
+                cache_item = yield (_GetStream(cache_id, vary_header) if self._is_streaming_storage else _Get(cache_id))
+            else:
+                # Cached response and ETag index entries are retrieved with a single lookup, bodies of other
+                # items are never loaded to evaluate conditional headers.
+                item_ids = [cache_id]
+                for etag in (*if_none_match, *if_match):
+                    if etag != "*":
+                        item_ids.extend(etag_index_ids(resource_id, etag))
+                found_items = yield _GetMany(list(dict.fromkeys(item_ids)))
+                cache_item = found_items.get(cache_id, cache_item)
+        except CacheError:
+            ...  # not cached yet
         except Exception:
-            ...  # ignore
-
-        # Check for conditional headers `if-none-match` `if-match`
-        conditional_headers_exists = "if-none-match" in request.headers or "if-match" in request.headers
+            self._count("storage_error", request)
 
-        if cache_item and not cache_item.is_expired and request.method in (HttpMethod.GET, HttpMethod.HEAD):
-            if "etag" in request.headers and not conditional_headers_exists:
-                return self.create_etag_response_from_cache_item(cache_item)
-
-            if "etag" not in request.headers:
-                cached_response = load_response(cache_item.body)
-                cached_response.headers["Last-Modified"] = format_date_rfc_1123(cache_item.updated_at)
-                cached_response.headers["Vary"] = ",".join(cache_vary)
-                cached_response.headers["Age"] = str(int((datetime.utcnow() - cache_item.updated_at).total_seconds()))
+        # Payload which cannot be decoded (e.g. malformed or stored by a newer version) is dropped as a miss.
+        if cache_item:
+            try:
+                self.get_response_template(cache_item, vary_header, self._allow_pickle)
+            except CacheError:
+                self._count("storage_error", request)
+                if self._is_collectable_storage:
+                    try:
+                        yield _Collect(cache_item)
+                    except Exception:
+                        ...  # entry is overwritten once the response is stored
+                cache_item = CacheItem.empty(cache_id)
 
-                if request.method == HttpMethod.HEAD:
-                    cached_response.body = b""
-                    cached_response.status_code = HttpStatus.NOT_MODIFIED
+        # If-match condition fails when none of the given entity tags is the current one
+        if if_match and not matches_etags(if_match, cache_item, found_items, False, resource_id, any_variant):
+            if cache_item and not cache_item.is_expired and request.method in (HttpMethod.GET, HttpMethod.HEAD):
+                self._count("not_modified", request)
+                return self.create_etag_response_from_cache_item(
+                    cache_item, vary_header, self._allow_pickle, self._get_accept_encoding(request)
+                )
+
+            self._count("precondition_failed", request)
+            return HttpResponse(status=HttpStatus.PRECONDITION_FAILED)
+
+        # If-none-match condition fails when any of the given entity tags is the current one
+        if if_none_match and matches_etags(if_none_match, cache_item, found_items, True, resource_id, any_variant):
+            # For methods that apply server-side changes, the status code 412 (Precondition Failed) is used.
+            if request.method not in (HttpMethod.GET, HttpMethod.HEAD):
+                self._count("precondition_failed", request)
+                return HttpResponse(status=HttpStatus.PRECONDITION_FAILED)
 
+            # When the condition fails for GET and HEAD methods, then the server must return
+            # HTTP status code 304 (Not Modified). We return that when cache is still fresh.
+            if cache_item and not cache_item.is_expired:
+                self._count("not_modified", request)
+                return self.create_etag_response_from_cache_item(
+                    cache_item, vary_header, self._allow_pickle, self._get_accept_encoding(request)
+                )
+
+        if cache_item and request.method in (HttpMethod.GET, HttpMethod.HEAD):
+            if not cache_item.is_expired:
+                self._count("hit", request)
+                cached_response = self._create_cached_response(request, cache_item, vary_header)
+                # Item close to its expiry is occasionally refreshed in the background ahead of time.
+                if self._should_refresh_early(request, cache_item) and self._claim_revalidation(cache_item.id):
+                    self._count("early_refresh", request)
+                    yield _RunInBackground(
+                        self._revalidate(request, cache_item, cache_expiry, cache_control, vary_header)
+                    )
                 return cached_response
 
-        # If-none-match condition fails when item CAN BE retrieved from cache
-        if "if-none-match" in request.headers:
-            try:
-                # Try to retrieve item from cache
-                self._cache_storage.get(parse_etag_value(request.headers.get("if-none-match")))
+            # Stale response is served straight away, while the handler is called in the background.
+            if self._is_stale_within(cache_item, stale_while_revalidate):
+                stale_response = self._create_cached_response(request, cache_item, vary_header)
+                revalidate = self._claim_revalidation(cache_item.id)
+                self._count("stale", request)
+                if revalidate:
+                    self._count("revalidation", request)
+                    yield _RunInBackground(
+                        self._revalidate(request, cache_item, cache_expiry, cache_control, vary_header)
+                    )
+                return stale_response
+
+        if request.method in (HttpMethod.GET, HttpMethod.HEAD):
+            self._count("miss", request)
 
-                # For methods that apply server-side changes, the status code 412 (Precondition Failed) is used.
-                if request.method in (HttpMethod.PUT, HttpMethod.PATCH, HttpMethod.POST, HttpMethod.DELETE):
-                    return HttpResponse(status=HttpStatus.PRECONDITION_FAILED)
+        # cache does not exists
+        if not cache_item or request.method not in (HttpMethod.GET, HttpMethod.HEAD):
+            return (yield from self._fetch(request, cache_item, cache_expiry, cache_control, vary_header))
 
-                # When the condition fails for GET and HEAD methods, then the server must return
-                # HTTP status code 304 (Not Modified). We return that when cache is still fresh.
-                if cache_item and not cache_item.is_expired and request.method in (HttpMethod.GET, HttpMethod.HEAD):
-                    return self.create_etag_response_from_cache_item(cache_item)
+        # Stale response can be served instead of an error, if the cached one is not too old.
+        try:
+            response = yield from self._fetch(request, cache_item, cache_expiry, cache_control, vary_header)
+        except Exception:
+            if not self._is_stale_within(cache_item, stale_if_error):
+                raise
+            self._count("stale_if_error", request)
+            return self._create_cached_response(request, cache_item, vary_header)
 
-            except Exception:
-                # When the exception occurs it means that if-none-match condition is fulfilled.
+        if response.status_code >= 500 and self._is_stale_within(cache_item, stale_if_error):
+            self._count("stale_if_error", request)
+            return self._create_cached_response(request, cache_item, vary_header)
 
-                # For GET and HEAD methods, the server will return the requested resource, with a 200 status,
-                # only if it doesn't have an ETag matching the given ones.
+        return response
 
-                # For other methods, the request will be processed only if the eventually existing resource's ETag
-                # doesn't match any of the values listed.
-                ...  # ignore
+    def _fetch(
+        self,
+        request: HttpRequest,
+        cache_item: CacheItem,
+        cache_expiry: int,
+        cache_control: str,
+        vary_header: str,
+    ) -> _Routine:
+        if self._coalesce_timeout is None or request.method not in (HttpMethod.GET, HttpMethod.HEAD):
+            response, _ = yield from self._fetch_response(request, cache_item, cache_expiry, cache_control, vary_header)
+            return response
 
-        if "if-match" in request.headers:
-            try:
-                self._cache_storage.get(parse_etag_value(request.headers.get("if-match")))
-                # we allow request to be processed if there is a match
+        # Concurrent requests for the same resource wait for the first one, instead of calling the handler.
+        (response, payload), shared = yield _Coalesce(
+            (request.method, cache_item.id),
+            lambda: self._fetch_response(request, cache_item, cache_expiry, cache_control, vary_header),
+        )
+        if shared:
+            self._count("coalesced", request)
+            return load_response(payload) if payload is not None else copy_response(response)
 
-            except Exception:
-                if cache_item and not cache_item.is_expired and request.method in (HttpMethod.GET, HttpMethod.HEAD):
-                    return self.create_etag_response_from_cache_item(cache_item)
+        return response
 
-                return HttpResponse(status=HttpStatus.PRECONDITION_FAILED)
+    def _fetch_response(
+        self,
+        request: HttpRequest,
+        cache_item: CacheItem,
+        cache_expiry: int,
+        cache_control: str,
+        vary_header: str,
+    ) -> _Routine:
+        # Index entry of the previously cached response's entity tag is dropped, once it is replaced.
+        previous_etag = self._get_etag(cache_item, vary_header) if cache_item else ""
+        # Misconfigured tags are reported before the handler runs, so its side effects are not repeated in vain.
+        route_tags = self._get_route_tags(request)
+
+        started = time.perf_counter()
+        response = yield _CallNext(request)
+        recompute_time = time.perf_counter() - started
+        response.headers["cache-control"] = cache_control
 
-        # cache does not exists
-        response = next(request)
+        if "vary" not in response.headers:
+            response.headers["vary"] = vary_header
 
-        if cache_control:
-            response.headers["cache-control"] = f"{cache_control}, max-age={cache_expiry}"
+        # If vary is being set we need to regenerate cache_id, and store cached response under the new id.
         else:
-            response.headers["cache-control"] = f"max-age={cache_expiry}"
-
-        if "vary" not in response.headers:
-            response.headers["vary"] = ",".join(cache_vary)
-
-        # If etag is not present in the response, but vary is being set we need to regenerate cache_id.
-        # And store cached response under the new id.
-        elif "etag" not in response.headers:
-            cache_vary = response.headers.get("vary")
-            if isinstance(cache_vary, str):
-                cache_vary = tuple([value.strip() for value in cache_vary.split(",")])
-            cache_id = generate_cache_id(request, cache_vary)
+            response_vary = self._get_header(response, "vary")
+            cache_id = self._key_generator(request, tuple(value.strip() for value in response_vary.split(",")))
             if cache_id != cache_item.id:
                 cache_item = CacheItem.empty(cache_id)
+                previous_etag = ""
+
+        # Response bigger than the limit is passed on without creating its cached copy.
+        cache_max_size = request.route.attributes.get("cache_max_size", self._cache_max_size)
+        if cache_max_size and response.body.getbuffer().nbytes > cache_max_size:
+            self._count("oversized", request)
+            if cache_item and self._is_collectable_storage:
+                yield _CollectMany([cache_item, *self._index_items(request, previous_etag)])
+            return response, None
+
+        etag = self._get_header(response, "etag") if "etag" in response.headers else ""
+        # Strong etag is generated once, when the response is stored, and it is served from the cache afterwards.
+        if (
+            not etag
+            and request.route.attributes.get("cache_etag", self._cache_etag)
+            and request.method in self._safe_methods
+            and response.status_code in self._successful_responses
+        ):
+            with response.body.getbuffer() as body:
+                etag = generate_etag(body)
+            response.headers["etag"] = etag
+
+        stale_index_items = []
+        if previous_etag != parse_etag_value(etag):
+            stale_index_items = self._index_items(request, previous_etag)
+
+        # Response with unchanged entity tag is not stored again, only lifetime of the cached one is extended.
+        elif (
+            previous_etag
+            and self._is_touchable_storage
+            and request.method in self._safe_methods
+            and request.method != HttpMethod.HEAD
+            and response.status_code in self._successful_responses
+        ):
+            # Fetched item may be served by other threads meanwhile, so it is never modified.
+            refreshed_item = self._create_item(
+                cache_item, b"", self._get_ttl(request, cache_expiry), cache_item.tags, cache_item.path
+            )
+            index_item = create_etag_index_item(refreshed_item, etag, self._get_resource_id(request))
+            touched = yield _Touch([refreshed_item, index_item])
+            if touched == 2:
+                self._count("refresh", request)
+                return response, None
 
-        if "etag" in response.headers:
-            cache_id = parse_etag_value(response.headers["etag"])
+        # If response wasn't successful or it is a head request we keep cache state unchanged.
+        if response.status_code not in self._successful_responses or request.method == HttpMethod.HEAD:
+            return response, None
 
-            # The cached item's id has changed, we should do the clean-up at this stage.
-            if (
-                "etag" in request.headers
-                and cache_item.id != cache_id
-                and isinstance(self._cache_storage, ICollectableCacheStorage)
-            ):
-                self._cache_storage.collect(cache_item)
+        ttl = self._get_ttl(request, cache_expiry)
+        tags = self._get_tags(route_tags, response)
 
-            # Update cache_id with the provided e-tag
-            cache_item._id = cache_id
+        # Collect cache for unsafe-methods, their responses are never serialised.
+        if request.method not in self._safe_methods:
+            if self._is_collectable_storage:
+                cache_item = self._create_item(cache_item, b"", ttl, tags, request.path)
+                index_items = self._index_items(request, previous_etag, parse_etag_value(etag))
+                yield _CollectMany([cache_item, *index_items])
+            return response, None
 
-        cache_item.ttl = cache_expiry
-        cache_item.body = dump_response(response)
+        # Store cache only for safe-methods
+        started = time.perf_counter()
+        payload: Optional[bytes] = None
+        chunks: List[Buffer] = []
+        if self._is_streaming_storage:
+            chunks = dump_response_chunks(response, self._compression)
+        else:
+            payload = dump_response(response, self._compression)
+        if self._metrics is not None:
+            self._metrics.observe("serialize", request.route.route, time.perf_counter() - started)
+
+        cache_item = self._create_item(
+            cache_item,
+            payload if payload is not None else b"",  # streamed body is passed separately
+            ttl,
+            tags,
+            request.path,
+        )
+
+        # Only handler calls producing a cached response weigh early refreshes.
+        self._recompute_times[request.route.route] = recompute_time
+        items = [cache_item]
+        if etag:
+            items.append(create_etag_index_item(cache_item, etag, self._get_resource_id(request)))
+        if self._is_streaming_storage:
+            yield _SetStream(cache_item, chunks)
+            if len(items) > 1:
+                yield _Set(items[1])
+        else:
+            yield _SetMany(items) if len(items) > 1 else _Set(cache_item)
+        if stale_index_items and self._is_collectable_storage:
+            yield _CollectMany(stale_index_items)
 
-        # If response wasn't successful or it is a head request we keep cache state unchanged.
-        if response.status_code not in self._successful_responses or request.method == HttpMethod.HEAD:
-            return response
+        return response, payload
 
-        # Store cache only for safe-methods
-        if request.method in self._safe_methods:
-            self._cache_storage.set(cache_item)
+    @staticmethod
+    def _create_item(cache_item: CacheItem, body: bytes, ttl: int, tags: Tuple[str, ...], path: str) -> CacheItem:
+        # Replacement of the fetched item, updated now and keeping its creation time.
+        now = time.time()
+        return CacheItem.restore(
+            cache_item.id,
+            body,
+            ttl,
+            cache_item.created_timestamp,
+            now,
+            now + ttl,
+            tags,
+            path,
+        )
+
+    def _get_resource_id(self, request: HttpRequest) -> str:
+        # ETag index is kept per resource (path and query), regardless of the variant selected by vary headers.
+        return self._key_generator(request, ())
+
+    def _index_items(self, request: HttpRequest, *etags: str) -> List[CacheItem]:
+        etags = tuple(etag for etag in dict.fromkeys(etags) if etag)
+        if not etags:
+            return []
+        resource_id = self._get_resource_id(request)
+
+        return [CacheItem.empty(etag_index_id(resource_id, etag)) for etag in etags]
+
+    def _get_etag(self, cache_item: CacheItem, vary_header: str) -> str:
+        try:
+            template = self.get_response_template(cache_item, vary_header, self._allow_pickle)
+        except CacheError:
+            return ""
+        etag = template.headers.get("etag")
+        if etag is None:
+            return ""
 
-        # Collect cache for unsafe-methods
-        elif isinstance(self._cache_storage, ICollectableCacheStorage):
-            self._cache_storage.collect(cache_item)
+        return parse_etag_value(etag if isinstance(etag, str) else ",".join(etag))
 
-        return response
+    @staticmethod
+    def _get_header(message: Union[HttpRequest, HttpResponse], name: str) -> str:
+        value = message.headers.get(name)
+        return value if isinstance(value, str) else ",".join(value)
+
+    @classmethod
+    def _get_accept_encoding(cls, request: HttpRequest) -> Optional[str]:
+        return cls._get_header(request, "accept-encoding") if "accept-encoding" in request.headers else None
+
+    def _count(self, event: str, request: HttpRequest) -> None:
+        if self._metrics is not None:
+            self._metrics.increment(event, request.route.route)
 
     @staticmethod
-    def create_etag_response_from_cache_item(cache_item: CacheItem) -> HttpResponse:
-        response = load_response(cache_item.body)
-        response.body = b""
-        response.status_code = HttpStatus.NOT_MODIFIED
+    def _get_route_tags(request: HttpRequest) -> Tuple[str, ...]:
+        # Tags set with route attribute are formatted with path parameters.
+        tags = []
+        for tag in request.route.attributes.get("cache_tags", ()):
+            try:
+                tags.append(tag.format_map(request.path_parameters))
+            except (KeyError, IndexError, ValueError) as error:
+                raise CacheError.for_invalid_cache_tag(tag, request.route.route) from error
+
+        return tuple(tags)
 
-        response.headers["Last-Modified"] = format_date_rfc_1123(cache_item.updated_at)
-        response.headers["Age"] = str(int((datetime.utcnow() - cache_item.updated_at).total_seconds()))
+    @staticmethod
+    def _get_tags(route_tags: Tuple[str, ...], response: HttpResponse) -> Tuple[str, ...]:
+        # Tags can be set with route attribute and/or `surrogate-key` header.
+        tags = list(route_tags)
+        if "surrogate-key" in response.headers:
+            surrogate_key = response.headers.get("surrogate-key")
+            if not isinstance(surrogate_key, str):
+                surrogate_key = " ".join(surrogate_key)
+            tags.extend(surrogate_key.split())
+
+        return tuple(tags)
+
+    def _revalidate(
+        self,
+        request: HttpRequest,
+        cache_item: CacheItem,
+        cache_expiry: int,
+        cache_control: str,
+        vary_header: str,
+    ) -> _Routine:
+        item_id = cache_item.id
+        try:
+            yield from self._fetch_response(request, cache_item, cache_expiry, cache_control, vary_header)
+        except Exception:
+            ...  # stale item is kept, so the next request will retry
+        finally:
+            with self._revalidation_lock:
+                self._revalidating.discard(item_id)
+
+    def _get_revalidation_executor(self) -> Executor:
+        # Requests handled in parallel may be the first to revalidate, only one of them creates the executor.
+        with self._revalidation_lock:
+            if self._revalidation_executor is None:
+                self._revalidation_executor = ThreadPoolExecutor(4, thread_name_prefix="chocs-cache-revalidation")
+
+            return self._revalidation_executor
+
+    def _get_ttl(self, request: HttpRequest, cache_expiry: int) -> int:
+        # Items stored together expire at different times, so they are not recomputed at once.
+        jitter = request.route.attributes.get("cache_ttl_jitter", self._cache_ttl_jitter)
+        if jitter <= 0:
+            return cache_expiry
+
+        return cache_expiry - int(random.uniform(0, min(jitter, 1.0) * cache_expiry))
+
+    def _should_refresh_early(self, request: HttpRequest, cache_item: CacheItem) -> bool:
+        """
+        Probabilistic early expiration (XFetch), items are refreshed the sooner before their expiry the longer
+        the handler takes and the higher `cache_early_refresh` (beta) is.
+        """
+        beta = request.route.attributes.get("cache_early_refresh", self._cache_early_refresh)
+        if beta <= 0 or request.method != HttpMethod.GET:
+            return False
+
+        delta = self._recompute_times.get(request.route.route, 0.0)
+        return time.time() - delta * beta * math.log(1.0 - random.random()) >= cache_item.expires_timestamp
+
+    def _claim_revalidation(self, item_id: str) -> bool:
+        with self._revalidation_lock:
+            if item_id in self._revalidating:
+                return False
+            self._revalidating.add(item_id)
+
+        return True
+
+    @staticmethod
+    def _is_stale_within(cache_item: CacheItem, window: int) -> bool:
+        return window > 0 and time.time() - cache_item.expires_timestamp <= window
+
+    def _create_cached_response(self, request: HttpRequest, cache_item: CacheItem, vary_header: str) -> HttpResponse:
+        accept_encoding = self._get_accept_encoding(request)
+        if request.method == HttpMethod.HEAD:
+            return self.create_etag_response_from_cache_item(
+                cache_item, vary_header, self._allow_pickle, accept_encoding
+            )
+
+        template = self.get_response_template(cache_item, vary_header, self._allow_pickle)
+        encoded = template.accepts(accept_encoding)
+        if "range" in request.headers and template.status_code == HttpStatus.OK:
+            partial_response = self._create_partial_response(request, template, encoded)
+            if partial_response is not None:
+                partial_response.headers.override("age", str(cache_item.age))
+                return partial_response
+
+        cached_response = template.create_response(encoded=encoded)
+        cached_response.headers.override("age", str(cache_item.age))
+
+        return cached_response
+
+    @staticmethod
+    def _create_partial_response(
+        request: HttpRequest, template: ResponseTemplate, encoded: bool
+    ) -> Optional[HttpResponse]:
+        # Full response is served, when the cached one has changed since the client got its part.
+        if "if-range" in request.headers and not template.matches_if_range(
+            str(request.headers.get("if-range")), encoded
+        ):
+            return None
+
+        range_header = request.headers.get("range")
+        if not isinstance(range_header, str):
+            range_header = ",".join(range_header)
+        body = template.encoded_body if encoded else template.body
+        ranges = parse_range(range_header, len(body))  # type: ignore
+
+        return template.create_partial_response(ranges, encoded) if ranges is not None else None
+
+    @staticmethod
+    def get_response_template(
+        cache_item: CacheItem, vary: Optional[str] = None, allow_pickle: bool = False
+    ) -> ResponseTemplate:
+        template = cache_item.decoded
+        if isinstance(template, ResponseTemplate) and template.vary == vary:
+            return template
+
+        template = ResponseTemplate.from_payload(cache_item.body, cache_item.updated_at, vary, allow_pickle)
+        cache_item.decoded = template
+
+        return template
+
+    @classmethod
+    def create_etag_response_from_cache_item(
+        cls,
+        cache_item: CacheItem,
+        vary: Optional[str] = None,
+        allow_pickle: bool = False,
+        accept_encoding: Optional[str] = None,
+    ) -> HttpResponse:
+        template = cls.get_response_template(cache_item, vary, allow_pickle)
+        response = template.create_response(with_body=False, encoded=template.accepts(accept_encoding))
+        response.status_code = HttpStatus.NOT_MODIFIED
+        response.headers.override("age", str(cache_item.age))
 
         return response
@@ -0,0 +1,551 @@
+import functools
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import weakref
+import zlib
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from chocs_middleware.cache.cache_storage import (
+    Buffer,
+    CacheItem,
+    IBatchCollectableCacheStorage,
+    IStreamingCacheStorage,
+    ITouchableCacheStorage,
+)
+from chocs_middleware.cache.error import CacheError
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore
+
+__all__ = ["MmapCacheStorage"]
+
+_MAGIC = b"CHCM"
+_VERSION = 1
+_PAGE_SIZE = 4096
+_MAX_LOAD = 0.75
+# Share of index slots (or of the arena, when blocks of other sizes are merged) freed by eviction at once,
+# so the index and free lists are not rebuilt on every insert.
+_EVICTION_BATCH = 0.1
+
+# magic, version, number of block classes, number of index slots, smallest block size, arena offset, arena size
+_GEOMETRY = struct.Struct("!4sHHIQQQ")
+# arena bump pointer, used slots, tombstones, eviction hand
+_COUNTERS = struct.Struct("!QQQQ")
+_COUNTERS_OFFSET = 40
+_FREE_LISTS_OFFSET = _COUNTERS_OFFSET + _COUNTERS.size
+_OFFSET = struct.Struct("!Q")
+
+# state, block class, padding, crc of the remaining fields, key digest, record offset
+_SLOT = struct.Struct("!BBHI16sQ")
+_SLOT_FIELDS = struct.Struct("!BB16sQ")
+_EMPTY = 0
+_USED = 1
+_TOMBSTONE = 2
+
+# crc, key size, body size, ttl, created, updated, expires
+_RECORD = struct.Struct("!IHIiddd")
+_CRC = struct.Struct("!I")
+
+
+def _reopen_after_fork(reference: "weakref.ReferenceType[MmapCacheStorage]") -> None:
+    storage = reference()
+    if storage is not None:
+        storage._reopen()
+
+
+class MmapCacheStorage(IBatchCollectableCacheStorage, IStreamingCacheStorage, ITouchableCacheStorage):
+    """
+    Storage kept in a memory-mapped file, shared by all processes opening the same `path` (e.g. pre-forked
+    workers). The file holds an open-addressing index of `slots` entries and an arena of `arena_size` bytes,
+    split into power-of-two blocks (from `min_block` up to `max_block` bytes) kept on per-size free lists.
+    A missing block is split from a larger free one. When the arena or the index is full, items are evicted
+    in index order; an evicted block smaller than the needed one is merged with its neighbours, which are
+    evicted as well. Items not fitting the largest block are not stored. The geometry of an existing file takes precedence over the passed arguments.
+
+    Processes synchronise with `flock`. A record is written to a free block before the index entry pointing
+    at it is published, and both are guarded with checksums, so a process dying mid-write never leaves
+    a partially written item visible to others. POSIX systems only.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        arena_size: int = 64 * 1024 * 1024,
+        slots: int = 65536,
+        min_block: int = 256,
+        max_block: int = 1024 * 1024,
+    ):
+        if fcntl is None:  # pragma: no cover
+            raise CacheError.for_invalid_storage_file(path, "memory-mapped storage requires a POSIX system")
+        if min_block < _RECORD.size or min_block & (min_block - 1) or max_block < min_block:
+            raise ValueError("`min_block` must be a power of two, not greater than `max_block`.")
+        if slots <= 0 or arena_size < max_block:
+            raise ValueError("`slots` must be a positive number and `arena_size` must fit at least one block.")
+
+        self.path = path
+        self._requested_geometry = (arena_size, slots, min_block, max_block)
+        self._lock = threading.RLock()
+        self._fd = -1
+        self._mmap: Optional[mmap.mmap] = None
+        self._open()
+        os.register_at_fork(after_in_child=functools.partial(_reopen_after_fork, weakref.ref(self)))
+
+    def get(self, item_id: str) -> CacheItem:
+        with self._locked(fcntl.LOCK_SH):
+            item = self._read_item(item_id)
+        if item is None:
+            raise CacheError.for_not_found(item_id)
+
+        return item
+
+    def get_many(self, item_ids: Iterable[str]) -> Dict[str, CacheItem]:
+        items = {}
+        with self._locked(fcntl.LOCK_SH):
+            for item_id in item_ids:
+                item = self._read_item(item_id)
+                if item is not None:
+                    items[item_id] = item
+
+        return items
+
+    def get_stream(self, item_id: str, sink: Callable[[memoryview], Any], chunk_size: int = 64 * 1024) -> CacheItem:
+        with self._locked(fcntl.LOCK_SH):
+            record = self._read_record(item_id)
+            if record is None:
+                raise CacheError.for_not_found(item_id)
+            offset, body_size, ttl, created, updated, expires = record
+            with memoryview(self._mmap)[offset : offset + body_size] as body:  # type: ignore
+                for start in range(0, body_size, chunk_size):
+                    with body[start : start + chunk_size] as chunk:
+                        sink(chunk)
+
+        return CacheItem.restore(item_id, b"", ttl, created, updated, expires)
+
+    @contextmanager
+    def read_body(self, item_id: str) -> Iterator[memoryview]:
+        """
+        Gives zero-copy access to the stored body, writers are blocked until the context is left.
+        """
+        with self._locked(fcntl.LOCK_SH):
+            record = self._read_record(item_id)
+            if record is None:
+                raise CacheError.for_not_found(item_id)
+            offset, body_size = record[0], record[1]
+            view = memoryview(self._mmap)[offset : offset + body_size]  # type: ignore
+            try:
+                yield view
+            finally:
+                view.release()
+
+    def set(self, item: CacheItem) -> None:
+        self.set_stream(item, (item.body,), len(item.body))
+
+    def set_stream(self, item: CacheItem, chunks: Iterable[Buffer], size: int) -> None:
+        with self._locked(fcntl.LOCK_EX):
+            self._write_item(item, chunks, size)
+
+    def set_many(self, items: Iterable[CacheItem]) -> None:
+        with self._locked(fcntl.LOCK_EX):
+            for item in items:
+                self._write_item(item, (item.body,), len(item.body))
+
+    def touch(self, items: Iterable[CacheItem]) -> int:
+        """
+        Rewrites headers of the stored records in place, bodies are only read to update their checksums.
+        """
+        touched = 0
+        with self._locked(fcntl.LOCK_EX):
+            for item in items:
+                record = self._read_record(item.id)
+                if record is None:
+                    continue
+                key_size = len(item.id.encode("utf8"))
+                self._write_header(record[0] - key_size - _RECORD.size, item, key_size, record[1])
+                touched += 1
+
+        return touched
+
+    def collect(self, item: CacheItem) -> None:
+        with self._locked(fcntl.LOCK_EX):
+            self._remove(self._digest(item.id.encode("utf8")))
+
+    def collect_many(self, items: Iterable[CacheItem]) -> None:
+        with self._locked(fcntl.LOCK_EX):
+            for item in items:
+                self._remove(self._digest(item.id.encode("utf8")))
+
+    def clear(self) -> None:
+        with self._locked(fcntl.LOCK_EX):
+            self._initialise()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            if self._fd >= 0:
+                os.close(self._fd)
+                self._fd = -1
+
+    @property
+    def is_empty(self) -> bool:
+        return len(self) <= 0
+
+    def __len__(self) -> int:
+        with self._locked(fcntl.LOCK_SH):
+            return self._counters()[1]
+
+    def __enter__(self) -> "MmapCacheStorage":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @contextmanager
+    def _locked(self, operation: int) -> Iterator[None]:
+        # flock is held per open file, so threads of the same process are serialised with a regular lock
+        with self._lock:
+            if self._mmap is None:
+                raise CacheError.for_invalid_storage_file(self.path, "storage is closed")
+            fcntl.flock(self._fd, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _open(self) -> None:
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            size = os.fstat(self._fd).st_size
+            if size >= _PAGE_SIZE:
+                self._mmap = mmap.mmap(self._fd, size)
+                magic, version, classes, slots, min_block, arena_offset, arena_size = _GEOMETRY.unpack_from(self._mmap)
+                if magic == _MAGIC and version != _VERSION:
+                    raise CacheError.for_invalid_storage_file(self.path, f"unsupported version `{version}`")
+                if magic == _MAGIC and size == arena_offset + arena_size:
+                    self._set_geometry(classes, slots, min_block, arena_offset, arena_size)
+                    return
+                self._mmap.close()
+
+            # New file or a file left by a process that died while creating it.
+            arena_size, slots, min_block, max_block = self._requested_geometry
+            classes = max_block.bit_length() - min_block.bit_length() + 1
+            arena_offset = _FREE_LISTS_OFFSET + classes * _OFFSET.size + slots * _SLOT.size
+            arena_offset = (arena_offset + _PAGE_SIZE - 1) // _PAGE_SIZE * _PAGE_SIZE
+            os.ftruncate(self._fd, 0)
+            os.ftruncate(self._fd, arena_offset + arena_size)
+            self._mmap = mmap.mmap(self._fd, arena_offset + arena_size)
+            self._set_geometry(classes, slots, min_block, arena_offset, arena_size)
+            self._initialise()
+        except BaseException:
+            self.close()
+            raise
+        finally:
+            if self._fd >= 0:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _reopen(self) -> None:
+        # Forked process must not share the open file (and so the lock) with its parent.
+        self._lock = threading.RLock()
+        self.close()
+        self._open()
+
+    def _set_geometry(self, classes: int, slots: int, min_block: int, arena_offset: int, arena_size: int) -> None:
+        self._classes = classes
+        self._slots = slots
+        self._min_block = min_block
+        self._arena_offset = arena_offset
+        self._arena_size = arena_size
+        self._slots_offset = _FREE_LISTS_OFFSET + classes * _OFFSET.size
+
+    def _initialise(self) -> None:
+        self._mmap[self._slots_offset : self._slots_offset + self._slots * _SLOT.size] = bytes(  # type: ignore
+            self._slots * _SLOT.size
+        )
+        self._mmap[_FREE_LISTS_OFFSET : self._slots_offset] = bytes(self._classes * _OFFSET.size)  # type: ignore
+        self._write_counters(0, 0, 0, 0)
+        _GEOMETRY.pack_into(
+            self._mmap,  # type: ignore
+            0,
+            _MAGIC,
+            _VERSION,
+            self._classes,
+            self._slots,
+            self._min_block,
+            self._arena_offset,
+            self._arena_size,
+        )
+
+    def _counters(self) -> Tuple[int, int, int, int]:
+        return _COUNTERS.unpack_from(self._mmap, _COUNTERS_OFFSET)  # type: ignore
+
+    def _write_counters(self, bump: int, used: int, tombstones: int, hand: int) -> None:
+        _COUNTERS.pack_into(self._mmap, _COUNTERS_OFFSET, bump, used, tombstones, hand)  # type: ignore
+
+    def _digest(self, key: bytes) -> bytes:
+        return hashlib.blake2b(key, digest_size=16).digest()
+
+    def _block_class(self, size: int) -> Optional[int]:
+        block_class = max(0, (size - 1).bit_length() - self._min_block.bit_length() + 1)
+        return block_class if block_class < self._classes else None
+
+    def _read_slot(self, index: int) -> Tuple[int, int, bytes, int]:
+        state, block_class, _, crc, digest, offset = _SLOT.unpack_from(
+            self._mmap, self._slots_offset + index * _SLOT.size  # type: ignore
+        )
+        if state == _EMPTY:
+            return _EMPTY, 0, digest, 0
+
+        # Torn entry is treated as removed one, its block is recovered once blocks are reclaimed.
+        if crc != zlib.crc32(_SLOT_FIELDS.pack(state, block_class, digest, offset)):
+            return _TOMBSTONE, 0, digest, 0
+
+        return state, block_class, digest, offset
+
+    def _write_slot(self, index: int, state: int, block_class: int, digest: bytes, offset: int) -> None:
+        crc = zlib.crc32(_SLOT_FIELDS.pack(state, block_class, digest, offset))
+        _SLOT.pack_into(
+            self._mmap, self._slots_offset + index * _SLOT.size, state, block_class, 0, crc, digest, offset  # type: ignore
+        )
+
+    def _find(self, digest: bytes) -> Tuple[int, int]:
+        """
+        Returns index of the slot holding given digest (or -1) and index of the first slot it can be stored in.
+        """
+        start = int.from_bytes(digest[:8], "big") % self._slots
+        free = -1
+        for step in range(self._slots):
+            index = (start + step) % self._slots
+            state, _, slot_digest, _ = self._read_slot(index)
+            if state == _EMPTY:
+                return -1, free if free >= 0 else index
+            if state == _TOMBSTONE:
+                if free < 0:
+                    free = index
+                continue
+            if slot_digest == digest:
+                return index, index
+
+        return -1, free
+
+    def _write_item(self, item: CacheItem, chunks: Iterable[Buffer], size: int) -> None:
+        key = item.id.encode("utf8")
+        block_class = self._block_class(_RECORD.size + len(key) + size)
+        digest = self._digest(key)
+
+        # Record larger than the biggest block class has no slot in the arena, so any previous record of the key
+        # is released rather than left to be served.
+        if block_class is None:
+            self._remove(digest)
+            return
+
+        offset = self._allocate(block_class)
+        if offset is None:
+            self._remove(digest)
+            return
+
+        key_end = offset + _RECORD.size + len(key)
+        record_end = key_end + size
+        self._mmap[offset + _RECORD.size : key_end] = key  # type: ignore
+        position = key_end
+        for chunk in chunks:
+            if position + len(chunk) > record_end:
+                break
+            self._mmap[position : position + len(chunk)] = chunk  # type: ignore
+            position += len(chunk)
+        if position != record_end:
+            self._release(block_class, offset)
+            raise ValueError(f"Chunks of item `{item.id}` do not add up to {size} bytes.")
+
+        self._write_header(offset, item, len(key), size)
+
+        found, free = self._find(digest)
+        if found < 0:
+            bump, used, tombstones, hand = self._counters()
+            if used + tombstones + 1 > self._slots * _MAX_LOAD:
+                if used + 1 > self._slots * _MAX_LOAD:
+                    target = self._slots * (_MAX_LOAD - _EVICTION_BATCH)
+                    while self._counters()[1] + 1 > target and self._evict() is not None:
+                        ...
+                self._rebuild_index()
+            found, free = self._find(digest)
+
+        if found >= 0:
+            _, old_class, _, old_offset = self._read_slot(found)
+            self._write_slot(found, _USED, block_class, digest, offset)
+            self._release(old_class, old_offset)
+            return
+
+        bump, used, tombstones, hand = self._counters()
+        if self._read_slot(free)[0] == _TOMBSTONE:
+            tombstones -= 1
+        self._write_slot(free, _USED, block_class, digest, offset)
+        self._write_counters(bump, used + 1, tombstones, hand)
+
+    def _write_header(self, offset: int, item: CacheItem, key_size: int, body_size: int) -> None:
+        header = _RECORD.pack(
+            0, key_size, body_size, item.ttl, item.created_timestamp, item.updated_timestamp, item.expires_timestamp
+        )
+        self._mmap[offset : offset + _RECORD.size] = header  # type: ignore
+        record_end = offset + _RECORD.size + key_size + body_size
+        with memoryview(self._mmap)[offset + _CRC.size : record_end] as view:  # type: ignore
+            _CRC.pack_into(self._mmap, offset, zlib.crc32(view))  # type: ignore
+
+    def _read_record(self, item_id: str) -> Optional[Tuple[int, int, int, float, float, float]]:
+        key = item_id.encode("utf8")
+        found, _ = self._find(self._digest(key))
+        if found < 0:
+            return None
+
+        _, block_class, _, offset = self._read_slot(found)
+        if offset < self._arena_offset or offset + (self._min_block << block_class) > len(self._mmap):  # type: ignore
+            return None
+
+        crc, key_size, body_size, ttl, created, updated, expires = _RECORD.unpack_from(self._mmap, offset)  # type: ignore
+        key_offset = offset + _RECORD.size
+        body_offset = key_offset + key_size
+        if body_offset + body_size > offset + (self._min_block << block_class):
+            return None
+
+        with memoryview(self._mmap)[offset + _CRC.size : body_offset + body_size] as view:  # type: ignore
+            key_start = _RECORD.size - _CRC.size
+            if crc != zlib.crc32(view) or view[key_start : key_start + key_size] != key:
+                return None
+
+        return body_offset, body_size, ttl, created, updated, expires
+
+    def _read_item(self, item_id: str) -> Optional[CacheItem]:
+        record = self._read_record(item_id)
+        if record is None:
+            return None
+        offset, body_size, ttl, created, updated, expires = record
+        body = self._mmap[offset : offset + body_size]  # type: ignore
+
+        return CacheItem.restore(item_id, body, ttl, created, updated, expires)
+
+    def _allocate(self, block_class: int) -> Optional[int]:
+        block_size = self._min_block << block_class
+        while True:
+            for free_class in range(block_class, self._classes):
+                head = self._pop_free(free_class)
+                if head:
+                    # Larger block is split, the halves not needed are put on the free lists of their sizes.
+                    for split_class in range(block_class, free_class):
+                        self._release(split_class, head + (self._min_block << split_class))
+                    return head
+
+            bump, used, tombstones, hand = self._counters()
+            if bump + block_size <= self._arena_size:
+                self._write_counters(bump + block_size, used, tombstones, hand)
+                return self._arena_offset + bump
+
+            evicted = self._evict()
+            if evicted is None:
+                return None
+            if evicted[1] < block_class:
+                self._reclaim(evicted[0], block_size)
+
+    def _pop_free(self, block_class: int) -> int:
+        free_list = _FREE_LISTS_OFFSET + block_class * _OFFSET.size
+        (head,) = _OFFSET.unpack_from(self._mmap, free_list)  # type: ignore
+        if head:
+            _OFFSET.pack_into(self._mmap, free_list, *_OFFSET.unpack_from(self._mmap, head))  # type: ignore
+
+        return head
+
+    def _reclaim(self, offset: int, size: int) -> None:
+        """
+        Evicts items holding blocks in the run of at least `size` bytes starting at the given offset (or ending
+        at the end of the arena), and rebuilds free lists from the gaps left between the remaining items, so
+        the run and adjacent free blocks of any size are merged.
+        """
+        size = max(size, int(self._arena_size * _EVICTION_BATCH))
+        start = min(offset - self._arena_offset, self._arena_size - size)
+        blocks = []
+        for index in range(self._slots):
+            state, block_class, _, block_offset = self._read_slot(index)
+            if state != _USED:
+                continue
+            block_start = block_offset - self._arena_offset
+            block_end = block_start + (self._min_block << block_class)
+            if block_start < 0 or block_end > self._arena_size:
+                continue
+            if block_start < start + size and block_end > start:
+                self._remove_slot(index)
+                continue
+            blocks.append((block_start, block_end))
+
+        self._rebuild_free_lists(sorted(blocks))
+
+    def _rebuild_free_lists(self, blocks: Iterable[Tuple[int, int]]) -> None:
+        self._mmap[_FREE_LISTS_OFFSET : self._slots_offset] = bytes(self._classes * _OFFSET.size)  # type: ignore
+        max_class = self._classes - 1
+        position = 0
+        for start, end in blocks:
+            while position < start:
+                block_class = min(max_class, ((start - position) // self._min_block).bit_length() - 1)
+                self._release(block_class, self._arena_offset + position)
+                position += self._min_block << block_class
+            position = max(position, end)
+
+        # Space after the last block is handed out by the bump pointer again.
+        _, used, tombstones, hand = self._counters()
+        self._write_counters(position, used, tombstones, hand)
+
+    def _release(self, block_class: int, offset: int) -> None:
+        if not offset:
+            return
+        free_list = _FREE_LISTS_OFFSET + block_class * _OFFSET.size
+        self._mmap[offset : offset + _OFFSET.size] = self._mmap[free_list : free_list + _OFFSET.size]  # type: ignore
+        _OFFSET.pack_into(self._mmap, free_list, offset)  # type: ignore
+
+    def _remove(self, digest: bytes) -> None:
+        found, _ = self._find(digest)
+        if found >= 0:
+            self._remove_slot(found)
+
+    def _remove_slot(self, index: int) -> None:
+        _, block_class, digest, offset = self._read_slot(index)
+        self._write_slot(index, _TOMBSTONE, 0, digest, 0)
+        bump, used, tombstones, hand = self._counters()
+        self._write_counters(bump, used - 1, tombstones + 1, hand)
+        self._release(block_class, offset)
+
+    def _evict(self) -> Optional[Tuple[int, int]]:
+        """
+        Removes the next item found from the eviction hand onwards, returns offset and class of its block.
+        """
+        hand = self._counters()[3]
+        for step in range(self._slots):
+            index = (hand + step) % self._slots
+            state, block_class, _, offset = self._read_slot(index)
+            if state == _USED:
+                self._remove_slot(index)
+                bump, used, tombstones, _ = self._counters()
+                self._write_counters(bump, used, tombstones, (index + 1) % self._slots)
+                return offset, block_class
+
+        return None
+
+    def _rebuild_index(self) -> None:
+        entries = []
+        for index in range(self._slots):
+            state, block_class, digest, offset = self._read_slot(index)
+            if state == _USED:
+                entries.append((block_class, digest, offset))
+
+        slots_end = self._slots_offset + self._slots * _SLOT.size
+        self._mmap[self._slots_offset : slots_end] = bytes(self._slots * _SLOT.size)  # type: ignore
+        for block_class, digest, offset in entries:
+            _, free = self._find(digest)
+            self._write_slot(free, _USED, block_class, digest, offset)
+
+        bump, _, _, hand = self._counters()
+        self._write_counters(bump, len(entries), 0, hand)
@@ -0,0 +1,382 @@
+import hashlib
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Union
+
+from chocs_middleware.cache.cache_storage import (
+    CacheItem,
+    IBatchCollectableCacheStorage,
+    ITouchableCacheStorage,
+    dump_item,
+    dump_item_metadata,
+    load_item,
+)
+from chocs_middleware.cache.error import CacheError
+from chocs_middleware.cache.invalidation import IInvalidatableCacheStorage, path_prefixes
+
+__all__ = ["RedisConnectionPool", "RedisCacheStorage"]
+
+Command = Sequence[Union[bytes, str, int]]
+
+# Overwrites metadata of the stored item (following its version byte) and its expiry, missing keys are not created.
+_TOUCH_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 0 then return 0 end
+redis.call("SETRANGE", KEYS[1], 1, ARGV[1])
+if tonumber(ARGV[2]) > 0 then redis.call("PEXPIRE", KEYS[1], ARGV[2]) else redis.call("PERSIST", KEYS[1]) end
+return 1
+"""
+
+# Adds item id (or updates its score) to the index scored by the item's expiry time, ids of expired items are dropped
+# and the index expires together with the item expiring last.
+_INDEX_SCRIPT = """
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", "(" .. ARGV[3])
+redis.call("ZADD", KEYS[1], ARGV[2], ARGV[1])
+if redis.call("ZCOUNT", KEYS[1], "+inf", "+inf") > 0 then return redis.call("PERSIST", KEYS[1]) end
+local last = redis.call("ZRANGE", KEYS[1], -1, -1, "WITHSCORES")
+return redis.call("PEXPIREAT", KEYS[1], last[2])
+"""
+
+# Scripts are called by their SHA1 digest, so their source is only sent when the server does not know them yet.
+_TOUCH_SCRIPT_SHA = hashlib.sha1(_TOUCH_SCRIPT.encode("utf8")).hexdigest()
+_INDEX_SCRIPT_SHA = hashlib.sha1(_INDEX_SCRIPT.encode("utf8")).hexdigest()
+
+
+def _encode_command(command: Command) -> bytes:
+    parts = [b"*%d\r\n" % len(command)]
+    for argument in command:
+        if isinstance(argument, int):
+            argument = b"%d" % argument
+        elif isinstance(argument, str):
+            argument = argument.encode("utf8")
+        parts.append(b"$%d\r\n" % len(argument))
+        parts.append(argument)
+        parts.append(b"\r\n")
+
+    return b"".join(parts)
+
+
+class _ReplyError:
+    __slots__ = ("message",)
+
+    def __init__(self, message: str):
+        self.message = message
+
+
+class RedisConnection:
+    """
+    Minimal client of the Redis serialization protocol (RESP2), commands passed to `execute` are pipelined.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        timeout: Optional[float],
+        db: int = 0,
+        password: Optional[str] = None,
+    ):
+        self._socket = socket.create_connection((host, port), timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self._socket.makefile("rb")
+        try:
+            if password is not None:
+                self.execute([(b"AUTH", password)])
+            if db:
+                self.execute([(b"SELECT", db)])
+        except BaseException:
+            self.close()
+            raise
+
+    def execute(self, commands: Iterable[Command]) -> List[Any]:
+        payload = [_encode_command(command) for command in commands]
+        self._socket.sendall(b"".join(payload))
+
+        # All replies are read before raising, so the connection stays usable.
+        replies = [self._read_reply() for _ in payload]
+        for reply in replies:
+            if isinstance(reply, _ReplyError):
+                raise CacheError.for_redis_error(reply.message)
+
+        return replies
+
+    def close(self) -> None:
+        self._reader.close()
+        self._socket.close()
+
+    def _read_reply(self) -> Any:
+        line = self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by Redis server.")
+
+        prefix, value = line[:1], line[1:-2]
+        if prefix == b"$":
+            size = int(value)
+            if size < 0:
+                return None
+            data = self._reader.read(size + 2)
+            if len(data) != size + 2:
+                raise ConnectionError("Connection closed by Redis server.")
+            return data[:-2]
+        if prefix == b"+":
+            return value
+        if prefix == b":":
+            return int(value)
+        if prefix == b"*":
+            size = int(value)
+            return None if size < 0 else [self._read_reply() for _ in range(size)]
+        if prefix == b"-":
+            return _ReplyError(value.decode("utf8", "replace"))
+
+        raise ConnectionError(f"Unexpected reply from Redis server `{line!r}`.")
+
+
+class RedisConnectionPool:
+    """
+    Keeps up to `max_idle` connections open for reuse, connections are created on demand. A connection
+    which failed in any way is closed instead of being returned to the pool.
+    """
+
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 6379,
+        db: int = 0,
+        password: Optional[str] = None,
+        timeout: Optional[float] = 0.1,
+        max_idle: int = 16,
+    ):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle: List[RedisConnection] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self) -> Iterator[RedisConnection]:
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        if connection is None:
+            connection = RedisConnection(self.host, self.port, self.timeout, self.db, self.password)
+
+        try:
+            yield connection
+        except BaseException:
+            connection.close()
+            raise
+
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def __len__(self) -> int:
+        return len(self._idle)
+
+
+class RedisCacheStorage(IBatchCollectableCacheStorage, ITouchableCacheStorage, IInvalidatableCacheStorage):
+    """
+    Keeps items in Redis (or any server speaking its protocol) under `prefix` + item id. Items expire in Redis
+    `expiry_grace` seconds after their ttl, so expired items can still be revalidated, items with no lifetime
+    left at all are kept until overwritten or collected.
+
+    Tags and paths of items are indexed in Redis sorted sets scored by expiry time of the items, so
+    `invalidate_tag` and `invalidate_prefix` only read the matching item ids. Ids of expired items are dropped
+    from an index whenever an item is added to it, ids of collected items are removed straight away. The root path
+    is not indexed, as it would hold every item, invalidating `/` prefix deletes all keys under `prefix` instead.
+
+    Storage fails open: when Redis is unavailable or does not respond within the pool's timeout, reads are
+    reported as a cache miss and writes are skipped. Failed calls are counted in `failures`.
+    """
+
+    def __init__(
+        self,
+        pool: Optional[RedisConnectionPool] = None,
+        prefix: str = "chocs-cache:",
+        expiry_grace: int = 0,
+    ):
+        self.pool = pool if pool is not None else RedisConnectionPool()
+        self.prefix = prefix
+        self.expiry_grace = expiry_grace
+        self.failures = 0
+
+    def get(self, item_id: str) -> CacheItem:
+        item = self.get_many([item_id]).get(item_id)
+        if item is None:
+            raise CacheError.for_not_found(item_id)
+
+        return item
+
+    def get_many(self, item_ids: Iterable[str]) -> Dict[str, CacheItem]:
+        """
+        Retrieves items with a single `MGET` call, missing items are omitted.
+        """
+        item_ids = list(item_ids)
+        if not item_ids:
+            return {}
+
+        replies = self._execute([(b"MGET", *[self.prefix + item_id for item_id in item_ids])])
+        if replies is None:
+            return {}
+
+        items = {}
+        for item_id, data in zip(item_ids, replies[0]):
+            if data is None:
+                continue
+            try:
+                items[item_id] = load_item(item_id, data)
+            except CacheError:
+                continue
+
+        return items
+
+    def set(self, item: CacheItem) -> None:
+        self.set_many([item])
+
+    def set_many(self, items: Iterable[CacheItem]) -> None:
+        """
+        Stores items with pipelined `SET` calls, each with its own expiry time.
+        """
+        commands: List[Command] = []
+        for item in items:
+            lifetime = int((item.ttl + self.expiry_grace) * 1000)
+            if lifetime > 0:
+                commands.append((b"SET", self.prefix + item.id, dump_item(item), b"PX", lifetime))
+            else:
+                commands.append((b"SET", self.prefix + item.id, dump_item(item)))
+
+            commands.extend(self._index_commands(item, lifetime))
+
+        if commands:
+            self._execute(commands)
+
+    def touch(self, items: Iterable[CacheItem]) -> int:
+        """
+        Updates metadata and expiry of items with pipelined calls of a short script, bodies are not sent.
+        """
+        commands: List[Command] = []
+        for item in items:
+            lifetime = int((item.ttl + self.expiry_grace) * 1000)
+            commands.append(
+                (b"EVALSHA", _TOUCH_SCRIPT_SHA, 1, self.prefix + item.id, dump_item_metadata(item), lifetime)
+            )
+            commands.extend(self._index_commands(item, lifetime))
+
+        replies = self._execute(commands) if commands else None
+        if replies is None:
+            return 0
+
+        return sum(reply for command, reply in zip(commands, replies) if command[1] == _TOUCH_SCRIPT_SHA)
+
+    def collect(self, item: CacheItem) -> None:
+        self.collect_many([item])
+
+    def collect_many(self, items: Iterable[CacheItem]) -> None:
+        """
+        Deletes items and removes their ids from indexes of their tags and path, ids of items passed without them
+        are dropped from indexes once the items would have expired.
+        """
+        keys = []
+        indexed: Dict[str, List[str]] = {}
+        for item in items:
+            keys.append(self.prefix + item.id)
+            for index_key in self._index_keys(item):
+                indexed.setdefault(index_key, []).append(item.id)
+
+        if keys:
+            commands: List[Command] = [(b"DEL", *keys)]
+            commands.extend((b"ZREM", index_key, *item_ids) for index_key, item_ids in indexed.items())
+            self._execute(commands)
+
+    def invalidate_tag(self, tag: str) -> int:
+        return self._invalidate(self._tag_key(tag))
+
+    def invalidate_prefix(self, path_prefix: str) -> int:
+        path = path_prefixes(path_prefix)[-1]
+        if path == "/":
+            return self._invalidate_all()
+
+        return self._invalidate(self._path_key(path))
+
+    def _invalidate(self, index_key: str) -> int:
+        replies = self._execute([(b"ZRANGE", index_key, 0, -1)])
+        if not replies or not replies[0]:
+            return 0
+
+        item_keys = [self.prefix + item_id.decode("utf8") for item_id in replies[0]]
+        replies = self._execute([(b"DEL", *item_keys), (b"DEL", index_key)])
+
+        return replies[0] if replies else 0
+
+    def _invalidate_all(self) -> int:
+        # Keys are iterated with `SCAN`, so the server is never blocked for longer than a single batch takes.
+        pattern = "".join("\\" + char if char in "*?[]\\" else char for char in self.prefix) + "*"
+        index_prefix = f"{self.prefix}#".encode("utf8")
+        invalidated = 0
+        cursor = b"0"
+        while True:
+            replies = self._execute([(b"SCAN", cursor, b"MATCH", pattern, b"COUNT", 1000)])
+            if replies is None:
+                return invalidated
+
+            cursor, keys = replies[0]
+            item_keys = [key for key in keys if not key.startswith(index_prefix)]
+            index_keys = [key for key in keys if key.startswith(index_prefix)]
+            commands: List[Command] = [(b"DEL", *item_keys)] if item_keys else []
+            if index_keys:
+                commands.append((b"DEL", *index_keys))
+            replies = self._execute(commands) if commands else None
+            if replies is not None and item_keys:
+                invalidated += replies[0]
+            if cursor == b"0":
+                return invalidated
+
+    def _index_commands(self, item: CacheItem, lifetime: int) -> List[Command]:
+        now = int(time.time() * 1000)
+        score = str(now + lifetime) if lifetime > 0 else "+inf"
+
+        return [
+            (b"EVALSHA", _INDEX_SCRIPT_SHA, 1, index_key, item.id, score, now) for index_key in self._index_keys(item)
+        ]
+
+    def _index_keys(self, item: CacheItem) -> List[str]:
+        index_keys = [self._tag_key(tag) for tag in item.tags]
+        # Root path is skipped, its index would hold every item and be trimmed on every write.
+        if item.path:
+            index_keys.extend(self._path_key(path) for path in path_prefixes(item.path)[1:])
+
+        return index_keys
+
+    # Indexes were kept in plain sets under `#tag:` and `#path:` keys before, sorted sets use new keys.
+    def _tag_key(self, tag: str) -> str:
+        return f"{self.prefix}#tags:{tag}"
+
+    def _path_key(self, path: str) -> str:
+        return f"{self.prefix}#paths:{path}"
+
+    def _execute(self, commands: List[Command]) -> Optional[List[Any]]:
+        try:
+            with self.pool.connection() as connection:
+                try:
+                    return connection.execute(commands)
+                except CacheError as error:
+                    # Server lost its script cache (e.g. it was restarted), scripts are loaded and all commands
+                    # are sent again, none of them changes the outcome when repeated.
+                    if "NOSCRIPT" not in str(error):
+                        raise
+                    connection.execute([(b"SCRIPT", b"LOAD", script) for script in (_TOUCH_SCRIPT, _INDEX_SCRIPT)])
+                    return connection.execute(commands)
+        except (OSError, ValueError, CacheError):
+            self.failures += 1
+            return None
@@ -0,0 +1,126 @@
+import asyncio
+import threading
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+__all__ = ["SingleFlight", "AsyncSingleFlight"]
+
+T = TypeVar("T")
+
+
+class _Call(Generic[T]):
+    __slots__ = ("done", "result", "error", "waiting")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[T] = None
+        self.error: Optional[BaseException] = None
+        self.waiting = 0
+
+
+class _LeaderCancelled(Exception):
+    """
+    Set on the shared future, when the task computing the result was cancelled.
+    """
+
+
+class SingleFlight(Generic[T]):
+    """
+    Makes sure only one call for the given key is in progress at a time, concurrent callers wait for its result
+    instead of calling the function themselves. Callers that waited longer than `timeout` seconds give up
+    waiting and call the function on their own.
+
+    `do` returns the result and a flag telling whether the result was shared with another caller.
+    When the call fails, the error is raised in all waiting callers.
+    """
+
+    def __init__(self, timeout: Optional[float] = 5.0):
+        self.timeout = timeout
+        self._calls: Dict[Hashable, _Call[T]] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> Tuple[T, bool]:
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                call.waiting += 1
+                leader = False
+
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as error:
+                call.error = error
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+            return call.result, False
+
+        if not call.done.wait(self.timeout):
+            return fn(), False
+
+        if call.error is not None:
+            raise call.error
+
+        return call.result, True  # type: ignore
+
+    def waiting(self, key: Hashable) -> int:
+        with self._lock:
+            call = self._calls.get(key)
+            return call.waiting if call is not None else 0
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+class AsyncSingleFlight(Generic[T]):
+    """
+    Asyncio counterpart of `SingleFlight`, an instance must be used within a single event loop. When the task
+    computing the result is cancelled, waiting tasks are not, they start over and one of them calls the function.
+    """
+
+    def __init__(self, timeout: Optional[float] = 5.0):
+        self.timeout = timeout
+        self._calls: Dict[Hashable, "asyncio.Future[T]"] = {}
+        self._waiting: Dict[Hashable, int] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> Tuple[T, bool]:
+        future = self._calls.get(key)
+        if future is None:
+            future = self._calls[key] = asyncio.get_running_loop().create_future()
+            try:
+                result = await fn()
+            except asyncio.CancelledError:
+                future.set_exception(_LeaderCancelled())
+                future.exception()
+                raise
+            except BaseException as error:
+                future.set_exception(error)
+                future.exception()  # mark as retrieved, when there was no one waiting
+                raise
+            else:
+                future.set_result(result)
+            finally:
+                del self._calls[key]
+                self._waiting.pop(key, None)
+
+            return result, False
+
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout), True
+        except asyncio.TimeoutError:
+            return await fn(), False
+        except _LeaderCancelled:
+            return await self.do(key, fn)
+
+    def waiting(self, key: Hashable) -> int:
+        return self._waiting.get(key, 0)
+
+    def __len__(self) -> int:
+        return len(self._calls)
@@ -0,0 +1,140 @@
+import threading
+from typing import Dict, Iterable, Optional
+
+from chocs_middleware.cache.cache_storage import (
+    BoundedInMemoryCacheStorage,
+    CacheItem,
+    IBatchCollectableCacheStorage,
+    ICacheStorage,
+    ICollectableCacheStorage,
+    ITouchableCacheStorage,
+    collect_many,
+    get_many,
+    set_many,
+)
+from chocs_middleware.cache.error import CacheError
+from chocs_middleware.cache.eviction import IEvictionPolicy
+from chocs_middleware.cache.invalidation import IInvalidatableCacheStorage
+
+__all__ = ["TieredCacheStorage"]
+
+
+class TieredCacheStorage(IBatchCollectableCacheStorage, ITouchableCacheStorage, IInvalidatableCacheStorage):
+    """
+    Serves hot items from a small bounded in-process storage (L1) placed in front of any other storage (L2),
+    e.g. one shared between processes. Items missing in L1 are read through from L2, writes and collects go
+    to both tiers. Items are kept in L1 for at most `l1_max_age` seconds, which bounds how long a process may
+    serve an item changed (or collected) by another process. Invalidations reach L1 of the current process only.
+    """
+
+    def __init__(
+        self,
+        l2: ICacheStorage,
+        l1_max_items: int = 1024,
+        l1_max_bytes: int = 0,
+        l1_max_age: float = 5.0,
+        l1_eviction_policy: Optional[IEvictionPolicy] = None,
+    ):
+        self.l1 = BoundedInMemoryCacheStorage(
+            l1_max_items, l1_max_bytes, eviction_policy=l1_eviction_policy, max_age=l1_max_age
+        )
+        self.l2 = l2
+        self.l2_hits = 0
+        self.l2_misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, item_id: str) -> CacheItem:
+        with self._lock:
+            try:
+                return self.l1.get(item_id)
+            except CacheError:
+                ...  # read through
+
+        try:
+            item = self.l2.get(item_id)
+        except CacheError:
+            self.l2_misses += 1
+            raise
+
+        self.l2_hits += 1
+        with self._lock:
+            self.l1.set(item)
+
+        return item
+
+    def set(self, item: CacheItem) -> None:
+        self.l2.set(item)
+        with self._lock:
+            self.l1.set(item)
+
+    def collect(self, item: CacheItem) -> None:
+        if isinstance(self.l2, ICollectableCacheStorage):
+            self.l2.collect(item)
+        with self._lock:
+            self.l1.collect(item)
+
+    def get_many(self, item_ids: Iterable[str]) -> Dict[str, CacheItem]:
+        """
+        Items missing in L1 are read through from L2 with a single batch.
+        """
+        item_ids = list(item_ids)
+        with self._lock:
+            items = self.l1.get_many(item_ids)
+
+        missing = [item_id for item_id in item_ids if item_id not in items]
+        if not missing:
+            return items
+
+        found = get_many(self.l2, missing)
+        self.l2_hits += len(found)
+        self.l2_misses += len(missing) - len(found)
+        with self._lock:
+            self.l1.set_many(found.values())
+        items.update(found)
+
+        return items
+
+    def set_many(self, items: Iterable[CacheItem]) -> None:
+        items = list(items)
+        set_many(self.l2, items)
+        with self._lock:
+            self.l1.set_many(items)
+
+    def collect_many(self, items: Iterable[CacheItem]) -> None:
+        items = list(items)
+        if isinstance(self.l2, ICollectableCacheStorage):
+            collect_many(self.l2, items)
+        with self._lock:
+            self.l1.collect_many(items)
+
+    def touch(self, items: Iterable[CacheItem]) -> int:
+        """
+        Touches items in both tiers, when L2 cannot touch items none are touched (so they are stored again).
+        """
+        if not isinstance(self.l2, ITouchableCacheStorage):
+            return 0
+
+        items = list(items)
+        touched = self.l2.touch(items)
+        with self._lock:
+            self.l1.touch(items)
+
+        return touched
+
+    def invalidate_tag(self, tag: str) -> int:
+        invalidated = self.l2.invalidate_tag(tag) if isinstance(self.l2, IInvalidatableCacheStorage) else 0
+        with self._lock:
+            return max(invalidated, self.l1.invalidate_tag(tag))
+
+    def invalidate_prefix(self, path_prefix: str) -> int:
+        invalidated = self.l2.invalidate_prefix(path_prefix) if isinstance(self.l2, IInvalidatableCacheStorage) else 0
+        with self._lock:
+            return max(invalidated, self.l1.invalidate_prefix(path_prefix))
+
+    @property
+    def l1_hits(self) -> int:
+        return self.l1.hits
+
+    @property
+    def l1_misses(self) -> int:
+        return self.l1.misses
@@ -0,0 +1,131 @@
+import hashlib
+import socketserver
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import pytest
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    """
+    Speaks just enough of the Redis protocol to exercise `RedisCacheStorage`.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _FakeRedisHandler)
+        self.data: Dict[bytes, Tuple[bytes, Optional[float]]] = {}
+        self.sorted_sets: Dict[bytes, Dict[bytes, float]] = {}
+        self.scripts: Dict[bytes, bytes] = {}
+        self.commands: List[List[bytes]] = []
+        self.delay = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def expires_in(self, key: bytes) -> Optional[float]:
+        expires = self.data[key][1]
+        return None if expires is None else expires - time.time()
+
+    def execute(self, command: List[bytes]) -> bytes:
+        name = command[0].upper()
+        with self.lock:
+            self.commands.append(command)
+            if name == b"PING":
+                return b"+PONG\r\n"
+            if name == b"SET":
+                expires = time.time() + int(command[4]) / 1000 if len(command) > 4 else None
+                self.data[command[1]] = (command[2], expires)
+                return b"+OK\r\n"
+            if name == b"MGET":
+                values = [self._get(key) for key in command[1:]]
+                return b"*%d\r\n" % len(values) + b"".join(self._bulk(value) for value in values)
+            if name == b"GET":
+                return self._bulk(self._get(command[1]))
+            if name == b"DEL":
+                deleted = sum(1 for key in command[1:] if self.data.pop(key, None) is not None)
+                deleted += sum(1 for key in command[1:] if self.sorted_sets.pop(key, None) is not None)
+                return b":%d\r\n" % deleted
+            if name == b"ZREM":
+                members = self.sorted_sets.get(command[1], {})
+                removed = sum(1 for member in command[2:] if members.pop(member, None) is not None)
+                return b":%d\r\n" % removed
+            if name == b"ZRANGE":
+                members = self.sorted_sets.get(command[1], {})
+                values = sorted(members, key=lambda member: (members[member], member))
+                return b"*%d\r\n" % len(values) + b"".join(self._bulk(value) for value in values)
+            if name == b"SCAN":
+                # Single batch holding all keys matching `<prefix>*` pattern
+                prefix = command[3][:-1].replace(b"\\", b"")
+                keys = [key for key in [*self.data, *self.sorted_sets] if key.startswith(prefix)]
+                return b"*2\r\n" + self._bulk(b"0") + b"*%d\r\n" % len(keys) + b"".join(map(self._bulk, keys))
+            if name == b"SCRIPT" and command[1].upper() == b"LOAD":
+                sha = hashlib.sha1(command[2]).hexdigest().encode()
+                self.scripts[sha] = command[2]
+                return self._bulk(sha)
+            if name == b"EVALSHA":
+                if command[1] not in self.scripts:
+                    return b"-NOSCRIPT No matching script. Please use EVAL.\r\n"
+                command = [b"EVAL", self.scripts[command[1]], *command[2:]]
+                name = b"EVAL"
+            if name == b"EVAL" and b"ZADD" in command[1]:
+                # Index script: key, item id, score (expiry time), current time; expired ids are dropped
+                members = self.sorted_sets.setdefault(command[3], {})
+                for member in [member for member, score in members.items() if score < float(command[6])]:
+                    del members[member]
+                members[command[4]] = float(command[5])
+                return b":1\r\n"
+            if name == b"EVAL":
+                # Touch script: key, metadata (at offset 1), lifetime
+                value = self._get(command[3])
+                if value is None:
+                    return b":0\r\n"
+                metadata, lifetime = command[4], int(command[5])
+                expires = time.time() + lifetime / 1000 if lifetime > 0 else None
+                self.data[command[3]] = (value[:1] + metadata + value[1 + len(metadata) :], expires)
+                return b":1\r\n"
+
+        return b"-ERR unknown command\r\n"
+
+    def _get(self, key: bytes) -> Optional[bytes]:
+        value, expires = self.data.get(key, (None, None))
+        if expires is not None and expires < time.time():
+            del self.data[key]
+            return None
+        return value
+
+    @staticmethod
+    def _bulk(value: Optional[bytes]) -> bytes:
+        return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+class _FakeRedisHandler(socketserver.StreamRequestHandler):
+    server: FakeRedisServer
+
+    def handle(self) -> None:
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = []
+            for _ in range(int(line[1:])):
+                size = int(self.rfile.readline()[1:])
+                command.append(self.rfile.read(size + 2)[:-2])
+            if self.server.delay:
+                time.sleep(self.server.delay)
+            self.wfile.write(self.server.execute(command))
+
+
+@pytest.fixture
+def redis_server() -> Iterator[FakeRedisServer]:
+    server = FakeRedisServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
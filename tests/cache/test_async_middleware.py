@@ -0,0 +1,243 @@
+import asyncio
+import time
+from typing import Any, Dict, Optional
+
+import pytest
+
+from chocs import HttpMethod, HttpRequest, HttpResponse, HttpStatus, Route
+
+from chocs_middleware.cache import (
+    AsyncInMemoryCacheStorage,
+    CacheError,
+    CacheItem,
+    CacheMiddleware,
+    IAsyncCacheStorage,
+    IAsyncCollectableCacheStorage,
+    InMemoryCacheStorage,
+)
+
+
+def create_request(method: HttpMethod, headers: Optional[Dict[str, str]] = None, **attributes: Any) -> HttpRequest:
+    request = HttpRequest(method, "/test", headers=headers)
+    request.route = Route("/test", attributes)
+    return request
+
+
+def test_async_storage_implements_protocols() -> None:
+    # given
+    cache = AsyncInMemoryCacheStorage()
+
+    # then
+    assert isinstance(cache, IAsyncCacheStorage)
+    assert isinstance(cache, IAsyncCollectableCacheStorage)
+
+
+def test_async_storage_can_handle_batches() -> None:
+    # given
+    cache = AsyncInMemoryCacheStorage()
+
+    async def run() -> Dict[str, CacheItem]:
+        await cache.set_many([CacheItem("a", b"1"), CacheItem("b", b"2"), CacheItem("c", b"3")])
+        await cache.collect_many([CacheItem("c", b"")])
+        return await cache.get_many(["a", "b", "c", "d"])
+
+    # when
+    items = asyncio.run(run())
+
+    # then
+    assert sorted(items) == ["a", "b"]
+    assert items["a"].body == b"1"
+    assert len(cache) == 2
+
+
+def test_can_use_simple_caching_strategy_in_async_handler() -> None:
+    # given
+    middleware = CacheMiddleware(AsyncInMemoryCacheStorage())
+    controller_call_count = 0
+
+    async def next(request: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        return HttpResponse("test", headers={"test": "ok"})
+
+    async def run() -> HttpResponse:
+        await middleware.handle_async(create_request(HttpMethod.GET, cache_expiry=10), next)
+        return await middleware.handle_async(create_request(HttpMethod.GET, cache_expiry=10), next)
+
+    # when
+    response = asyncio.run(run())
+
+    # then
+    assert controller_call_count == 1
+    assert str(response) == "test"
+    assert response.headers["cache-control"] == "max-age=10"
+
+
+def test_can_use_sync_storage_in_async_handler() -> None:
+    # given
+    cache = InMemoryCacheStorage()
+    middleware = CacheMiddleware(cache)
+
+    async def next(request: HttpRequest) -> HttpResponse:
+        return HttpResponse("test")
+
+    # when
+    asyncio.run(middleware.handle_async(create_request(HttpMethod.GET, cache_expiry=10), next))
+
+    # then
+    assert len(cache) == 1
+
+
+def test_fail_using_async_storage_in_sync_handler() -> None:
+    # given
+    middleware = CacheMiddleware(AsyncInMemoryCacheStorage())
+
+    # then
+    with pytest.raises(CacheError):
+        middleware.handle(create_request(HttpMethod.GET, cache_expiry=10), lambda request: HttpResponse("test"))
+
+
+def test_can_use_etag_based_cache_in_async_handler() -> None:
+    # given
+    middleware = CacheMiddleware(AsyncInMemoryCacheStorage())
+
+    async def next(request: HttpRequest) -> HttpResponse:
+        return HttpResponse("test", headers={"etag": '"1"'})
+
+    async def run() -> HttpResponse:
+        await middleware.handle_async(create_request(HttpMethod.GET, cache_expiry=10), next)
+        return await middleware.handle_async(create_request(HttpMethod.GET, {"etag": '"1"'}, cache_expiry=10), next)
+
+    # when
+    response = asyncio.run(run())
+
+    # then
+    assert response.status_code == HttpStatus.NOT_MODIFIED
+
+
+@pytest.mark.parametrize(
+    "method,expected_status",
+    [
+        (HttpMethod.GET, HttpStatus.OK),
+        (HttpMethod.POST, HttpStatus.PRECONDITION_FAILED),
+    ],
+)
+def test_can_handle_if_none_match_in_async_handler(method: HttpMethod, expected_status: HttpStatus) -> None:
+    # given
+    cache = AsyncInMemoryCacheStorage()
+    middleware = CacheMiddleware(cache)
+
+    async def next(request: HttpRequest) -> HttpResponse:
+        return HttpResponse("test", headers={"etag": '"existing_etag"'})
+
+    async def run() -> HttpResponse:
+        await middleware.handle_async(create_request(HttpMethod.GET, cache=True), next)
+        return await middleware.handle_async(create_request(method, {"if-none-match": "existing_etag"}, cache=True), next)
+
+    # when
+    response = asyncio.run(run())
+
+    # then
+    assert response.status_code == expected_status
+
+
+@pytest.mark.parametrize(
+    "if_match,expected_status",
+    [
+        ("etag", HttpStatus.OK),
+        ("missing", HttpStatus.PRECONDITION_FAILED),
+    ],
+)
+def test_can_handle_if_match_in_async_handler(if_match: str, expected_status: HttpStatus) -> None:
+    # given
+    cache = AsyncInMemoryCacheStorage()
+    middleware = CacheMiddleware(cache)
+
+    async def next(request: HttpRequest) -> HttpResponse:
+        return HttpResponse("test", headers={"etag": '"etag"'})
+
+    async def run() -> HttpResponse:
+        await middleware.handle_async(create_request(HttpMethod.GET, cache=True), next)
+        return await middleware.handle_async(create_request(HttpMethod.PUT, {"if-match": if_match}, cache=True), next)
+
+    # when
+    response = asyncio.run(run())
+
+    # then
+    assert response.status_code == expected_status
+
+
+def test_can_collect_cache_in_async_handler() -> None:
+    # given
+    cache = AsyncInMemoryCacheStorage()
+    middleware = CacheMiddleware(cache)
+
+    async def next(request: HttpRequest) -> HttpResponse:
+        return HttpResponse("test", headers={"etag": "1"})
+
+    async def run() -> None:
+        await middleware.handle_async(create_request(HttpMethod.GET, cache_expiry=10), next)
+        await middleware.handle_async(create_request(HttpMethod.DELETE, {"etag": "1"}, cache_expiry=10), next)
+
+    # when
+    asyncio.run(run())
+
+    # then
+    assert cache.is_empty
+
+
+def test_can_coalesce_requests_in_async_handler() -> None:
+    # given
+    middleware = CacheMiddleware(AsyncInMemoryCacheStorage(), coalesce_timeout=5.0)
+    controller_call_count = 0
+
+    async def next(request: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        await asyncio.sleep(0.05)
+        return HttpResponse("test")
+
+    async def run() -> Any:
+        return await asyncio.gather(
+            *[middleware.handle_async(create_request(HttpMethod.GET, cache_expiry=10), next) for _ in range(10)]
+        )
+
+    # when
+    responses = asyncio.run(run())
+
+    # then
+    assert controller_call_count == 1
+    assert [str(response) for response in responses] == ["test"] * 10
+
+
+def test_can_serve_stale_while_revalidating_in_async_handler() -> None:
+    # given
+    cache = AsyncInMemoryCacheStorage()
+    middleware = CacheMiddleware(cache)
+    controller_call_count = 0
+
+    async def next(request: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        return HttpResponse(f"test {controller_call_count}")
+
+    def create() -> HttpRequest:
+        return create_request(HttpMethod.GET, cache_expiry=10, cache_stale_while_revalidate=30)
+
+    async def run() -> HttpResponse:
+        await middleware.handle_async(create(), next)
+        for item_id in list(cache._storage._cache):
+            (await cache.get(item_id))._expires = time.time() - 5
+
+        stale_response = await middleware.handle_async(create(), next)
+        await asyncio.sleep(0.01)
+        assert str(stale_response) == "test 1"
+
+        return await middleware.handle_async(create(), next)
+
+    # when
+    response = asyncio.run(run())
+
+    # then
+    assert controller_call_count == 2
+    assert str(response) == "test 2"
@@ -1,7 +1,15 @@
+import threading
+from datetime import datetime
+
 import pytest
 
+from chocs import HttpMethod, HttpRequest
+
 from chocs_middleware.cache import InMemoryCacheStorage, CollectableInMemoryCacheStorage, ICacheStorage, CacheItem, \
-    CacheError
+    CacheError, BoundedInMemoryCacheStorage, ICollectableCacheStorage, LFUEvictionPolicy, SIEVEEvictionPolicy, \
+    ShardedInMemoryCacheStorage, IBatchCacheStorage, ITouchableCacheStorage
+from chocs_middleware.cache.cache_storage import collect_many, generate_cache_id, get_many, normalize_query_string, \
+    set_many
 
 
 def test_can_instantiate() -> None:
@@ -68,3 +76,316 @@ def test_can_delete_item() -> None:
         instance.get(item.id)
 
     assert instance.is_empty
+
+
+def test_can_instantiate_bounded_storage() -> None:
+    # given
+    instance = BoundedInMemoryCacheStorage(max_items=10)
+
+    # then
+    assert isinstance(instance, ICollectableCacheStorage)
+    assert instance.is_empty
+
+    with pytest.raises(ValueError):
+        BoundedInMemoryCacheStorage(max_items=0, max_bytes=0)
+
+
+def test_bounded_storage_evicts_by_item_count() -> None:
+    # given
+    instance = BoundedInMemoryCacheStorage(max_items=2)
+
+    # when
+    instance.set(CacheItem("1", b"a"))
+    instance.set(CacheItem("2", b"b"))
+    instance.get("1")
+    instance.set(CacheItem("3", b"c"))
+
+    # then
+    assert len(instance) == 2
+    assert instance.evictions == 1
+    assert instance.get("1")
+    with pytest.raises(CacheError):
+        instance.get("2")
+    assert instance.hits == 2
+    assert instance.misses == 1
+
+
+def test_bounded_storage_evicts_by_total_bytes() -> None:
+    # given
+    instance = BoundedInMemoryCacheStorage(max_items=0, max_bytes=10)
+
+    # when
+    instance.set(CacheItem("1", b"1234"))
+    instance.set(CacheItem("2", b"1234"))
+    instance.set(CacheItem("1", b"12345"))
+
+    # then
+    assert instance.total_bytes == 9
+    assert instance.evictions == 0
+
+    # when
+    instance.set(CacheItem("3", b"1234"))
+
+    # then
+    assert instance.total_bytes == 9
+    assert instance.evictions == 1
+    with pytest.raises(CacheError):
+        instance.get("2")
+
+
+def test_bounded_storage_skips_items_exceeding_byte_limit() -> None:
+    # given
+    instance = BoundedInMemoryCacheStorage(max_bytes=4)
+    instance.set(CacheItem("1", b"1234"))
+
+    # when
+    instance.set(CacheItem("1", b"12345"))
+
+    # then
+    assert instance.is_empty
+    assert instance.total_bytes == 0
+    assert instance.evictions == 0
+
+
+@pytest.mark.parametrize("policy", [LFUEvictionPolicy(), SIEVEEvictionPolicy()])
+def test_bounded_storage_uses_eviction_policy(policy) -> None:
+    # given
+    instance = BoundedInMemoryCacheStorage(max_items=2, eviction_policy=policy)
+
+    # when
+    instance.set(CacheItem("1", b"a"))
+    instance.set(CacheItem("2", b"b"))
+    instance.get("1")
+    instance.set(CacheItem("3", b"c"))
+
+    # then
+    assert instance.get("1")
+    assert instance.get("3")
+    assert instance.evictions == 1
+
+
+def test_bounded_storage_can_collect_item() -> None:
+    # given
+    instance = BoundedInMemoryCacheStorage(max_items=2)
+    item = CacheItem("1", b"abc")
+    instance.set(item)
+
+    # when
+    instance.collect(item)
+    instance.collect(item)
+
+    # then
+    assert instance.is_empty
+    assert instance.total_bytes == 0
+
+
+def test_bounded_storage_drops_items_held_longer_than_max_age() -> None:
+    # given
+    instance = BoundedInMemoryCacheStorage(max_items=10, max_age=5)
+    instance.set(CacheItem("1", b"test", 60))
+    instance.set(CacheItem("2", b"test", 60))
+
+    # when
+    instance._stored_at["1"] -= 10
+
+    # then
+    with pytest.raises(CacheError):
+        instance.get("1")
+    assert instance.get("2")
+    assert len(instance) == 1
+
+
+def test_sharded_storage_spreads_items_across_shards() -> None:
+    # given
+    instance = ShardedInMemoryCacheStorage(shards=4)
+
+    # when
+    for i in range(100):
+        instance.set(CacheItem(f"item-{i}", b"test"))
+    instance.collect(CacheItem("item-0", b""))
+    instance.collect(CacheItem("missing", b""))
+
+    # then
+    assert isinstance(instance, ICollectableCacheStorage)
+    assert len(instance) == 99
+    assert all(len(shard) > 0 for shard in instance.shards)
+    assert instance.get("item-1").body == b"test"
+    with pytest.raises(CacheError):
+        instance.get("item-0")
+
+
+def test_sharded_storage_can_use_bounded_shards() -> None:
+    # given
+    instance = ShardedInMemoryCacheStorage(shards=2, shard_factory=lambda: BoundedInMemoryCacheStorage(max_items=5))
+
+    # when
+    for i in range(100):
+        instance.set(CacheItem(f"item-{i}", b"test"))
+
+    # then
+    assert len(instance) == 10
+
+
+def test_sharded_storage_can_be_used_by_many_threads() -> None:
+    # given
+    instance = ShardedInMemoryCacheStorage(shards=8)
+    errors = []
+
+    def work(thread_id: int) -> None:
+        try:
+            for i in range(500):
+                item = CacheItem(f"item-{i % 50}", f"{thread_id}".encode())
+                instance.set(item)
+                instance.collect(item)
+                instance.set(item)
+                try:
+                    instance.get(item.id)
+                except CacheError:
+                    ...  # collected by another thread
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=work, args=(thread_id,)) for thread_id in range(8)]
+
+    # when
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # then
+    assert errors == []
+    assert len(instance) <= 50
+
+
+def test_sharded_storage_can_store_get_and_collect_many_items() -> None:
+    # given
+    instance = ShardedInMemoryCacheStorage(shards=4)
+
+    # when
+    instance.set_many(CacheItem(str(i), b"test") for i in range(20))
+    items = instance.get_many(["1", "5", "missing", "19"])
+    instance.collect_many([CacheItem("1", b""), CacheItem("5", b"")])
+
+    # then
+    assert sorted(items) == ["1", "19", "5"]
+    assert len(instance) == 18
+    assert sum(len(shard) for shard in instance.shards) == 18
+
+
+@pytest.mark.parametrize(
+    "instance", [InMemoryCacheStorage(), BoundedInMemoryCacheStorage(), ShardedInMemoryCacheStorage(shards=4)]
+)
+def test_can_touch_items(instance: ITouchableCacheStorage) -> None:
+    # given
+    instance.set(CacheItem("1", b"test", -10, ("users",), "/users/1"))
+    refreshed = CacheItem("1", b"", 20)
+
+    # when
+    touched = instance.touch([refreshed, CacheItem("missing", b"")])
+    stored = instance.get("1")
+
+    # then
+    assert isinstance(instance, ITouchableCacheStorage)
+    assert touched == 1
+    assert not stored.is_expired
+    assert stored.body == b"test"
+    assert stored.ttl == 20
+    assert stored.updated_timestamp == refreshed.updated_timestamp
+    assert stored.expires_timestamp == refreshed.expires_timestamp
+    assert stored.tags == ("users",)
+    assert stored.path == "/users/1"
+
+
+def test_batch_functions_fall_back_to_single_item_calls() -> None:
+    # given
+    class SingleItemStorage(ICollectableCacheStorage):
+        def __init__(self):
+            self.items = {}
+
+        def get(self, item_id: str) -> CacheItem:
+            if item_id not in self.items:
+                raise CacheError.for_not_found(item_id)
+            return self.items[item_id]
+
+        def set(self, item: CacheItem) -> None:
+            self.items[item.id] = item
+
+        def collect(self, item: CacheItem) -> None:
+            self.items.pop(item.id, None)
+
+    instance = SingleItemStorage()
+
+    # when
+    set_many(instance, [CacheItem("1", b"one"), CacheItem("2", b"two"), CacheItem("3", b"three")])
+    collect_many(instance, [CacheItem("2", b"")])
+    items = get_many(instance, ["1", "2", "3"])
+
+    # then
+    assert not isinstance(instance, IBatchCacheStorage)
+    assert isinstance(InMemoryCacheStorage(), IBatchCacheStorage)
+    assert {item_id: item.body for item_id, item in items.items()} == {"1": b"one", "3": b"three"}
+
+
+def test_cache_item_builds_datetimes_from_timestamps() -> None:
+    # given
+    item = CacheItem("1", b"test", 10)
+
+    # then
+    assert not hasattr(item, "__dict__")
+    assert not item.is_expired
+    assert item.age == 0
+    assert item.created_at == item.updated_at
+    assert (item.expires_at - item.updated_at).total_seconds() == pytest.approx(10)
+    assert abs((datetime.utcnow() - item.updated_at).total_seconds()) < 1
+    assert item.expires_timestamp == pytest.approx(item.updated_timestamp + 10)
+
+
+def test_cache_item_updates_timestamps_on_body_change() -> None:
+    # given
+    item = CacheItem("1", b"test", -10)
+    created_at = item.created_timestamp
+
+    # when
+    item.ttl = 20
+    item.body = b"updated"
+
+    # then
+    assert not item.is_expired
+    assert item.created_timestamp == created_at
+    assert item.expires_timestamp == pytest.approx(item.updated_timestamp + 20)
+
+
+@pytest.mark.parametrize(
+    "query_string,expected",
+    [
+        ("", ""),
+        ("a=1", "a=1"),
+        ("b=2&a=1", "a=1&b=2"),
+        ("b=2&a=1&a=0&&c", "a=1&a=0&b=2&c"),
+    ],
+)
+def test_can_normalize_query_string(query_string: str, expected: str) -> None:
+    assert normalize_query_string(query_string) == expected
+
+
+def test_generate_cache_id_ignores_query_parameters_order() -> None:
+    # given
+    request = HttpRequest(HttpMethod.GET, "/test", query_string="b=2&a=1")
+    reordered_request = HttpRequest(HttpMethod.GET, "/test", query_string="a=1&b=2")
+
+    # then
+    assert generate_cache_id(request) == generate_cache_id(reordered_request)
+    assert generate_cache_id(request, normalize_query=False) != generate_cache_id(reordered_request, normalize_query=False)
+
+
+def test_generate_cache_id_separates_header_values() -> None:
+    # given
+    request = HttpRequest(HttpMethod.GET, "/test", headers={"accept": "ab"})
+    other_request = HttpRequest(HttpMethod.GET, "/test", headers={"accept": "a", "accept-language": "b"})
+
+    # then
+    assert generate_cache_id(request) != generate_cache_id(other_request)
+    assert generate_cache_id(request, ("Accept ",)) == generate_cache_id(request, ("accept",))
+    assert len(generate_cache_id(request)) == 32
+    assert len(generate_cache_id(request, digest_size=8)) == 16
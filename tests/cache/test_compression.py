@@ -0,0 +1,72 @@
+import pytest
+from chocs import HttpResponse
+
+from chocs_middleware.cache import CacheError, CompressionPolicy, GzipCodec, ICompressionCodec, LzmaCodec, ZlibCodec, \
+    register_codec
+from chocs_middleware.cache.compression import get_codec
+
+
+@pytest.mark.parametrize("codec", [ZlibCodec(), GzipCodec(), LzmaCodec()])
+def test_can_compress_and_decompress(codec: ICompressionCodec) -> None:
+    # given
+    data = b"test data " * 100
+
+    # when
+    compressed = codec.compress(memoryview(data))
+
+    # then
+    assert isinstance(codec, ICompressionCodec)
+    assert len(compressed) < len(data)
+    assert codec.decompress(compressed) == data
+    assert isinstance(get_codec(codec.codec_id), type(codec))
+
+
+def test_can_register_custom_codec() -> None:
+    # given
+    class ReversedCodec(ICompressionCodec):
+        codec_id = 200
+        content_encoding = None
+
+        def compress(self, data):  # type: ignore
+            return bytes(data)[::-1]
+
+        def decompress(self, data):  # type: ignore
+            return bytes(data)[::-1]
+
+    codec = ReversedCodec()
+
+    # when
+    register_codec(codec)
+
+    # then
+    assert get_codec(200) is codec
+    with pytest.raises(ValueError):
+        register_codec(type("InvalidCodec", (ReversedCodec,), {"codec_id": 0})())
+
+
+def test_fail_to_get_unknown_codec() -> None:
+    # then
+    with pytest.raises(CacheError):
+        get_codec(255)
+
+
+@pytest.mark.parametrize("headers, size, expected", [
+    [{"content-type": "application/json"}, 2048, GzipCodec],
+    [{"content-type": "text/html; charset=utf-8"}, 2048, GzipCodec],
+    [{"content-type": "application/json"}, 100, None],
+    [{"content-type": "image/png"}, 2048, None],
+    [{"content-type": "application/json", "content-encoding": "br"}, 2048, None],
+    [{"content-type": "application/x-ndjson"}, 2048, LzmaCodec],
+])
+def test_can_select_codec(headers: dict, size: int, expected: type) -> None:
+    # given
+    policy = CompressionPolicy(min_size=1024, codecs={"application/x-ndjson": LzmaCodec()})
+
+    # when
+    codec = policy.select_codec(HttpResponse(headers=headers), size)
+
+    # then
+    if expected is None:
+        assert codec is None
+    else:
+        assert isinstance(codec, expected)
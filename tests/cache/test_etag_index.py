@@ -0,0 +1,90 @@
+from typing import List
+
+import pytest
+
+from chocs_middleware.cache import CacheItem
+from chocs_middleware.cache.etag_index import create_etag_index_item, etag_index_id, etag_index_ids, matches_etags, \
+    parse_etags
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        ('"1"', ['"1"']),
+        ('"1", W/"2",  "3,4"', ['"1"', 'W/"2"', '"3,4"']),
+        ("*", ["*"]),
+        ("legacy-etag", ["legacy-etag"]),
+        ("", []),
+    ],
+)
+def test_can_parse_etags(value: str, expected: List[str]) -> None:
+    assert parse_etags(value) == expected
+
+
+def test_can_create_index_item() -> None:
+    # given
+    cache_item = CacheItem("cache-id", b"payload", 10, ("users",), "/users/1")
+
+    # when
+    index_item = create_etag_index_item(cache_item, 'W/"1"', "resource-id")
+
+    # then
+    assert index_item.id == etag_index_id("resource-id", "1") == "resource-id#etag:1"
+    assert index_item.updated_timestamp == cache_item.updated_timestamp
+    assert index_item.expires_timestamp == cache_item.expires_timestamp
+    assert index_item.tags == ("users",)
+    assert index_item.path == "/users/1"
+
+
+def test_looks_up_etag_with_content_coding_suffix_as_it_is_and_decoded() -> None:
+    assert etag_index_ids("resource-id", '"1"') == ("resource-id#etag:1",)
+    assert etag_index_ids("resource-id", '"1-v2"') == ("resource-id#etag:1-v2",)
+    assert etag_index_ids("resource-id", 'W/"1-gzip"') == ("resource-id#etag:1-gzip", "resource-id#etag:1")
+
+
+def test_matches_current_etags_only() -> None:
+    # given
+    cache_item = CacheItem("cache-id", b"payload", 10)
+    index_items = {
+        item.id: item
+        for item in (
+            create_etag_index_item(cache_item, '"strong"', "resource-id"),
+            create_etag_index_item(cache_item, 'W/"weak"', "resource-id"),
+        )
+    }
+    outdated_item = CacheItem.restore("cache-id", b"payload", 10, 0.0, 0.0, 10.0)
+
+    # then
+    assert matches_etags(['"other"', '"strong"'], cache_item, index_items, False, "resource-id")
+    assert matches_etags(['W/"strong"'], cache_item, index_items, True, "resource-id")
+    assert not matches_etags(['W/"strong"'], cache_item, index_items, False, "resource-id")
+    assert matches_etags(['"weak"'], cache_item, index_items, True, "resource-id")
+    assert not matches_etags(['"weak"'], cache_item, index_items, False, "resource-id")
+    assert matches_etags(["*"], cache_item, index_items, False, "resource-id")
+    assert not matches_etags(["*"], CacheItem.empty("cache-id"), index_items, False, "resource-id")
+    assert not matches_etags(['"strong"'], outdated_item, index_items, True, "resource-id")
+    assert not matches_etags(['"strong"'], cache_item, index_items, False, "other-resource-id")
+
+
+def test_matches_unexpired_index_entries_when_item_is_not_available() -> None:
+    # given
+    index_item = create_etag_index_item(CacheItem("cache-id", b"payload", 10), '"1"', "resource-id")
+    expired_index_item = create_etag_index_item(CacheItem("cache-id", b"payload", -10), '"2"', "resource-id")
+    index_items = {index_item.id: index_item, expired_index_item.id: expired_index_item}
+
+    # then
+    assert matches_etags(['"1"'], CacheItem.empty("cache-id"), index_items, False, "resource-id")
+    assert not matches_etags(['"2"'], CacheItem.empty("cache-id"), index_items, False, "resource-id")
+
+
+def test_matches_other_variants_only_when_asked_to() -> None:
+    # given
+    index_item = create_etag_index_item(CacheItem("json-variant-id", b"payload", 10), '"1"', "resource-id")
+    index_items = {index_item.id: index_item}
+    other_variant = CacheItem("xml-variant-id", b"payload", 10)
+
+    # then
+    assert not matches_etags(['"1"'], other_variant, index_items, True, "resource-id")
+    assert not matches_etags(['"1"'], CacheItem.empty("xml-variant-id"), index_items, False, "resource-id")
+    assert matches_etags(['"1"'], other_variant, index_items, False, "resource-id", any_variant=True)
+    assert matches_etags(['"1"'], CacheItem.empty("xml-variant-id"), index_items, False, "resource-id", True)
@@ -0,0 +1,138 @@
+import pytest
+
+from chocs_middleware.cache import CacheError, IEvictionPolicy, LFUEvictionPolicy, LRUEvictionPolicy, \
+    SIEVEEvictionPolicy
+
+
+@pytest.mark.parametrize("policy", [LRUEvictionPolicy(), LFUEvictionPolicy(), SIEVEEvictionPolicy()])
+def test_can_instantiate(policy: IEvictionPolicy) -> None:
+    # then
+    assert isinstance(policy, IEvictionPolicy)
+    assert len(policy) == 0
+
+
+@pytest.mark.parametrize("policy", [LRUEvictionPolicy(), LFUEvictionPolicy(), SIEVEEvictionPolicy()])
+def test_fail_to_evict_from_empty_policy(policy: IEvictionPolicy) -> None:
+    # then
+    with pytest.raises(CacheError):
+        policy.evict()
+
+
+def test_lru_evicts_least_recently_used_key() -> None:
+    # given
+    policy = LRUEvictionPolicy()
+    for key in ("a", "b", "c"):
+        policy.insert(key)
+
+    # when
+    policy.touch("a")
+
+    # then
+    assert policy.evict() == "b"
+    assert policy.evict() == "c"
+    assert policy.evict() == "a"
+    assert len(policy) == 0
+
+
+def test_lfu_evicts_least_frequently_used_key() -> None:
+    # given
+    policy = LFUEvictionPolicy()
+    for key in ("a", "b", "c"):
+        policy.insert(key)
+
+    # when
+    policy.touch("a")
+    policy.touch("a")
+    policy.touch("c")
+
+    # then
+    assert policy.frequency("a") == 3
+    assert policy.evict() == "b"
+    assert policy.evict() == "c"
+    assert policy.evict() == "a"
+
+
+def test_lfu_recovers_minimum_frequency_after_removal() -> None:
+    # given
+    policy = LFUEvictionPolicy()
+    policy.insert("a")
+    policy.insert("b")
+    policy.touch("b")
+    policy.touch("b")
+
+    # when
+    policy.remove("a")
+
+    # then
+    assert policy.evict() == "b"
+    assert len(policy) == 0
+
+
+def test_lfu_keeps_buckets_ordered_by_frequency() -> None:
+    # given
+    policy = LFUEvictionPolicy()
+    for key in ("a", "b", "c", "d"):
+        policy.insert(key)
+    for key, touches in (("a", 3), ("b", 1), ("c", 3), ("d", 2)):
+        for _ in range(touches):
+            policy.touch(key)
+
+    # when
+    policy.remove("d")
+    policy.insert("e")
+
+    # then
+    assert [policy.frequency(key) for key in ("a", "b", "c", "d", "e")] == [4, 2, 4, 0, 1]
+    assert [policy.evict() for _ in range(4)] == ["e", "b", "a", "c"]
+    assert len(policy) == 0
+
+
+def test_sieve_keeps_visited_keys() -> None:
+    # given
+    policy = SIEVEEvictionPolicy()
+    for key in ("a", "b", "c", "d"):
+        policy.insert(key)
+
+    # when
+    policy.touch("a")
+    policy.touch("c")
+
+    # then
+    assert policy.evict() == "b"
+    assert policy.evict() == "d"
+    assert policy.evict() == "a"
+    assert policy.evict() == "c"
+
+
+def test_sieve_survives_scan() -> None:
+    # given
+    policy = SIEVEEvictionPolicy()
+    policy.insert("hot")
+
+    # when
+    evicted = []
+    for index in range(10):
+        policy.touch("hot")
+        policy.insert(f"scan-{index}")
+        evicted.append(policy.evict())
+
+    # then
+    assert "hot" not in evicted
+    assert len(policy) == 1
+
+
+def test_sieve_can_remove_key_under_hand() -> None:
+    # given
+    policy = SIEVEEvictionPolicy()
+    for key in ("a", "b", "c"):
+        policy.insert(key)
+    policy.touch("a")
+    policy.touch("b")
+
+    # when
+    assert policy.evict() == "c"
+    policy.remove("a")
+
+    # then
+    assert policy.evict() == "b"
+    assert len(policy) == 0
@@ -0,0 +1,223 @@
+import threading
+import time
+
+import pytest
+
+from chocs_middleware.cache import BoundedInMemoryCacheStorage, CacheError, CacheItem, CacheReaper, \
+    CollectableInMemoryCacheStorage, ExpiryQueue, InMemoryCacheStorage, IReapableCacheStorage
+
+
+def test_can_pop_expired_ids_in_order() -> None:
+    # given
+    queue = ExpiryQueue()
+    now = time.time()
+    queue.schedule("b", now - 1)
+    queue.schedule("a", now - 2)
+    queue.schedule("c", now + 10)
+
+    # when
+    expired = queue.pop_expired(now, 10)
+
+    # then
+    assert [item_id for item_id, _ in expired] == ["a", "b"]
+    assert len(queue) == 1
+
+
+def test_can_reschedule_and_discard_ids() -> None:
+    # given
+    queue = ExpiryQueue()
+    now = time.time()
+    queue.schedule("a", now - 1)
+    queue.schedule("b", now - 1)
+
+    # when
+    queue.schedule("a", now + 10)
+    queue.discard("b")
+
+    # then
+    assert queue.pop_expired(now, 10) == []
+    assert len(queue) == 1
+
+
+def test_pop_expired_respects_limit() -> None:
+    # given
+    queue = ExpiryQueue()
+    now = time.time()
+    for index in range(10):
+        queue.schedule(str(index), now - index + 1)
+
+    # then
+    assert len(queue.pop_expired(now, 3)) == 3
+    assert len(queue) == 7
+
+
+def test_expired_items_are_kept_by_default() -> None:
+    # given
+    storage = InMemoryCacheStorage()
+    storage.set(CacheItem("1", b"test", -10))
+
+    # then
+    assert isinstance(storage, IReapableCacheStorage)
+    assert storage.get("1").is_expired
+    assert storage.reap() == 0
+
+
+@pytest.mark.parametrize("storage", [
+    InMemoryCacheStorage(expiry_grace=0),
+    CollectableInMemoryCacheStorage(expiry_grace=0),
+    BoundedInMemoryCacheStorage(max_items=10, expiry_grace=0),
+])
+def test_expired_items_are_dropped_on_read(storage: InMemoryCacheStorage) -> None:
+    # given
+    storage.set(CacheItem("1", b"test", -10))
+    storage.set(CacheItem("2", b"test", 10))
+
+    # then
+    with pytest.raises(CacheError):
+        storage.get("1")
+    assert storage.get("2")
+    assert len(storage) == 1
+
+
+def test_expired_items_are_kept_within_grace_period() -> None:
+    # given
+    storage = InMemoryCacheStorage(expiry_grace=60)
+    storage.set(CacheItem("1", b"test", -10))
+
+    # then
+    assert storage.get("1").is_expired
+    assert storage.reap() == 0
+
+
+def test_can_reap_expired_items_in_batches() -> None:
+    # given
+    storage = BoundedInMemoryCacheStorage(max_items=100, expiry_grace=0)
+    for index in range(10):
+        storage.set(CacheItem(f"expired-{index}", b"test", -10))
+    storage.set(CacheItem("fresh", b"test", 10))
+
+    # then
+    assert storage.reap(4) == 4
+    assert storage.reap(4) == 4
+    assert storage.reap(4) == 2
+    assert len(storage) == 1
+    assert storage.total_bytes == 4
+
+
+def test_reap_reschedules_refreshed_items() -> None:
+    # given
+    storage = CollectableInMemoryCacheStorage(expiry_grace=0)
+    item = CacheItem("1", b"test", -10)
+    storage.set(item)
+
+    # when
+    item.ttl = 10
+    item.body = b"refreshed"
+
+    # then
+    assert storage.reap() == 0
+    assert storage.get("1") is item
+
+    # when
+    storage.collect(item)
+
+    # then
+    assert storage.reap() == 0
+    assert storage.is_empty
+
+
+def test_can_run_reaper() -> None:
+    # given
+    storage = InMemoryCacheStorage(expiry_grace=0)
+    for index in range(5):
+        storage.set(CacheItem(str(index), b"test", -10))
+    reaper = CacheReaper(storage, batch_size=2)
+
+    # when
+    reaped = reaper.run_once()
+
+    # then
+    assert reaped == 5
+    assert reaper.reaped == 5
+    assert storage.is_empty
+
+
+def test_can_start_and_stop_reaper() -> None:
+    # given
+    storage = InMemoryCacheStorage(expiry_grace=0)
+    storage.set(CacheItem("1", b"test", -10))
+
+    # when
+    with CacheReaper(storage, interval=0.01) as reaper:
+        assert reaper.is_running
+        for _ in range(100):
+            if storage.is_empty:
+                break
+            time.sleep(0.01)
+
+    # then
+    assert storage.is_empty
+    assert not reaper.is_running
+
+
+def test_reaper_runs_alongside_request_traffic() -> None:
+    # given
+    storage = BoundedInMemoryCacheStorage(max_items=64, expiry_grace=0)
+    errors = []
+
+    def traffic(thread_id: int) -> None:
+        try:
+            for index in range(2000):
+                item_id = str((thread_id * 7 + index) % 100)
+                storage.set(CacheItem(item_id, b"x" * (index % 10 + 1), 0))
+                try:
+                    storage.get(item_id)
+                except CacheError:
+                    pass
+                storage.touch([CacheItem(item_id, b"", 0)])
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=traffic, args=(thread_id,)) for thread_id in range(4)]
+
+    # when
+    with CacheReaper(storage, interval=0.0001, batch_size=8) as reaper:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert reaper.is_running
+    time.sleep(0.01)
+    reaper.run_once()
+
+    # then
+    assert errors == []
+    assert reaper.failures == 0
+    assert storage.is_empty
+    assert storage.total_bytes == 0
+
+
+def test_reaper_keeps_running_after_failed_run() -> None:
+    # given
+    class FailingStorage:
+        calls = 0
+
+        def reap(self, limit: int = 1000) -> int:
+            self.calls += 1
+            if self.calls == 1:
+                raise RuntimeError("reap failed")
+            return 0
+
+    storage = FailingStorage()
+
+    # when
+    with CacheReaper(storage, interval=0.01) as reaper:
+        for _ in range(100):
+            if storage.calls > 1:
+                break
+            time.sleep(0.01)
+
+        # then
+        assert reaper.is_running
+        assert reaper.failures == 1
+        assert storage.calls > 1
@@ -0,0 +1,295 @@
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from chocs import Application, HttpMethod, HttpRequest, HttpResponse
+
+from chocs_middleware.cache import (
+    CacheError,
+    CacheItem,
+    CacheMiddleware,
+    FileCacheStorage,
+    IBatchCollectableCacheStorage,
+    ICollectableCacheStorage,
+    IInvalidatableCacheStorage,
+    InMemoryCacheStorage,
+    IReapableCacheStorage,
+    IStreamingCacheStorage,
+)
+
+pytestmark = pytest.mark.skipif(os.name != "posix", reason="file storage requires a POSIX system")
+
+
+def create_storage(path: Path, **kwargs) -> FileCacheStorage:
+    return FileCacheStorage(str(path / "cache.log"), **kwargs)
+
+
+def test_can_store_and_get_item(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+    item = CacheItem("1", b"test_data", 10, ("users",), "/users/1")
+
+    # when
+    instance.set(item)
+    stored = instance.get("1")
+
+    # then
+    assert isinstance(instance, ICollectableCacheStorage)
+    assert isinstance(instance, IStreamingCacheStorage)
+    assert isinstance(instance, IReapableCacheStorage)
+    assert isinstance(instance, IInvalidatableCacheStorage)
+    assert stored.body == b"test_data"
+    assert stored.ttl == 10
+    assert stored.tags == ("users",)
+    assert stored.path == "/users/1"
+    assert stored.expires_timestamp == item.expires_timestamp
+    assert len(instance) == 1
+
+
+def test_keeps_items_after_restart(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+    instance.set(CacheItem("1", b"first", 10))
+    instance.set(CacheItem("2", b"second", 10, ("tag",)))
+    instance.set(CacheItem("1", b"first, updated", 10))
+    instance.collect(CacheItem("2", b""))
+    instance.set(CacheItem("3", b"third", 10, ("tag",)))
+    instance.close()
+
+    # when
+    instance = create_storage(tmp_path)
+
+    # then
+    assert len(instance) == 2
+    assert instance.get("1").body == b"first, updated"
+    assert instance.get("3").body == b"third"
+    with pytest.raises(CacheError):
+        instance.get("2")
+    assert instance.invalidate_tag("tag") == 1
+    assert instance.dead_bytes > 0
+
+
+def test_drops_torn_records_on_load(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+    instance.set(CacheItem("1", b"first"))
+    size = instance.file_size
+    instance.set(CacheItem("2", b"second"))
+    instance.close()
+    with open(tmp_path / "cache.log", "r+b") as file:
+        file.truncate(os.path.getsize(tmp_path / "cache.log") - 3)
+
+    # when
+    instance = create_storage(tmp_path)
+    instance.set(CacheItem("3", b"third"))
+
+    # then
+    assert instance.get("1").body == b"first"
+    assert instance.get("3").body == b"third"
+    with pytest.raises(CacheError):
+        instance.get("2")
+    assert instance.file_size > size
+
+
+def test_can_store_and_get_item_in_chunks(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+    received = []
+
+    # when
+    instance.set_stream(CacheItem("1", b""), [b"a" * 100, memoryview(b"b" * 100)], 200)
+    instance.get_stream("1", lambda chunk: received.append(bytes(chunk)), 64)
+
+    # then
+    assert [len(chunk) for chunk in received] == [64, 64, 64, 8]
+    assert b"".join(received) == b"a" * 100 + b"b" * 100
+    with pytest.raises(ValueError):
+        instance.set_stream(CacheItem("2", b""), [b"a" * 100], 50)
+    assert len(instance) == 1
+    assert instance.get("1").body == b"a" * 100 + b"b" * 100
+
+
+def test_can_store_get_and_collect_many_items(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+
+    # when
+    instance.set_many([CacheItem("1", b"one"), CacheItem("2", b"two"), CacheItem("3", b"three")])
+    items = instance.get_many(["1", "3", "missing"])
+    instance.collect_many([CacheItem("1", b""), CacheItem("2", b"")])
+    instance.close()
+    instance = create_storage(tmp_path)
+
+    # then
+    assert isinstance(instance, IBatchCollectableCacheStorage)
+    assert {item_id: item.body for item_id, item in items.items()} == {"1": b"one", "3": b"three"}
+    assert instance.get_many(["1", "2", "3"]).keys() == {"3"}
+
+
+def test_can_invalidate_items(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+    instance.set(CacheItem("1", b"test", tags=("users",), path="/users/1"))
+    instance.set(CacheItem("2", b"test", tags=("users",), path="/users/2"))
+    instance.set(CacheItem("3", b"test", path="/orders/1"))
+
+    # then
+    assert instance.invalidate_prefix("/users/1") == 1
+    assert instance.invalidate_tag("users") == 1
+    assert len(instance) == 1
+    instance.close()
+    assert len(create_storage(tmp_path)) == 1
+
+
+def test_can_reap_and_skip_expired_items(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path, expiry_grace=0)
+    instance.set(CacheItem("expired", b"test", ttl=-10))
+    instance.set(CacheItem("fresh", b"test", ttl=10))
+
+    # when
+    reaped = instance.reap()
+
+    # then
+    assert reaped == 1
+    assert len(instance) == 1
+
+    # when
+    instance.set(CacheItem("expired", b"test", ttl=-10))
+    instance.close()
+    instance = create_storage(tmp_path, expiry_grace=0)
+
+    # then
+    assert len(instance) == 1
+    assert instance.get("fresh").body == b"test"
+
+
+def test_reaps_expired_items_in_batches(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path, expiry_grace=0)
+    for i in range(5):
+        instance.set(CacheItem(f"expired-{i}", b"test", ttl=-10))
+    instance.set(CacheItem("expired-0", b"test", ttl=10))
+    instance.collect(CacheItem("expired-1", b""))
+
+    # when
+    first = instance.reap(2)
+    second = instance.reap(2)
+
+    # then
+    assert (first, second) == (2, 1)
+    assert len(instance) == 1
+    assert instance.get("expired-0").body == b"test"
+
+
+def test_can_compact_file(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path, background_compaction=False)
+    for i in range(100):
+        instance.set(CacheItem(f"item-{i % 10}", b"a" * 100, tags=(f"tag-{i % 2}",)))
+    size = instance.file_size
+
+    # when
+    instance.compact()
+
+    # then
+    assert instance.file_size < size / 5
+    assert instance.dead_bytes == 0
+    assert len(instance) == 10
+    assert instance.get("item-9").body == b"a" * 100
+    assert instance.invalidate_tag("tag-1") == 5
+
+    # when
+    instance.close()
+    instance = create_storage(tmp_path)
+
+    # then
+    assert len(instance) == 5
+    assert not os.path.exists(tmp_path / "cache.log.compact")
+
+
+def test_compacts_in_background(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path, min_compaction_size=1024, compaction_threshold=0.5)
+    (tmp_path / "uncompacted").mkdir()
+    uncompacted = create_storage(tmp_path / "uncompacted", background_compaction=False)
+
+    # when
+    for i in range(200):
+        instance.set(CacheItem("item", str(i).encode() * 50))
+        uncompacted.set(CacheItem("item", str(i).encode() * 50))
+    deadline = time.time() + 5
+    while instance.file_size > uncompacted.file_size / 4 and time.time() < deadline:
+        time.sleep(0.01)
+        instance.set(CacheItem("item", b"199" * 50))
+    instance.close()
+    instance = create_storage(tmp_path)
+
+    # then
+    assert instance.file_size < uncompacted.file_size / 4
+    assert instance.get("item").body == b"199" * 50
+
+
+def test_can_warm_other_storage(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+    for i in range(5):
+        instance.set(CacheItem(f"item-{i}", f"body-{i}".encode()))
+    warm_storage = InMemoryCacheStorage()
+    limited_storage = InMemoryCacheStorage()
+
+    # when
+    copied = instance.warm(warm_storage)
+    limited = instance.warm(limited_storage, limit=2)
+
+    # then
+    assert copied == 5
+    assert warm_storage.get("item-3").body == b"body-3"
+    assert limited == 2
+    assert len(limited_storage) == 2
+
+
+def test_cannot_be_opened_twice(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+
+    # then
+    with pytest.raises(CacheError):
+        create_storage(tmp_path)
+
+    # when
+    instance.close()
+
+    # then
+    create_storage(tmp_path).close()
+    with pytest.raises(CacheError):
+        instance.get("1")
+
+
+def test_can_be_used_by_middleware_after_restart(tmp_path: Path) -> None:
+    # given
+    controller_call_count = 0
+
+    def create_app(storage: FileCacheStorage) -> Application:
+        app = Application(CacheMiddleware(storage))
+
+        @app.get("/test", cache_expiry=10)
+        def get_test(req: HttpRequest) -> HttpResponse:
+            nonlocal controller_call_count
+            controller_call_count += 1
+            return HttpResponse("test" * 1000)
+
+        return app
+
+    storage = create_storage(tmp_path)
+    create_app(storage)(HttpRequest(HttpMethod.GET, "/test"))
+    storage.close()
+
+    # when
+    response = create_app(create_storage(tmp_path))(HttpRequest(HttpMethod.GET, "/test"))
+
+    # then
+    assert controller_call_count == 1
+    assert str(response) == "test" * 1000
@@ -1,9 +1,14 @@
+import pickle
 from datetime import datetime
 
 import pytest
 from chocs import HttpResponse, HttpStatus
 
-from chocs_middleware.cache.http_support import dump_response, load_response, format_date_rfc_1123, parse_etag_value
+from chocs_middleware.cache import CacheError
+from chocs_middleware.cache.http_support import dump_response, load_response, format_date_rfc_1123, parse_etag_value, \
+    encode_response, decode_response, ResponseTemplate, read_response_record, accepts_encoding, dump_response_chunks, \
+    ResponseRecordReader, parse_range, encode_etag, decode_etag_value
+from chocs_middleware.cache.compression import GzipCodec, LzmaCodec
 
 
 @pytest.mark.parametrize("given,expected", [
@@ -51,3 +56,301 @@ def test_can_dump_and_load_response() -> None:
 
     # then
     assert response == l_response
+
+
+def test_can_dump_and_load_response_with_multi_value_headers() -> None:
+    # given
+    response = HttpResponse("żółw", status=HttpStatus.CREATED, headers={"set-cookie": ["a=1", "b=2"]})
+    response.headers["vary"] = "accept,accept-language"
+
+    # when
+    l_response = load_response(dump_response(response))
+
+    # then
+    assert l_response.status_code == HttpStatus.CREATED
+    assert l_response.headers["set-cookie"] == ["a=1", "b=2"]
+    assert l_response.headers["vary"] == "accept,accept-language"
+    assert str(l_response) == "żółw"
+    assert response.body.tell() == 0
+
+
+def test_decode_response_does_not_copy_body() -> None:
+    # given
+    data = encode_response(200, [("content-type", "text/plain")], b"body")
+
+    # when
+    status, headers, body = decode_response(data)
+
+    # then
+    assert status == 200
+    assert headers == [("content-type", "text/plain")]
+    assert isinstance(body, memoryview)
+    assert body.obj is data
+    assert body.tobytes() == b"body"
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"CHC",
+    b"XYZ" + encode_response(200, [], b"body")[3:],
+    encode_response(200, [("a", "b")], b"body")[:-1],
+])
+def test_fail_to_decode_malformed_response(data: bytes) -> None:
+    # then
+    with pytest.raises(CacheError):
+        decode_response(data)
+
+
+def test_fail_to_decode_unsupported_version() -> None:
+    # given
+    data = bytearray(encode_response(200, [], b"body"))
+    data[3] = 99
+
+    # then
+    with pytest.raises(CacheError):
+        decode_response(data)
+
+
+def test_can_load_legacy_response() -> None:
+    # given
+    data = pickle.dumps((200, b"test", {"test": "ok"}))
+
+    # when
+    response = load_response(data, allow_pickle=True)
+
+    # then
+    assert response == HttpResponse("test", headers={"test": "ok"})
+
+    with pytest.raises(CacheError):
+        load_response(data)
+    with pytest.raises(CacheError):
+        ResponseTemplate.from_payload(data, datetime(2000, 12, 18, 10, 1, 1))
+
+
+def test_can_create_responses_from_template() -> None:
+    # given
+    payload = dump_response(HttpResponse("test", headers={"test": "ok"}))
+    template = ResponseTemplate.from_payload(payload, datetime(2000, 12, 18, 10, 1, 1), "accept")
+
+    # when
+    response = template.create_response()
+    response.headers.override("age", "1")
+    response.write(b"modified")
+    other_response = template.create_response()
+    head_response = template.create_response(with_body=False)
+
+    # then
+    assert template.body == b"test"
+    assert "age" not in template.headers
+    assert other_response.body.read() == b"test"
+    assert other_response.headers["last-modified"] == "Mon, 18 Dec 2000 10:01:01 GMT"
+    assert other_response.headers["vary"] == "accept"
+    assert other_response.headers["test"] == "ok"
+    assert not head_response.body.read()
+
+
+def test_can_encode_compressed_response() -> None:
+    # given
+    body = b"compressible " * 100
+
+    # when
+    data = encode_response(200, [("content-type", "text/plain")], body, GzipCodec())
+    record = read_response_record(data)
+
+    # then
+    assert len(data) < len(body)
+    assert isinstance(record.codec, GzipCodec)
+    assert GzipCodec().decompress(record.body) == body
+    assert decode_response(data)[2].tobytes() == body
+
+
+def test_keeps_incompressible_body_uncompressed() -> None:
+    # when
+    data = encode_response(200, [], b"abc", LzmaCodec())
+
+    # then
+    assert read_response_record(data).codec is None
+    assert decode_response(data)[2].tobytes() == b"abc"
+
+
+@pytest.mark.parametrize("accept_encoding, content_encoding, expected", [
+    ["gzip, deflate", "gzip", True],
+    ["GZIP", "gzip", True],
+    ["deflate", "gzip", False],
+    ["", "gzip", False],
+    ["*", "gzip", True],
+    ["gzip;q=0, *", "gzip", False],
+    ["*;q=0", "gzip", False],
+    ["br;q=1.0, gzip;q=0.5", "gzip", True],
+])
+def test_accepts_encoding(accept_encoding: str, content_encoding: str, expected: bool) -> None:
+    assert accepts_encoding(accept_encoding, content_encoding) == expected
+
+
+def test_can_create_encoded_responses_from_template() -> None:
+    # given
+    body = b"compressible " * 100
+    payload = encode_response(200, [("content-type", "text/plain"), ("content-length", str(len(body)))], body,
+                              GzipCodec())
+    template = ResponseTemplate.from_payload(payload, datetime(2000, 12, 18, 10, 1, 1), "accept")
+
+    # when
+    encoded_response = template.create_response(encoded=True)
+    response = template.create_response()
+
+    # then
+    assert template.content_encoding == "gzip"
+    assert encoded_response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in encoded_response.headers
+    assert encoded_response.headers["vary"] == "accept,accept-encoding"
+    assert GzipCodec().decompress(encoded_response.body.read()) == body
+    assert "content-encoding" not in response.headers
+    assert response.headers["vary"] == "accept,accept-encoding"
+    assert response.body.read() == body
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64 * 1024])
+def test_can_read_response_passed_in_chunks(chunk_size: int) -> None:
+    # given
+    response = HttpResponse(b"a" * 1000, headers={"test": ["one", "two"]})
+    chunks = dump_response_chunks(response, chunk_size=chunk_size)
+    payload = b"".join(chunks)
+    reader = ResponseRecordReader()
+
+    # when
+    for offset in range(0, len(payload), chunk_size):
+        reader.write(payload[offset : offset + chunk_size])
+    template = reader.create_template(datetime(2000, 12, 18, 10, 1, 1))
+
+    # then
+    assert payload == dump_response(response)
+    assert all(len(chunk) <= max(chunk_size, len(chunks[0])) for chunk in chunks)
+    assert template.create_response().body.getvalue() == b"a" * 1000
+    assert template.headers.get("test") == ["one", "two"]
+
+
+def test_can_read_compressed_response_passed_in_chunks() -> None:
+    # given
+    payload = encode_response(200, [("content-type", "text/plain")], b"a" * 1000, GzipCodec())
+    reader = ResponseRecordReader()
+
+    # when
+    reader.write(payload[:10])
+    reader.write(payload[10:])
+    template = reader.create_template(datetime(2000, 12, 18, 10, 1, 1), "accept")
+
+    # then
+    assert template.body == b"a" * 1000
+    assert template.content_encoding == "gzip"
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"not a response record",
+    encode_response(200, [], b"test")[:-1],
+    encode_response(200, [], b"test") + b"t",
+])
+def test_fail_to_read_malformed_response_passed_in_chunks(data: bytes) -> None:
+    # given
+    reader = ResponseRecordReader()
+
+    # then
+    with pytest.raises(CacheError):
+        reader.write(data)
+        reader.create_template(datetime(2000, 12, 18, 10, 1, 1))
+
+
+@pytest.mark.parametrize("given, expected", [
+    ["bytes=0-4", [(0, 4)]],
+    ["bytes=5-", [(5, 9)]],
+    ["bytes=-3", [(7, 9)]],
+    ["bytes=0-1, 4-100", [(0, 1), (4, 9)]],
+    ["BYTES = 0-1,,8-", [(0, 1), (8, 9)]],
+    ["bytes=20-", []],
+    ["bytes=-0", []],
+    ["bytes=3-1", None],
+    ["items=0-1", None],
+    ["bytes=a-b", None],
+    ["bytes=-", None],
+    ["bytes=", None],
+    ["bytes=" + ",".join(["0-1"] * 33), None],
+])
+def test_parse_range(given: str, expected: list) -> None:
+    assert parse_range(given, 10) == expected
+
+
+def test_can_create_partial_responses_from_template() -> None:
+    # given
+    payload = encode_response(200, [("content-type", "text/plain"), ("content-length", "10")], b"0123456789")
+    template = ResponseTemplate.from_payload(payload, datetime(2000, 12, 18, 10, 1, 1))
+
+    # when
+    single = template.create_partial_response([(2, 4)])
+    multiple = template.create_partial_response([(0, 1), (8, 9)])
+    unsatisfiable = template.create_partial_response([])
+
+    # then
+    assert single.status_code == HttpStatus.PARTIAL_CONTENT
+    assert single.body.getvalue() == b"234"
+    assert single.headers.get("content-range") == "bytes 2-4/10"
+    assert single.headers.get("content-length") == "3"
+
+    assert multiple.status_code == HttpStatus.PARTIAL_CONTENT
+    content_type = str(multiple.headers.get("content-type"))
+    assert content_type.startswith("multipart/byteranges; boundary=")
+    boundary = content_type.split("=")[1]
+    assert multiple.body.getvalue() == (
+        f"--{boundary}\r\ncontent-type: text/plain\r\ncontent-range: bytes 0-1/10\r\n\r\n01"
+        f"\r\n--{boundary}\r\ncontent-type: text/plain\r\ncontent-range: bytes 8-9/10\r\n\r\n89"
+        f"\r\n--{boundary}--\r\n"
+    ).encode()
+    assert multiple.headers.get("content-length") == str(len(multiple.body.getvalue()))
+
+    assert unsatisfiable.status_code == HttpStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+    assert unsatisfiable.headers.get("content-range") == "bytes */10"
+    assert template.create_response().body.getvalue() == b"0123456789"
+
+
+@pytest.mark.parametrize("if_range, expected", [
+    ['"v1"', True],
+    ['"v2"', False],
+    ['W/"v1"', False],
+    ["Mon, 18 Dec 2000 10:01:01 GMT", True],
+    ["Tue, 19 Dec 2000 10:01:01 GMT", False],
+])
+def test_template_matches_if_range(if_range: str, expected: bool) -> None:
+    # given
+    payload = encode_response(200, [("etag", '"v1"')], b"0123456789")
+    template = ResponseTemplate.from_payload(payload, datetime(2000, 12, 18, 10, 1, 1))
+
+    # then
+    assert template.matches_if_range(if_range) is expected
+
+
+@pytest.mark.parametrize("etag, expected", [
+    ['"v1"', '"v1-gzip"'],
+    ['W/"v1"', 'W/"v1-gzip"'],
+    ["v1", "v1-gzip"],
+])
+def test_encode_etag(etag: str, expected: str) -> None:
+    assert encode_etag(etag, "gzip") == expected
+    assert decode_etag_value(parse_etag_value(expected)) == parse_etag_value(etag)
+
+
+@pytest.mark.parametrize("value", ["v1", "v1-br", "-gzip", "v1-gzip-old"])
+def test_decode_etag_value_keeps_other_values(value: str) -> None:
+    assert decode_etag_value(value) == value
+
+
+def test_encoded_template_has_distinct_etag() -> None:
+    # given
+    payload = encode_response(200, [("etag", '"v1"')], b"0123456789" * 10, GzipCodec())
+    template = ResponseTemplate.from_payload(payload, datetime(2000, 12, 18, 10, 1, 1))
+
+    # then
+    assert template.create_response(encoded=True).headers["etag"] == '"v1-gzip"'
+    assert template.create_response().headers["etag"] == '"v1"'
+    assert template.matches_if_range('"v1-gzip"', encoded=True)
+    assert not template.matches_if_range('"v1"', encoded=True)
+    assert not template.matches_if_range('"v1-gzip"')
+    assert template.create_partial_response([(0, 1)], encoded=True).body.getvalue() == template.encoded_body[:2]
@@ -0,0 +1,177 @@
+from typing import List
+
+import pytest
+
+from chocs import Application, HttpMethod, HttpRequest, HttpResponse
+
+from chocs_middleware.cache import (
+    BoundedInMemoryCacheStorage,
+    CacheError,
+    CacheItem,
+    CacheMiddleware,
+    CollectableInMemoryCacheStorage,
+    IInvalidatableCacheStorage,
+    InvalidationIndex,
+    RedisCacheStorage,
+    RedisConnectionPool,
+    ShardedInMemoryCacheStorage,
+    TieredCacheStorage,
+)
+from chocs_middleware.cache.cache_storage import dump_item, load_item
+from chocs_middleware.cache.invalidation import path_prefixes
+
+from .conftest import FakeRedisServer
+
+
+@pytest.mark.parametrize(
+    "path,expected",
+    [
+        ("/", ["/"]),
+        ("/users", ["/", "/users"]),
+        ("/users/42/", ["/", "/users", "/users/42"]),
+    ],
+)
+def test_can_list_path_prefixes(path: str, expected: List[str]) -> None:
+    assert path_prefixes(path) == expected
+
+
+def test_index_finds_items_by_tag_and_path_prefix() -> None:
+    # given
+    index = InvalidationIndex()
+
+    # when
+    index.add("1", ("user:42",), "/users/42")
+    index.add("2", ("user:42", "users"), "/users/42/orders")
+    index.add("3", ("users",), "/users/420")
+    index.add("4", (), "")
+
+    # then
+    assert len(index) == 3
+    assert sorted(index.tagged("user:42")) == ["1", "2"]
+    assert sorted(index.prefixed("/users/42")) == ["1", "2"]
+    assert sorted(index.prefixed("/users")) == ["1", "2", "3"]
+    assert index.prefixed("/orders") == []
+
+
+def test_index_forgets_discarded_and_reindexed_items() -> None:
+    # given
+    index = InvalidationIndex()
+    index.add("1", ("a",), "/users/42/orders")
+    index.add("2", ("a",), "/users/42")
+
+    # when
+    index.add("1", ("b",), "/users/1")
+    index.discard("2")
+
+    # then
+    assert index.tagged("a") == []
+    assert index.tagged("b") == ["1"]
+    assert index.prefixed("/users/42") == []
+    assert index._paths.children["users"].children.keys() == {"1"}
+
+
+@pytest.mark.parametrize(
+    "storage",
+    [
+        CollectableInMemoryCacheStorage(),
+        BoundedInMemoryCacheStorage(max_items=10),
+        ShardedInMemoryCacheStorage(shards=4),
+        TieredCacheStorage(CollectableInMemoryCacheStorage()),
+    ],
+)
+def test_storages_can_invalidate_items(storage: IInvalidatableCacheStorage) -> None:
+    # given
+    storage.set(CacheItem("1", b"test", tags=("user:42",), path="/users/42"))  # type: ignore
+    storage.set(CacheItem("2", b"test", tags=("user:42", "users"), path="/users"))  # type: ignore
+    storage.set(CacheItem("3", b"test", tags=("users",), path="/users/1/orders"))  # type: ignore
+    storage.set(CacheItem("4", b"test", path="/users/1"))  # type: ignore
+
+    # when
+    tagged = storage.invalidate_tag("user:42")
+    prefixed = storage.invalidate_prefix("/users/1")
+
+    # then
+    assert isinstance(storage, IInvalidatableCacheStorage)
+    assert tagged == 2
+    assert prefixed == 2
+    assert storage.invalidate_tag("users") == 0
+    for item_id in ("1", "2", "3", "4"):
+        with pytest.raises(CacheError):
+            storage.get(item_id)  # type: ignore
+
+
+def test_redis_storage_can_invalidate_items(redis_server: FakeRedisServer) -> None:
+    # given
+    storage = RedisCacheStorage(RedisConnectionPool(port=redis_server.port))
+    storage.set(CacheItem("1", b"test", tags=("user:42",), path="/users/42"))
+    storage.set(CacheItem("2", b"test", tags=("user:42",), path="/users/42/orders"))
+    storage.set(CacheItem("3", b"test", path="/users/1"))
+
+    # when
+    tagged = storage.invalidate_tag("user:42")
+    prefixed = storage.invalidate_prefix("/users/1/")
+
+    # then
+    assert tagged == 2
+    assert prefixed == 1
+    assert storage.get_many(["1", "2", "3"]) == {}
+
+
+def test_can_persist_tags_and_path() -> None:
+    # given
+    item = CacheItem("1", b"test", 10, tags=("a", "b"), path="/users/42")
+
+    # when
+    restored = load_item("1", dump_item(item))
+
+    # then
+    assert restored.body == b"test"
+    assert restored.tags == ("a", "b")
+    assert restored.path == "/users/42"
+
+
+def test_middleware_tags_cached_responses() -> None:
+    # given
+    cache = CollectableInMemoryCacheStorage()
+    app = Application(CacheMiddleware(cache))
+    controller_call_count = 0
+
+    @app.get("/users/{user_id}", cache_expiry=10, cache_tags=("user:{user_id}",))
+    def get_user(req: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        return HttpResponse("test", headers={"surrogate-key": "users accounts"})
+
+    app(HttpRequest(HttpMethod.GET, "/users/42"))
+    app(HttpRequest(HttpMethod.GET, "/users/42"))
+
+    # when
+    invalidated = cache.invalidate_tag("user:42")
+    app(HttpRequest(HttpMethod.GET, "/users/42"))
+
+    # then
+    assert invalidated == 1
+    assert controller_call_count == 2
+    assert cache.invalidate_tag("accounts") == 1
+
+
+def test_middleware_rejects_tags_referring_to_unknown_path_parameters() -> None:
+    # given
+    cache = CollectableInMemoryCacheStorage()
+    app = Application(CacheMiddleware(cache))
+    controller_call_count = 0
+
+    @app.get("/users/{user_id}", cache_expiry=10, cache_tags=("user:{id}",))
+    def get_user(req: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        return HttpResponse("test")
+
+    # when
+    with pytest.raises(CacheError) as error:
+        app(HttpRequest(HttpMethod.GET, "/users/42"))
+
+    # then
+    assert "user:{id}" in str(error.value)
+    assert controller_call_count == 0
+    assert cache.is_empty
@@ -0,0 +1,138 @@
+from chocs import Application, HttpMethod, HttpRequest, HttpResponse, HttpStatus
+
+from chocs_middleware.cache import (
+    BoundedInMemoryCacheStorage,
+    CacheItem,
+    CacheMiddleware,
+    CollectableInMemoryCacheStorage,
+    ICacheMetrics,
+    InMemoryCacheMetrics,
+    InMemoryCacheStorage,
+)
+
+
+def test_can_count_events_and_observe_durations() -> None:
+    # given
+    metrics = InMemoryCacheMetrics(buckets=(0.1, 1.0))
+
+    # when
+    metrics.increment("hit", "/a")
+    metrics.increment("hit", "/b", 2)
+    metrics.observe("storage_get", "/a", 0.05)
+    metrics.observe("storage_get", "/a", 0.5)
+    metrics.observe("storage_get", "/a", 5.0)
+
+    # then
+    assert isinstance(metrics, ICacheMetrics)
+    assert metrics.count("hit") == 3
+    assert metrics.count("hit", "/b") == 2
+    histogram = metrics.histogram("storage_get", "/a")
+    assert histogram is not None
+    assert histogram.counts == [1, 1, 1]
+    assert histogram.cumulative_counts() == [1, 2, 3]
+    assert histogram.count == 3
+
+
+def test_can_render_prometheus_format() -> None:
+    # given
+    metrics = InMemoryCacheMetrics(buckets=(0.1,))
+    metrics.increment("hit", '/users/{user_id}')
+    metrics.observe("handler", "/users/{user_id}", 0.25)
+
+    # when
+    output = metrics.render_prometheus()
+
+    # then
+    assert output.splitlines() == [
+        "# TYPE chocs_cache_events_total counter",
+        'chocs_cache_events_total{event="hit",route="/users/{user_id}"} 1',
+        "# TYPE chocs_cache_operation_duration_seconds histogram",
+        'chocs_cache_operation_duration_seconds_bucket{operation="handler",route="/users/{user_id}",le="0.1"} 0',
+        'chocs_cache_operation_duration_seconds_bucket{operation="handler",route="/users/{user_id}",le="+Inf"} 1',
+        'chocs_cache_operation_duration_seconds_sum{operation="handler",route="/users/{user_id}"} 0.25',
+        'chocs_cache_operation_duration_seconds_count{operation="handler",route="/users/{user_id}"} 1',
+    ]
+
+
+def test_middleware_reports_metrics() -> None:
+    # given
+    metrics = InMemoryCacheMetrics()
+    app = Application(CacheMiddleware(InMemoryCacheStorage(), metrics=metrics))
+
+    @app.get("/users/{user_id}", cache_expiry=10)
+    def get_user(req: HttpRequest) -> HttpResponse:
+        return HttpResponse("test")
+
+    # when
+    for _ in range(3):
+        app(HttpRequest(HttpMethod.GET, "/users/1"))
+
+    # then
+    assert metrics.count("miss", "/users/{user_id}") == 1
+    assert metrics.count("hit", "/users/{user_id}") == 2
+    assert metrics.histogram("storage_get", "/users/{user_id}").count == 3  # type: ignore
+    assert metrics.histogram("storage_set", "/users/{user_id}").count == 1  # type: ignore
+    assert metrics.histogram("handler", "/users/{user_id}").count == 1  # type: ignore
+    assert metrics.histogram("serialize", "/users/{user_id}").count == 1  # type: ignore
+
+
+def test_middleware_serializes_stored_responses_only() -> None:
+    # given
+    metrics = InMemoryCacheMetrics()
+    app = Application(CacheMiddleware(CollectableInMemoryCacheStorage(), metrics=metrics))
+
+    @app.get("/users/{user_id}", cache_expiry=10)
+    def get_user(req: HttpRequest) -> HttpResponse:
+        return HttpResponse("error", status=HttpStatus.INTERNAL_SERVER_ERROR)
+
+    @app.head("/users/{user_id}", cache_expiry=10)
+    def head_user(req: HttpRequest) -> HttpResponse:
+        return HttpResponse("test")
+
+    @app.put("/users/{user_id}", cache=True)
+    def put_user(req: HttpRequest) -> HttpResponse:
+        return HttpResponse("test")
+
+    # when
+    app(HttpRequest(HttpMethod.GET, "/users/1"))
+    app(HttpRequest(HttpMethod.HEAD, "/users/1"))
+    app(HttpRequest(HttpMethod.PUT, "/users/1"))
+
+    # then
+    assert metrics.histogram("handler", "/users/{user_id}").count == 3  # type: ignore
+    assert metrics.histogram("serialize", "/users/{user_id}") is None
+
+
+def test_middleware_reports_storage_errors() -> None:
+    # given
+    class BrokenStorage(InMemoryCacheStorage):
+        def get(self, item_id: str) -> CacheItem:
+            raise ConnectionError()
+
+    metrics = InMemoryCacheMetrics()
+    app = Application(CacheMiddleware(BrokenStorage(), metrics=metrics))
+
+    @app.get("/test", cache_expiry=10)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        return HttpResponse("test")
+
+    # when
+    response = app(HttpRequest(HttpMethod.GET, "/test"))
+
+    # then
+    assert str(response) == "test"
+    assert metrics.count("storage_error") == 1
+    assert metrics.count("miss") == 1
+
+
+def test_bounded_storage_reports_evictions() -> None:
+    # given
+    metrics = InMemoryCacheMetrics()
+    storage = BoundedInMemoryCacheStorage(max_items=1, metrics=metrics)
+
+    # when
+    storage.set(CacheItem("1", b"test"))
+    storage.set(CacheItem("2", b"test"))
+
+    # then
+    assert metrics.count("eviction") == 1
@@ -1,10 +1,18 @@
-from datetime import datetime, timedelta
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List
+
+import pytest
 
 from chocs import Application
 from chocs import HttpResponse, HttpStatus, HttpRequest, HttpMethod
 
-from chocs_middleware.cache import CacheMiddleware, InMemoryCacheStorage, CollectableInMemoryCacheStorage
+from chocs_middleware.cache import CacheMiddleware, InMemoryCacheStorage, CollectableInMemoryCacheStorage, \
+    CompressionPolicy, GzipCodec, CacheError, InMemoryCacheMetrics, MmapCacheStorage
 from chocs_middleware.cache.cache_storage import CacheItem, generate_cache_id
+from chocs_middleware.cache.http_support import generate_etag, load_response
 
 
 def test_can_skip_cache() -> None:
@@ -75,6 +83,63 @@ def test_can_use_simple_caching_strategy() -> None:
     assert "test" in cached_response.headers
 
 
+def test_can_reuse_response_template_between_hits() -> None:
+    # given
+    cache = InMemoryCacheStorage()
+    app = Application(CacheMiddleware(cache))
+    request = HttpRequest(HttpMethod.GET, "/test")
+
+    @app.get("/test", cache_expiry=10)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        return HttpResponse("test")
+
+    # when
+    app(request)
+    first_hit = app(request)
+    cache_item = cache.get(generate_cache_id(request))
+    template = cache_item.decoded
+    first_hit.write(b"changed")
+    second_hit = app(request)
+
+    # then
+    assert template is not None
+    assert cache_item.decoded is template
+    assert second_hit.body.read() == b"test"
+    assert second_hit.headers["age"] == "0"
+    assert "age" not in template.headers
+
+    # when
+    cache_item.body = cache_item.body
+
+    # then
+    assert cache_item.decoded is None
+
+
+def test_can_serve_compressed_cache() -> None:
+    # given
+    cache = InMemoryCacheStorage()
+    app = Application(CacheMiddleware(cache, compression=CompressionPolicy(min_size=100)))
+    body = '{"name": "Bob Bobber"}' * 100
+
+    @app.get("/test", cache_expiry=10)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        return HttpResponse(body, headers={"content-type": "application/json"})
+
+    # when
+    response = app(HttpRequest(HttpMethod.GET, "/test"))
+    encoded_response = app(HttpRequest(HttpMethod.GET, "/test", headers={"accept-encoding": "gzip, deflate"}))
+    decoded_response = app(HttpRequest(HttpMethod.GET, "/test", headers={"accept-encoding": "br"}))
+
+    # then
+    assert len(cache.get(generate_cache_id(HttpRequest(HttpMethod.GET, "/test"))).body) < len(body)
+    assert str(response) == body
+    assert encoded_response.headers["content-encoding"] == "gzip"
+    assert GzipCodec().decompress(encoded_response.body.read()).decode() == body
+    assert "content-encoding" not in decoded_response.headers
+    assert str(decoded_response) == body
+    assert decoded_response.headers["vary"] == "accept,accept-language,accept-encoding"
+
+
 def test_can_use_simple_caching_strategy_with_head_request() -> None:
     # given
     cache = InMemoryCacheStorage()
@@ -128,6 +193,29 @@ def test_can_use_etag_based_cache() -> None:
     assert "test" in cached_response.headers
 
 
+def test_can_serve_cached_response_with_etag_to_requests_without_validators() -> None:
+    # given
+    app = Application(CacheMiddleware(InMemoryCacheStorage()))
+    controller_call_count = 0
+
+    @app.get("/test", cache_expiry=10)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        return HttpResponse("test", headers={"etag": '"1"'})
+
+    # when
+    app(HttpRequest(HttpMethod.GET, "/test"))
+    cached_response = app(HttpRequest(HttpMethod.GET, "/test"))
+    not_modified_response = app(HttpRequest(HttpMethod.GET, "/test", headers={"if-none-match": "*"}))
+
+    # then
+    assert controller_call_count == 1
+    assert cached_response.status_code == HttpStatus.OK
+    assert str(cached_response) == "test"
+    assert not_modified_response.status_code == HttpStatus.NOT_MODIFIED
+
+
 def test_can_serve_response_for_non_existing_etag() -> None:
     # given
     app = Application(CacheMiddleware(InMemoryCacheStorage()))
@@ -144,8 +232,9 @@ def test_can_serve_response_for_non_existing_etag() -> None:
     cached_response = app(HttpRequest(HttpMethod.GET, "/test", headers={"etag": '"2"'}))
 
     # then
-    assert response == cached_response
-    assert controller_call_count == 2
+    assert str(response) == str(cached_response)
+    assert cached_response.status_code == HttpStatus.OK
+    assert controller_call_count == 1
 
 
 def test_can_serve_response_for_expired_cache() -> None:
@@ -164,8 +253,8 @@ def test_can_serve_response_for_expired_cache() -> None:
 
     # when
     response = app(request)
-    cache_item = cache.get("1")
-    cache_item._expires_at = datetime.utcnow() - timedelta(0, -20)
+    cache_item = cache.get(generate_cache_id(request))
+    cache_item._expires = time.time() - 20
     cached_response = app(request)
 
     # then
@@ -188,17 +277,17 @@ def test_can_pass_conditional_request_if_none_match() -> None:
 
     # when
     response = app(HttpRequest(HttpMethod.GET, "/test"))
-    response_without_cache = app(HttpRequest(HttpMethod.GET, "/test", headers={
+    cached_response = app(HttpRequest(HttpMethod.GET, "/test", headers={
         "etag": e_tag,
         "if-none-match": "non-existing-etag",
     }))
 
     # then
-    assert controller_call_count == 2
+    assert controller_call_count == 1
     assert response.status_code == HttpStatus.OK
-    assert response_without_cache.status_code == HttpStatus.OK
+    assert cached_response.status_code == HttpStatus.OK
 
-    assert response == response_without_cache
+    assert str(response) == str(cached_response)
 
 
 def test_can_fail_conditional_request_if_none_match() -> None:
@@ -207,7 +296,6 @@ def test_can_fail_conditional_request_if_none_match() -> None:
     app = Application(CacheMiddleware(cache))
     e_tag = '"1"'
     controller_call_count = 0
-    cache.set(CacheItem("existing_etag", b""))
 
     @app.get("/test", cache_expiry=10)
     def get_test(req: HttpRequest) -> HttpResponse:
@@ -218,8 +306,7 @@ def test_can_fail_conditional_request_if_none_match() -> None:
     # when
     response = app(HttpRequest(HttpMethod.GET, "/test"))
     cached_response = app(HttpRequest(HttpMethod.GET, "/test", headers={
-        "etag": e_tag,
-        "if-none-match": "existing_etag",
+        "if-none-match": f'"0", {e_tag}',
     }))
 
     # then
@@ -232,26 +319,65 @@ def test_can_fail_conditional_request_with_precondition_failure() -> None:
     # given
     cache = InMemoryCacheStorage()
     app = Application(CacheMiddleware(cache))
-    cache.set(CacheItem("existing_etag", b""))
 
-    @app.post("/test", cache_expiry=10)
+    @app.get("/test", cache_expiry=10)
     def get_test(req: HttpRequest) -> HttpResponse:
+        return HttpResponse("test", headers={"etag": '"existing_etag"'})
+
+    @app.post("/test", cache_expiry=10)
+    def create_test(req: HttpRequest) -> HttpResponse:
         return HttpResponse("test")
 
     # when
+    app(HttpRequest(HttpMethod.GET, "/test"))
     response = app(HttpRequest(HttpMethod.POST, "/test", headers={"if-none-match": "existing_etag"}))
 
     # then
     assert response.status_code == HttpStatus.PRECONDITION_FAILED
 
 
+def test_retrieves_items_for_conditional_request_with_single_lookup() -> None:
+    # given
+    class RecordingStorage(InMemoryCacheStorage):
+        def __init__(self):
+            super().__init__()
+            self.lookups: List[List[str]] = []
+
+        def get(self, item_id: str) -> CacheItem:
+            self.lookups.append([item_id])
+            return super().get(item_id)
+
+        def get_many(self, item_ids: Iterable[str]) -> Dict[str, CacheItem]:
+            item_ids = list(item_ids)
+            self.lookups.append(item_ids)
+            return {item_id: item for item_id, item in self._cache.items() if item_id in item_ids}
+
+    cache = RecordingStorage()
+    app = Application(CacheMiddleware(cache))
+    request = HttpRequest(HttpMethod.GET, "/test", headers={"if-none-match": '"1"', "if-match": '"1", "2"'})
+    cache_id = generate_cache_id(request)
+    resource_id = generate_cache_id(request, ())
+
+    @app.get("/test", cache_expiry=10)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        return HttpResponse("test", headers={"etag": '"1"'})
+
+    # when
+    app(HttpRequest(HttpMethod.GET, "/test"))
+    cache.lookups.clear()
+    response = app(request)
+
+    # then
+    assert response.status_code == HttpStatus.NOT_MODIFIED
+    assert cache.lookups == [[cache_id, f"{resource_id}#etag:1", f"{resource_id}#etag:2"]]
+
+
 def test_can_pass_conditional_request_if_match() -> None:
     # given
     cache = InMemoryCacheStorage()
     app = Application(CacheMiddleware(cache))
     e_tag = '"1"'
     controller_call_count = 0
-    cache.set(CacheItem("etag", b""))
 
     @app.get("/test", cache_expiry=10)
     def get_test(req: HttpRequest) -> HttpResponse:
@@ -261,16 +387,16 @@ def test_can_pass_conditional_request_if_match() -> None:
 
     # when
     response = app(HttpRequest(HttpMethod.GET, "/test"))
-    response_without_cache = app(HttpRequest(HttpMethod.GET, "/test", headers={
-        "if-match": "etag",
+    cached_response = app(HttpRequest(HttpMethod.GET, "/test", headers={
+        "if-match": e_tag,
     }))
 
     # then
-    assert controller_call_count == 2
+    assert controller_call_count == 1
     assert response.status_code == HttpStatus.OK
-    assert response_without_cache.status_code == HttpStatus.OK
+    assert cached_response.status_code == HttpStatus.OK
 
-    assert response == response_without_cache
+    assert str(response) == str(cached_response)
 
 
 def test_can_fail_conditional_request_if_match() -> None:
@@ -365,23 +491,60 @@ def test_can_collect_stale_cache() -> None:
     assert cache.is_empty
 
 
+def test_matches_if_match_of_unsafe_request_against_any_variant() -> None:
+    # given
+    app = Application(CacheMiddleware(CollectableInMemoryCacheStorage()))
+    controller_call_count = 0
+
+    @app.get("/test", cache_expiry=10)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        return HttpResponse("test", headers={"etag": '"abc"'})
+
+    @app.put("/test", cache_expiry=10)
+    def put_test(req: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        return HttpResponse("updated", headers={"etag": '"def"'})
+
+    app(HttpRequest(HttpMethod.GET, "/test", headers={"accept": "application/json"}))
+
+    # when
+    other_variant = app(HttpRequest(HttpMethod.GET, "/test", headers={"if-none-match": '"abc"'}))
+    updated = app(HttpRequest(HttpMethod.PUT, "/test", headers={"if-match": '"abc"', "accept": "*/*"}))
+    outdated = app(HttpRequest(HttpMethod.PUT, "/test", headers={"if-match": '"other"'}))
+
+    # then
+    assert other_variant.status_code == HttpStatus.OK
+    assert updated.status_code == HttpStatus.OK
+    assert str(updated) == "updated"
+    assert outdated.status_code == HttpStatus.PRECONDITION_FAILED
+    assert controller_call_count == 1
+
+
 def test_can_update_etag_in_cached_item() -> None:
     # given
     cache_storage = CollectableInMemoryCacheStorage()
     app = Application(CacheMiddleware(cache_storage))
-    cache_item = CacheItem.empty("1")  # this is an expired item by default
+    request = HttpRequest(HttpMethod.GET, "/test")
+    cache_id = generate_cache_id(request)
+    resource_id = generate_cache_id(request, ())
+    e_tag = "1"
 
     @app.get("/test", cache_expiry=10)
     def get_test(req: HttpRequest) -> HttpResponse:
-        return HttpResponse("test", headers={"etag": "2"})
+        return HttpResponse("test", headers={"etag": e_tag})
 
     # when
-    cache_storage.set(cache_item)
-    app(HttpRequest(HttpMethod.GET, "/test", headers={"etag": "1"}))
+    app(request)
+    cache_storage.get(cache_id)._expires = time.time() - 1
+    e_tag = "2"
+    app(request)
 
     # then
-    assert cache_item.id == "2"
-    assert len(cache_storage) == 1
+    assert cache_storage.get(f"{resource_id}#etag:2")
+    with pytest.raises(CacheError):
+        cache_storage.get(f"{resource_id}#etag:1")
+    assert len(cache_storage) == 2
 
 
 def test_can_update_cache_id_for_new_vary_header() -> None:
@@ -404,3 +567,541 @@ def test_can_update_cache_id_for_new_vary_header() -> None:
     new_cache = cache_storage.get(generate_cache_id(request, ("x-a", "x-b")))
     assert len(cache_storage) == 2
     assert isinstance(new_cache, CacheItem)
+
+
+def test_can_coalesce_concurrent_requests() -> None:
+    # given
+    cache = InMemoryCacheStorage()
+    middleware = CacheMiddleware(cache, coalesce_timeout=2)
+    app = Application(middleware)
+    release = threading.Event()
+    controller_call_count = 0
+    responses: List[HttpResponse] = []
+
+    @app.get("/test", cache_expiry=10)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        release.wait(2)
+        return HttpResponse("test", headers={"test": "ok"})
+
+    def worker() -> None:
+        responses.append(app(HttpRequest(HttpMethod.GET, "/test")))
+
+    # when
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    key = (HttpMethod.GET, generate_cache_id(HttpRequest(HttpMethod.GET, "/test")))
+    deadline = time.time() + 2
+    while middleware._single_flight.waiting(key) < 3 and time.time() < deadline:  # type: ignore
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    # then
+    assert controller_call_count == 1
+    assert len(responses) == 4
+    assert len({id(response) for response in responses}) == 4
+    for response in responses:
+        assert response.body.read() == b"test"
+        assert response.headers["test"] == "ok"
+        assert response.headers["cache-control"] == "max-age=10"
+
+
+def test_can_serve_stale_response_while_revalidating() -> None:
+    # given
+    cache = InMemoryCacheStorage()
+    executor = ThreadPoolExecutor(1)
+    app = Application(CacheMiddleware(cache, revalidation_executor=executor))
+    request = HttpRequest(HttpMethod.GET, "/test")
+    controller_call_count = 0
+
+    @app.get("/test", cache_expiry=10, cache_stale_while_revalidate=30)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        return HttpResponse(f"version {controller_call_count}")
+
+    response = app(request)
+    stale_item = cache.get(generate_cache_id(request))
+    stale_item._expires = time.time() - 5
+    stale_body = stale_item.body
+
+    # when
+    stale_response = app(request)
+    executor.shutdown(wait=True)
+    fresh_response = app(request)
+
+    # then
+    assert response.headers["cache-control"] == "max-age=10, stale-while-revalidate=30"
+    assert str(stale_response) == "version 1"
+    assert int(stale_response.headers["age"]) >= 0
+    assert controller_call_count == 2
+    assert str(fresh_response) == "version 2"
+    assert not cache.get(generate_cache_id(request)).is_expired
+    assert stale_item.body == stale_body and stale_item.is_expired  # revalidation stores a new item
+
+
+def test_can_refresh_response_before_it_expires() -> None:
+    # given
+    cache = InMemoryCacheStorage()
+    executor = ThreadPoolExecutor(1)
+    app = Application(CacheMiddleware(cache, revalidation_executor=executor, cache_early_refresh=1e9))
+    request = HttpRequest(HttpMethod.GET, "/test")
+    controller_call_count = 0
+
+    @app.get("/test", cache_expiry=10)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        time.sleep(0.001)
+        return HttpResponse(f"version {controller_call_count}")
+
+    @app.get("/disabled", cache_expiry=10, cache_early_refresh=0)
+    def get_disabled(req: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        return HttpResponse("disabled")
+
+    app(request)
+
+    # when
+    cached_response = app(request)
+    executor.shutdown(wait=True)
+    app(HttpRequest(HttpMethod.GET, "/disabled"))
+    app(HttpRequest(HttpMethod.GET, "/disabled"))
+
+    # then
+    assert str(cached_response) == "version 1"
+    assert str(load_response(cache.get(generate_cache_id(request)).body)) == "version 2"
+    assert controller_call_count == 3
+
+
+def test_measures_recompute_time_of_stored_responses_only() -> None:
+    # given
+    cache = CollectableInMemoryCacheStorage()
+    middleware = CacheMiddleware(cache)
+    app = Application(middleware)
+    request = HttpRequest(HttpMethod.GET, "/test")
+    delay = 0.02
+
+    @app.get("/test", cache_expiry=10)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        time.sleep(delay)
+        return HttpResponse("test", headers={"etag": '"1"'})
+
+    @app.put("/test")
+    def put_test(req: HttpRequest) -> HttpResponse:
+        return HttpResponse(status=HttpStatus.NO_CONTENT)
+
+    app(request)
+    recompute_time = middleware._recompute_times["/test"]
+
+    # when
+    delay = 0
+    cache.get(generate_cache_id(request))._expires = time.time() - 1
+    app(request)  # unchanged response is only refreshed
+    app(HttpRequest(HttpMethod.PUT, "/test"))
+
+    # then
+    assert recompute_time >= 0.02
+    assert middleware._recompute_times == {"/test": recompute_time}
+
+
+def test_can_spread_expiry_of_cached_responses() -> None:
+    # given
+    cache = InMemoryCacheStorage()
+    app = Application(CacheMiddleware(cache))
+
+    @app.get("/items/{item_id}", cache_expiry=1000, cache_ttl_jitter=0.5)
+    def get_item(req: HttpRequest) -> HttpResponse:
+        return HttpResponse("item")
+
+    # when
+    requests = [HttpRequest(HttpMethod.GET, f"/items/{i}") for i in range(20)]
+    for request in requests:
+        app(request)
+    ttls = {cache.get(generate_cache_id(request)).ttl for request in requests}
+
+    # then
+    assert len(ttls) > 1
+    assert all(500 <= ttl <= 1000 for ttl in ttls)
+
+
+def test_does_not_serve_response_stale_for_too_long() -> None:
+    # given
+    cache = InMemoryCacheStorage()
+    app = Application(CacheMiddleware(cache))
+    request = HttpRequest(HttpMethod.GET, "/test")
+    controller_call_count = 0
+
+    @app.get("/test", cache_expiry=10, cache_stale_while_revalidate=30)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        return HttpResponse(f"version {controller_call_count}")
+
+    app(request)
+    cache.get(generate_cache_id(request))._expires = time.time() - 60
+
+    # when
+    response = app(request)
+
+    # then
+    assert str(response) == "version 2"
+    assert controller_call_count == 2
+
+
+def test_can_serve_stale_response_on_error() -> None:
+    # given
+    cache = InMemoryCacheStorage()
+    app = Application(CacheMiddleware(cache))
+    request = HttpRequest(HttpMethod.GET, "/test")
+    failure: List[Exception] = []
+
+    @app.get("/test", cache_expiry=10, cache_stale_if_error=30)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        if failure:
+            raise failure[0]
+        return HttpResponse("cached")
+
+    app(request)
+    cache_item = cache.get(generate_cache_id(request))
+    cache_item._expires = time.time() - 5
+
+    # when
+    failure.append(RuntimeError("backend failure"))
+    response = app(request)
+
+    # then
+    assert str(response) == "cached"
+    assert cache_item.is_expired
+
+    # when
+    cache_item._expires = time.time() - 60
+
+    # then
+    with pytest.raises(RuntimeError):
+        app(request)
+
+
+def test_can_serve_stale_response_on_server_error() -> None:
+    # given
+    cache = InMemoryCacheStorage()
+    app = Application(CacheMiddleware(cache))
+    request = HttpRequest(HttpMethod.GET, "/test")
+    status = [HttpStatus.OK]
+
+    @app.get("/test", cache_expiry=10, cache_stale_if_error=30)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        return HttpResponse(f"status {int(status[0])}", status[0])
+
+    app(request)
+    cache_item = cache.get(generate_cache_id(request))
+    cache_item._expires = time.time() - 5
+
+    # when
+    status[0] = HttpStatus.SERVICE_UNAVAILABLE
+    response = app(request)
+
+    # then
+    assert response.status_code == HttpStatus.OK
+    assert str(response) == "status 200"
+    assert str(load_response(cache_item.body)) == "status 200"
+
+    # when
+    cache_item._expires = time.time() - 60
+    response = app(request)
+
+    # then
+    assert response.status_code == HttpStatus.SERVICE_UNAVAILABLE
+    assert str(load_response(cache_item.body)) == "status 200"
+
+
+def test_does_not_cache_responses_exceeding_max_size() -> None:
+    # given
+    cache = CollectableInMemoryCacheStorage()
+    app = Application(CacheMiddleware(cache, cache_max_size=100))
+    controller_call_count = 0
+
+    @app.get("/small", cache_expiry=10)
+    def get_small(req: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        return HttpResponse("a" * 100)
+
+    @app.get("/large", cache_expiry=10)
+    def get_large(req: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        return HttpResponse("a" * 101)
+
+    @app.get("/export", cache_expiry=10, cache_max_size=1000)
+    def get_export(req: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        return HttpResponse("a" * 1000)
+
+    # when
+    for path in ("/small", "/large", "/export"):
+        app(HttpRequest(HttpMethod.GET, path))
+        response = app(HttpRequest(HttpMethod.GET, path))
+
+        # then
+        assert str(response).startswith("a" * 100)
+
+    assert controller_call_count == 4
+    assert len(cache) == 2
+
+
+def test_can_generate_strong_etag_from_body() -> None:
+    # given
+    cache = InMemoryCacheStorage()
+    app = Application(CacheMiddleware(cache))
+    controller_call_count = 0
+
+    @app.get("/generated", cache_expiry=10, cache_etag=True)
+    def get_generated(req: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        return HttpResponse("test")
+
+    @app.get("/custom", cache_expiry=10, cache_etag=True)
+    def get_custom(req: HttpRequest) -> HttpResponse:
+        return HttpResponse("test", headers={"etag": '"custom"'})
+
+    @app.get("/disabled", cache_expiry=10)
+    def get_disabled(req: HttpRequest) -> HttpResponse:
+        return HttpResponse("test")
+
+    # when
+    response = app(HttpRequest(HttpMethod.GET, "/generated"))
+    etag = str(response.headers.get("etag"))
+    not_modified = app(HttpRequest(HttpMethod.GET, "/generated", headers={"if-none-match": etag}))
+
+    # then
+    assert etag == generate_etag(b"test")
+    assert etag.startswith('"') and len(etag) == 34
+    assert not_modified.status_code == HttpStatus.NOT_MODIFIED
+    assert not_modified.headers.get("etag") == etag
+    assert controller_call_count == 1
+    assert app(HttpRequest(HttpMethod.GET, "/custom")).headers.get("etag") == '"custom"'
+    assert "etag" not in app(HttpRequest(HttpMethod.GET, "/disabled")).headers
+
+
+def test_refreshes_unchanged_response_without_storing_it_again() -> None:
+    # given
+    class CountingStorage(CollectableInMemoryCacheStorage):
+        stored = 0
+
+        def set(self, item: CacheItem) -> None:
+            self.stored += 1
+            super().set(item)
+
+    cache = CountingStorage()
+    app = Application(CacheMiddleware(cache))
+    request = HttpRequest(HttpMethod.GET, "/test")
+    etag = '"1"'
+    controller_call_count = 0
+
+    @app.get("/test", cache_expiry=10)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        return HttpResponse("test", headers={"etag": etag})
+
+    app(request)
+    cache_item = cache.get(generate_cache_id(request))
+    cache_item._expires = time.time() - 1
+
+    # when
+    refreshed = app(request)
+    not_modified = app(HttpRequest(HttpMethod.GET, "/test", headers={"if-none-match": '"1"'}))
+
+    # then
+    assert str(refreshed) == "test"
+    assert controller_call_count == 2
+    assert cache.stored == 2
+    assert not cache.get(generate_cache_id(request)).is_expired
+    assert cache_item.is_expired  # item served to other requests is not modified
+    assert not_modified.status_code == HttpStatus.NOT_MODIFIED
+
+    # when
+    cache.get(generate_cache_id(request))._expires = time.time() - 1
+    etag = '"2"'
+    app(request)
+
+    # then
+    assert cache.stored == 4
+    assert app(HttpRequest(HttpMethod.GET, "/test", headers={"if-none-match": '"1"'})).status_code == HttpStatus.OK
+    assert controller_call_count == 3
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [b"CHC\x01garbage", b"CHC\x63" + b"\x00" * 20, pickle.dumps((200, b"legacy", {"test": "ok"}))],
+)
+def test_treats_undecodable_payload_as_miss(payload: bytes) -> None:
+    # given
+    cache = CollectableInMemoryCacheStorage()
+    metrics = InMemoryCacheMetrics()
+    app = Application(CacheMiddleware(cache, metrics=metrics))
+    request = HttpRequest(HttpMethod.GET, "/test")
+    cache.set(CacheItem(generate_cache_id(request), payload, 10))
+
+    @app.get("/test", cache_expiry=10)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        return HttpResponse("fresh")
+
+    # when
+    response = app(request)
+
+    # then
+    assert str(response) == "fresh"
+    assert metrics.count("storage_error", "/test") == 1
+    assert str(load_response(cache.get(generate_cache_id(request)).body)) == "fresh"
+
+
+def test_treats_undecodable_streamed_payload_as_miss(tmp_path) -> None:
+    # given
+    cache = MmapCacheStorage(str(tmp_path / "cache.bin"))
+    metrics = InMemoryCacheMetrics()
+    app = Application(CacheMiddleware(cache, metrics=metrics))
+    request = HttpRequest(HttpMethod.GET, "/test")
+    cache.set(CacheItem(generate_cache_id(request), b"CHC\x01garbage", 10))
+
+    @app.get("/test", cache_expiry=10)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        return HttpResponse("fresh")
+
+    # when
+    response = app(request)
+
+    # then
+    assert str(response) == "fresh"
+    assert metrics.count("storage_error", "/test") == 1
+    assert str(load_response(cache.get(generate_cache_id(request)).body)) == "fresh"
+    cache.close()
+
+
+def test_can_serve_legacy_pickled_responses_when_allowed() -> None:
+    # given
+    cache = InMemoryCacheStorage()
+    app = Application(CacheMiddleware(cache, allow_pickle=True))
+    request = HttpRequest(HttpMethod.GET, "/test")
+    cache.set(CacheItem(generate_cache_id(request), pickle.dumps((200, b"legacy", {"test": "ok"})), 10))
+
+    @app.get("/test", cache_expiry=10)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        return HttpResponse("fresh")
+
+    # when
+    response = app(request)
+
+    # then
+    assert str(response) == "legacy"
+
+
+def test_can_serve_byte_ranges_from_cache() -> None:
+    # given
+    app = Application(CacheMiddleware(InMemoryCacheStorage()))
+    controller_call_count = 0
+
+    @app.get("/asset", cache_expiry=10)
+    def get_asset(req: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        return HttpResponse(b"0123456789", headers={"content-type": "application/octet-stream"})
+
+    app(HttpRequest(HttpMethod.GET, "/asset"))
+    last_modified = str(app(HttpRequest(HttpMethod.GET, "/asset")).headers.get("last-modified"))
+
+    # when
+    partial = app(HttpRequest(HttpMethod.GET, "/asset", headers={"range": "bytes=-4"}))
+    multipart = app(HttpRequest(HttpMethod.GET, "/asset", headers={"range": "bytes=0-0,5-6"}))
+    if_range = app(HttpRequest(HttpMethod.GET, "/asset", headers={"range": "bytes=0-1", "if-range": last_modified}))
+    changed = app(HttpRequest(HttpMethod.GET, "/asset", headers={"range": "bytes=0-1", "if-range": '"other"'}))
+    unsatisfiable = app(HttpRequest(HttpMethod.GET, "/asset", headers={"range": "bytes=10-"}))
+    ignored = app(HttpRequest(HttpMethod.GET, "/asset", headers={"range": "lines=1-2"}))
+
+    # then
+    assert controller_call_count == 1
+    assert partial.status_code == HttpStatus.PARTIAL_CONTENT
+    assert partial.body.getvalue() == b"6789"
+    assert partial.headers.get("content-range") == "bytes 6-9/10"
+    assert "age" in partial.headers
+    assert multipart.status_code == HttpStatus.PARTIAL_CONTENT
+    assert str(multipart.headers.get("content-type")).startswith("multipart/byteranges")
+    assert if_range.status_code == HttpStatus.PARTIAL_CONTENT
+    assert if_range.body.getvalue() == b"01"
+    assert changed.status_code == HttpStatus.OK
+    assert changed.body.getvalue() == b"0123456789"
+    assert unsatisfiable.status_code == HttpStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+    assert ignored.status_code == HttpStatus.OK
+
+
+def test_gives_encoded_responses_distinct_etag() -> None:
+    # given
+    app = Application(CacheMiddleware(InMemoryCacheStorage(), compression=CompressionPolicy(min_size=100)))
+    body = '{"name": "Bob Bobber"}' * 100
+    gzip = {"accept-encoding": "gzip"}
+
+    @app.get("/test", cache_expiry=10)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        return HttpResponse(body, headers={"content-type": "application/json", "etag": '"v1"'})
+
+    @app.put("/test")
+    def put_test(req: HttpRequest) -> HttpResponse:
+        return HttpResponse(status=HttpStatus.NO_CONTENT)
+
+    app(HttpRequest(HttpMethod.GET, "/test"))
+
+    # when
+    encoded = app(HttpRequest(HttpMethod.GET, "/test", headers=gzip))
+    identity = app(HttpRequest(HttpMethod.GET, "/test"))
+    identity_range = app(HttpRequest(HttpMethod.GET, "/test", headers={**gzip, "range": "bytes=0-9", "if-range": '"v1"'}))
+    encoded_range = app(
+        HttpRequest(HttpMethod.GET, "/test", headers={**gzip, "range": "bytes=0-9", "if-range": '"v1-gzip"'})
+    )
+    not_modified = app(HttpRequest(HttpMethod.GET, "/test", headers={**gzip, "if-none-match": '"v1-gzip"'}))
+    if_match = app(HttpRequest(HttpMethod.PUT, "/test", headers={**gzip, "if-match": '"v1-gzip"'}))
+
+    # then
+    assert encoded.headers["etag"] == '"v1-gzip"'
+    assert identity.headers["etag"] == '"v1"'
+    assert identity_range.status_code == HttpStatus.OK
+    assert identity_range.headers["content-encoding"] == "gzip"
+    assert encoded_range.status_code == HttpStatus.PARTIAL_CONTENT
+    assert encoded_range.headers["content-encoding"] == "gzip"
+    assert encoded_range.body.getvalue() == encoded.body.getvalue()[:10]
+    assert not_modified.status_code == HttpStatus.NOT_MODIFIED
+    assert not_modified.headers["etag"] == '"v1-gzip"'
+    assert if_match.status_code == HttpStatus.NO_CONTENT
+
+
+def test_matches_handler_etag_with_content_coding_suffix() -> None:
+    # given
+    app = Application(CacheMiddleware(InMemoryCacheStorage()))
+
+    @app.get("/test", cache_expiry=10)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        return HttpResponse("test", headers={"etag": '"5e1f-gzip"'})
+
+    @app.put("/test")
+    def put_test(req: HttpRequest) -> HttpResponse:
+        return HttpResponse(status=HttpStatus.NO_CONTENT)
+
+    app(HttpRequest(HttpMethod.GET, "/test"))
+
+    # when
+    not_modified = app(HttpRequest(HttpMethod.GET, "/test", headers={"if-none-match": '"5e1f-gzip"'}))
+    modified = app(HttpRequest(HttpMethod.GET, "/test", headers={"if-none-match": '"5e1f"'}))
+    if_match = app(HttpRequest(HttpMethod.PUT, "/test", headers={"if-match": '"5e1f-gzip"'}))
+
+    # then
+    assert not_modified.status_code == HttpStatus.NOT_MODIFIED
+    assert not_modified.headers["etag"] == '"5e1f-gzip"'
+    assert modified.status_code == HttpStatus.OK
+    assert if_match.status_code == HttpStatus.NO_CONTENT
@@ -0,0 +1,275 @@
+import multiprocessing
+import os
+from pathlib import Path
+
+import pytest
+
+from chocs import Application, HttpMethod, HttpRequest, HttpResponse
+
+from chocs_middleware.cache import (
+    CacheError,
+    CacheItem,
+    CacheMiddleware,
+    IBatchCollectableCacheStorage,
+    ICollectableCacheStorage,
+    IStreamingCacheStorage,
+    ITouchableCacheStorage,
+    MmapCacheStorage,
+)
+
+pytestmark = pytest.mark.skipif(os.name != "posix", reason="memory-mapped storage requires a POSIX system")
+
+
+def create_storage(path: Path, **kwargs) -> MmapCacheStorage:
+    options = {"arena_size": 64 * 1024, "slots": 64, "min_block": 256, "max_block": 4096}
+    options.update(kwargs)
+    return MmapCacheStorage(str(path / "cache.bin"), **options)
+
+
+def test_can_store_and_get_item(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+    item = CacheItem("1", b"test_data", 10)
+
+    # when
+    instance.set(item)
+    stored = instance.get("1")
+
+    # then
+    assert isinstance(instance, ICollectableCacheStorage)
+    assert stored.body == b"test_data"
+    assert stored.ttl == 10
+    assert stored.updated_timestamp == item.updated_timestamp
+    assert stored.expires_timestamp == item.expires_timestamp
+    assert len(instance) == 1
+
+
+def test_can_override_and_collect_item(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+    instance.set(CacheItem("1", b"a" * 100))
+
+    # when
+    instance.set(CacheItem("1", b"b" * 1000))
+
+    # then
+    assert instance.get("1").body == b"b" * 1000
+    assert len(instance) == 1
+
+    # when
+    instance.collect(CacheItem("1", b""))
+    instance.collect(CacheItem("missing", b""))
+
+    # then
+    assert instance.is_empty
+    with pytest.raises(CacheError):
+        instance.get("1")
+
+
+def test_can_store_get_and_collect_many_items(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+
+    # when
+    instance.set_many([CacheItem("1", b"one"), CacheItem("2", b"two"), CacheItem("3", b"three")])
+    items = instance.get_many(["1", "3", "missing"])
+    instance.collect_many([CacheItem("1", b""), CacheItem("2", b"")])
+
+    # then
+    assert isinstance(instance, IBatchCollectableCacheStorage)
+    assert {item_id: item.body for item_id, item in items.items()} == {"1": b"one", "3": b"three"}
+    assert len(instance) == 1
+    assert instance.get_many(["1", "2", "3"]).keys() == {"3"}
+
+
+def test_can_touch_items(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+    instance.set(CacheItem("1", b"test", -10))
+    refreshed = CacheItem("1", b"", 20)
+
+    # when
+    touched = instance.touch([refreshed, CacheItem("missing", b"")])
+    stored = create_storage(tmp_path).get("1")
+
+    # then
+    assert isinstance(instance, ITouchableCacheStorage)
+    assert touched == 1
+    assert stored.body == b"test"
+    assert stored.ttl == 20
+    assert stored.updated_timestamp == refreshed.updated_timestamp
+    assert stored.expires_timestamp == refreshed.expires_timestamp
+
+
+def test_can_read_body_without_copying(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+    instance.set(CacheItem("1", b"test_data"))
+
+    # when
+    with instance.read_body("1") as body:
+        # then
+        assert isinstance(body, memoryview)
+        assert body == b"test_data"
+
+
+def test_can_store_and_get_item_in_chunks(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+    item = CacheItem("1", b"", 10)
+    received = []
+
+    # when
+    instance.set_stream(item, [b"a" * 1000, memoryview(b"b" * 1000)], 2000)
+    stored = instance.get_stream("1", lambda chunk: received.append(bytes(chunk)), 512)
+
+    # then
+    assert isinstance(instance, IStreamingCacheStorage)
+    assert [len(chunk) for chunk in received] == [512, 512, 512, 464]
+    assert b"".join(received) == b"a" * 1000 + b"b" * 1000
+    assert stored.body == b""
+    assert stored.expires_timestamp == item.expires_timestamp
+    assert instance.get("1").body == b"a" * 1000 + b"b" * 1000
+
+
+def test_fails_to_store_chunks_of_unexpected_size(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+
+    # then
+    with pytest.raises(ValueError):
+        instance.set_stream(CacheItem("1", b""), [b"a" * 100], 50)
+    with pytest.raises(ValueError):
+        instance.set_stream(CacheItem("1", b""), [b"a" * 100], 150)
+    assert instance.is_empty
+
+
+def test_skips_items_exceeding_largest_block(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+    instance.set(CacheItem("1", b"test"))
+
+    # when
+    instance.set(CacheItem("1", b"a" * 4096))
+
+    # then
+    assert instance.is_empty
+
+
+def test_evicts_items_when_full(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+
+    # when
+    for i in range(200):
+        instance.set(CacheItem(f"item-{i}", b"a" * 1000))
+
+    # then
+    assert 0 < len(instance) <= 48
+    assert instance.get("item-199").body == b"a" * 1000
+
+
+def test_ignores_torn_records(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+    instance.set(CacheItem("1", b"test_data"))
+    offset = instance._mmap.find(b"test_data")  # type: ignore
+
+    # when
+    instance._mmap[offset] = ord("T")  # type: ignore
+
+    # then
+    with pytest.raises(CacheError):
+        instance.get("1")
+
+
+def test_shares_items_between_processes(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path)
+    instance.set(CacheItem("parent", b"from parent"))
+
+    def child() -> None:
+        assert instance.get("parent").body == b"from parent"
+        instance.set(CacheItem("child", b"from child"))
+
+    process = multiprocessing.get_context("fork").Process(target=child)
+
+    # when
+    process.start()
+    process.join()
+
+    # then
+    assert process.exitcode == 0
+    assert instance.get("child").body == b"from child"
+    assert create_storage(tmp_path).get("child").body == b"from child"
+
+
+def test_can_be_used_by_middleware(tmp_path: Path) -> None:
+    # given
+    app = Application(CacheMiddleware(create_storage(tmp_path)))
+    controller_call_count = 0
+
+    @app.get("/test", cache_expiry=10)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        return HttpResponse("test")
+
+    # when
+    app(HttpRequest(HttpMethod.GET, "/test"))
+    response = app(HttpRequest(HttpMethod.GET, "/test"))
+
+    # then
+    assert controller_call_count == 1
+    assert str(response) == "test"
+
+
+def test_middleware_streams_large_bodies(tmp_path: Path) -> None:
+    # given
+    app = Application(CacheMiddleware(create_storage(tmp_path, max_block=1024 * 1024, arena_size=4 * 1024 * 1024)))
+    body = os.urandom(300 * 1024)
+
+    @app.get("/export", cache_expiry=10)
+    def get_export(req: HttpRequest) -> HttpResponse:
+        return HttpResponse(body, headers={"content-type": "application/octet-stream"})
+
+    # when
+    app(HttpRequest(HttpMethod.GET, "/export"))
+    response = app(HttpRequest(HttpMethod.GET, "/export"))
+
+    # then
+    assert response.body.getvalue() == body
+    assert response.headers.get("content-type") == "application/octet-stream"
+    assert "age" in response.headers
+
+
+def test_reclaims_blocks_of_other_sizes_when_full(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path, arena_size=1024 * 1024, slots=16384, max_block=128 * 1024)
+    for i in range(4096):
+        instance.set(CacheItem(f"small-{i}", b"a" * 100))
+
+    # when
+    for i in range(20):
+        instance.set(CacheItem(f"large-{i}", b"b" * 100 * 1024))
+
+    # then
+    assert len(instance.get_many(f"large-{i}" for i in range(20))) > 1
+    assert instance.get("large-19").body == b"b" * 100 * 1024
+    instance.set(CacheItem("small", b"a" * 100))
+    assert instance.get("small").body == b"a" * 100
+
+
+def test_splits_larger_free_blocks(tmp_path: Path) -> None:
+    # given
+    instance = create_storage(tmp_path, arena_size=4096)
+    instance.set(CacheItem("large", b"a" * 3000))
+    instance.collect(CacheItem("large", b""))
+
+    # when
+    for i in range(16):
+        instance.set(CacheItem(f"small-{i}", b"a" * 100))
+
+    # then
+    assert len(instance) == 16
+    assert instance._counters()[0] == 4096  # type: ignore
@@ -0,0 +1,217 @@
+import socket
+
+import pytest
+
+from chocs import Application, HttpMethod, HttpRequest, HttpResponse
+
+from chocs_middleware.cache import (
+    CacheError,
+    CacheItem,
+    CacheMiddleware,
+    ICollectableCacheStorage,
+    ITouchableCacheStorage,
+    RedisCacheStorage,
+    RedisConnectionPool,
+)
+
+from .conftest import FakeRedisServer
+
+
+def create_storage(server: FakeRedisServer, **kwargs) -> RedisCacheStorage:
+    return RedisCacheStorage(RedisConnectionPool(port=server.port, timeout=0.2), **kwargs)
+
+
+def test_can_store_and_get_item(redis_server: FakeRedisServer) -> None:
+    # given
+    instance = create_storage(redis_server)
+    item = CacheItem("1", b"test_data", 10)
+
+    # when
+    instance.set(item)
+    stored = instance.get("1")
+
+    # then
+    assert isinstance(instance, ICollectableCacheStorage)
+    assert stored.body == b"test_data"
+    assert stored.ttl == 10
+    assert stored.updated_timestamp == item.updated_timestamp
+    assert stored.expires_timestamp == item.expires_timestamp
+    assert 9 < redis_server.expires_in(b"chocs-cache:1") <= 10  # type: ignore
+
+
+def test_uses_expiry_grace_for_native_ttl(redis_server: FakeRedisServer) -> None:
+    # given
+    instance = create_storage(redis_server, expiry_grace=60)
+
+    # when
+    instance.set(CacheItem("1", b"test_data", 10))
+    instance.set(CacheItem("2", b"test_data", 0))
+
+    # then
+    assert 69 < redis_server.expires_in(b"chocs-cache:1") <= 70  # type: ignore
+    assert 59 < redis_server.expires_in(b"chocs-cache:2") <= 60  # type: ignore
+
+
+def test_can_collect_item(redis_server: FakeRedisServer) -> None:
+    # given
+    instance = create_storage(redis_server)
+    instance.set(CacheItem("1", b"test_data"))
+
+    # when
+    instance.collect(CacheItem("1", b""))
+
+    # then
+    with pytest.raises(CacheError):
+        instance.get("1")
+
+
+def test_pipelines_batches(redis_server: FakeRedisServer) -> None:
+    # given
+    instance = create_storage(redis_server)
+
+    # when
+    instance.set_many([CacheItem("a", b"1"), CacheItem("b", b"2"), CacheItem("c", b"3")])
+    instance.collect_many([CacheItem("c", b"")])
+    items = instance.get_many(["a", "b", "c"])
+
+    # then
+    assert sorted(items) == ["a", "b"]
+    assert [command[0] for command in redis_server.commands] == [b"SET", b"SET", b"SET", b"DEL", b"MGET"]
+    assert len(instance.pool) == 1
+
+
+def test_can_touch_items_without_sending_bodies(redis_server: FakeRedisServer) -> None:
+    # given
+    instance = create_storage(redis_server)
+    instance.set(CacheItem("1", b"test_data", -10, ("users",), "/users/1"))
+    refreshed = CacheItem("1", b"", 20, ("users",), "/users/1")
+    sent = len(redis_server.commands)
+
+    # when
+    touched = instance.touch([refreshed, CacheItem("missing", b"")])
+    stored = instance.get("1")
+
+    # then
+    assert isinstance(instance, ITouchableCacheStorage)
+    assert touched == 1
+    assert b"missing" not in b"".join(redis_server.data)
+    assert all(b"test_data" not in part for command in redis_server.commands[sent:] for part in command)
+    assert stored.body == b"test_data"
+    assert stored.tags == ("users",)
+    assert stored.ttl == 20
+    assert stored.expires_timestamp == refreshed.expires_timestamp
+    assert 19 < redis_server.expires_in(b"chocs-cache:1") <= 20  # type: ignore
+
+
+def test_removes_collected_and_expired_items_from_indexes(redis_server: FakeRedisServer) -> None:
+    # given
+    instance = create_storage(redis_server)
+    instance.set_many([
+        CacheItem("1", b"test", 10, ("users",), "/users/1"),
+        CacheItem("2", b"test", 10, ("users",), "/users/2"),
+        CacheItem("expired", b"test", 10, ("users",), "/users/3"),
+    ])
+    redis_server.sorted_sets[b"chocs-cache:#tags:users"][b"expired"] = 0  # expired in Redis meanwhile
+
+    # when
+    instance.collect_many([CacheItem("1", b"", tags=("users",), path="/users/1")])
+    instance.set(CacheItem("4", b"test", 0, ("users",), "/users/4"))
+
+    # then
+    assert redis_server.sorted_sets[b"chocs-cache:#tags:users"].keys() == {b"2", b"4"}
+    assert redis_server.sorted_sets[b"chocs-cache:#paths:/users"].keys() == {b"2", b"expired", b"4"}
+    assert b"chocs-cache:#paths:/" not in redis_server.sorted_sets
+    assert redis_server.sorted_sets[b"chocs-cache:#paths:/users/1"] == {}
+    assert redis_server.sorted_sets[b"chocs-cache:#tags:users"][b"4"] == float("inf")
+    assert instance.invalidate_tag("users") == 2
+
+
+def test_loads_scripts_once_server_does_not_know_them(redis_server: FakeRedisServer) -> None:
+    # given
+    instance = create_storage(redis_server)
+
+    # when
+    instance.set(CacheItem("1", b"test", 10, ("users",)))
+    instance.set(CacheItem("2", b"test", 10, ("users",)))
+    redis_server.scripts.clear()  # server restarted
+    touched = instance.touch([CacheItem("1", b"", 20, ("users",))])
+
+    # then
+    names = [command[0] for command in redis_server.commands]
+    assert names.count(b"SCRIPT") == 4
+    assert b"EVAL" not in names
+    assert touched == 1
+    assert redis_server.sorted_sets[b"chocs-cache:#tags:users"].keys() == {b"1", b"2"}
+    assert instance.failures == 0
+
+
+def test_can_invalidate_root_prefix(redis_server: FakeRedisServer) -> None:
+    # given
+    instance = create_storage(redis_server)
+    instance.set_many([
+        CacheItem("1", b"test", 10, ("users",), "/users/1"),
+        CacheItem("2", b"test", 10, (), "/"),
+        CacheItem("3", b"test", 10),
+    ])
+    redis_server.data[b"other:1"] = (b"test", None)
+
+    # when
+    invalidated = instance.invalidate_prefix("/")
+
+    # then
+    assert invalidated == 3
+    assert instance.get_many(["1", "2", "3"]) == {}
+    assert list(redis_server.data) == [b"other:1"]
+    assert redis_server.sorted_sets == {}
+
+
+def test_fails_open_when_server_does_not_respond(redis_server: FakeRedisServer) -> None:
+    # given
+    instance = create_storage(redis_server)
+    instance.set(CacheItem("1", b"test_data"))
+    redis_server.delay = 0.5
+
+    # when
+    instance.set(CacheItem("2", b"test_data"))
+    with pytest.raises(CacheError):
+        instance.get("1")
+
+    # then
+    assert instance.failures == 2
+    assert len(instance.pool) == 0
+
+
+def test_fails_open_when_server_is_down() -> None:
+    # given
+    with socket.socket() as unused:
+        unused.bind(("127.0.0.1", 0))
+        port = unused.getsockname()[1]
+    instance = RedisCacheStorage(RedisConnectionPool(port=port))
+
+    # when
+    instance.set(CacheItem("1", b"test_data"))
+
+    # then
+    assert instance.failures == 1
+    with pytest.raises(CacheError):
+        instance.get("1")
+
+
+def test_can_be_used_by_middleware(redis_server: FakeRedisServer) -> None:
+    # given
+    app = Application(CacheMiddleware(create_storage(redis_server)))
+    controller_call_count = 0
+
+    @app.get("/test", cache_expiry=10)
+    def get_test(req: HttpRequest) -> HttpResponse:
+        nonlocal controller_call_count
+        controller_call_count += 1
+        return HttpResponse("test")
+
+    # when
+    app(HttpRequest(HttpMethod.GET, "/test"))
+    response = app(HttpRequest(HttpMethod.GET, "/test"))
+
+    # then
+    assert controller_call_count == 1
+    assert str(response) == "test"
@@ -0,0 +1,190 @@
+import asyncio
+import threading
+import time
+from typing import List
+
+import pytest
+
+from chocs_middleware.cache import AsyncSingleFlight, SingleFlight
+
+
+def _wait_for(condition, timeout: float = 2.0) -> None:  # type: ignore
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.001)
+
+
+def test_can_share_result_between_threads() -> None:
+    # given
+    single_flight: SingleFlight[int] = SingleFlight(timeout=2)
+    release = threading.Event()
+    calls = 0
+    results: List = []
+
+    def compute() -> int:
+        nonlocal calls
+        calls += 1
+        release.wait(2)
+        return 42
+
+    def worker() -> None:
+        results.append(single_flight.do("key", compute))
+
+    # when
+    threads = [threading.Thread(target=worker) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    _wait_for(lambda: single_flight.waiting("key") == 4)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    # then
+    assert calls == 1
+    assert sorted(results) == [(42, False)] + [(42, True)] * 4
+    assert len(single_flight) == 0
+
+
+def test_shares_error_between_threads() -> None:
+    # given
+    single_flight: SingleFlight[int] = SingleFlight(timeout=2)
+    release = threading.Event()
+    errors: List = []
+
+    def compute() -> int:
+        release.wait(2)
+        raise RuntimeError("backend failure")
+
+    def worker() -> None:
+        try:
+            single_flight.do("key", compute)
+        except RuntimeError as error:
+            errors.append(error)
+
+    # when
+    threads = [threading.Thread(target=worker) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    _wait_for(lambda: single_flight.waiting("key") == 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    # then
+    assert len(errors) == 3
+    assert len(single_flight) == 0
+
+
+def test_computes_result_after_timeout() -> None:
+    # given
+    single_flight: SingleFlight[str] = SingleFlight(timeout=0.01)
+    release = threading.Event()
+    results: List = []
+
+    def slow() -> str:
+        release.wait(2)
+        return "leader"
+
+    leader = threading.Thread(target=lambda: results.append(single_flight.do("key", slow)))
+    leader.start()
+    _wait_for(lambda: len(single_flight) == 1)
+
+    # when
+    result = single_flight.do("key", lambda: "follower")
+    release.set()
+    leader.join()
+
+    # then
+    assert result == ("follower", False)
+    assert results == [("leader", False)]
+
+
+def test_can_share_result_between_tasks() -> None:
+    # given
+    single_flight: AsyncSingleFlight[int] = AsyncSingleFlight(timeout=2)
+    calls = 0
+
+    async def compute() -> int:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return 42
+
+    async def run() -> List:
+        return list(await asyncio.gather(*[single_flight.do("key", compute) for _ in range(5)]))
+
+    # when
+    results = asyncio.run(run())
+
+    # then
+    assert calls == 1
+    assert results == [(42, False)] + [(42, True)] * 4
+    assert len(single_flight) == 0
+
+
+def test_shares_error_between_tasks() -> None:
+    # given
+    single_flight: AsyncSingleFlight[int] = AsyncSingleFlight(timeout=2)
+
+    async def compute() -> int:
+        await asyncio.sleep(0.01)
+        raise RuntimeError("backend failure")
+
+    async def run() -> List:
+        return list(await asyncio.gather(*[single_flight.do("key", compute) for _ in range(3)], return_exceptions=True))
+
+    # when
+    results = asyncio.run(run())
+
+    # then
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_task_computes_result_after_timeout() -> None:
+    # given
+    single_flight: AsyncSingleFlight[str] = AsyncSingleFlight(timeout=0.01)
+
+    async def slow() -> str:
+        await asyncio.sleep(0.1)
+        return "leader"
+
+    async def fast() -> str:
+        return "follower"
+
+    async def run() -> List:
+        leader = asyncio.ensure_future(single_flight.do("key", slow))
+        await asyncio.sleep(0)
+        follower = await single_flight.do("key", fast)
+        return [await leader, follower]
+
+    # then
+    assert asyncio.run(run()) == [("leader", False), ("follower", False)]
+
+
+def test_waiting_tasks_start_over_when_leader_is_cancelled() -> None:
+    # given
+    single_flight: AsyncSingleFlight[int] = AsyncSingleFlight(timeout=2)
+    calls = 0
+
+    async def compute() -> int:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return 42
+
+    async def run() -> List:
+        leader = asyncio.ensure_future(single_flight.do("key", compute))
+        await asyncio.sleep(0)
+        followers = asyncio.gather(*[single_flight.do("key", compute) for _ in range(3)])
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return [await asyncio.gather(leader, return_exceptions=True), await followers]
+
+    # when
+    leader_result, results = asyncio.run(run())
+
+    # then
+    assert isinstance(leader_result[0], asyncio.CancelledError)
+    assert calls == 2
+    assert results == [(42, False), (42, True), (42, True)]
+    assert len(single_flight) == 0
@@ -0,0 +1,115 @@
+import pytest
+
+from chocs_middleware.cache import (
+    CacheError,
+    CacheItem,
+    CollectableInMemoryCacheStorage,
+    ICollectableCacheStorage,
+    InMemoryCacheStorage,
+    TieredCacheStorage,
+)
+
+
+def test_reads_through_to_second_tier() -> None:
+    # given
+    l2 = CollectableInMemoryCacheStorage()
+    l2.set(CacheItem("1", b"test"))
+    instance = TieredCacheStorage(l2)
+
+    # when
+    items = [instance.get("1"), instance.get("1"), instance.get("1")]
+
+    # then
+    assert isinstance(instance, ICollectableCacheStorage)
+    assert [item.body for item in items] == [b"test"] * 3
+    assert (instance.l1_hits, instance.l1_misses) == (2, 1)
+    assert (instance.l2_hits, instance.l2_misses) == (1, 0)
+
+
+def test_counts_misses_in_both_tiers() -> None:
+    # given
+    instance = TieredCacheStorage(InMemoryCacheStorage())
+
+    # when
+    with pytest.raises(CacheError):
+        instance.get("1")
+
+    # then
+    assert (instance.l1_misses, instance.l2_misses) == (1, 1)
+
+
+def test_writes_and_collects_through_both_tiers() -> None:
+    # given
+    l2 = CollectableInMemoryCacheStorage()
+    instance = TieredCacheStorage(l2)
+
+    # when
+    instance.set(CacheItem("1", b"test"))
+
+    # then
+    assert len(instance.l1) == 1
+    assert len(l2) == 1
+
+    # when
+    instance.collect(CacheItem("1", b""))
+
+    # then
+    assert instance.l1.is_empty
+    assert l2.is_empty
+
+
+def test_refreshes_first_tier_after_max_age() -> None:
+    # given
+    l2 = CollectableInMemoryCacheStorage()
+    instance = TieredCacheStorage(l2, l1_max_age=5)
+    instance.set(CacheItem("1", b"old"))
+
+    # when
+    l2.set(CacheItem("1", b"new"))
+    before_max_age = instance.get("1")
+    instance.l1._stored_at["1"] -= 10
+    after_max_age = instance.get("1")
+
+    # then
+    assert before_max_age.body == b"old"
+    assert after_max_age.body == b"new"
+    assert instance.l2_hits == 1
+
+
+def test_reads_many_items_through_to_second_tier_in_single_batch() -> None:
+    # given
+    l2 = CollectableInMemoryCacheStorage()
+    l2.set_many([CacheItem("1", b"one"), CacheItem("2", b"two")])
+    instance = TieredCacheStorage(l2)
+    instance.get("1")
+
+    # when
+    items = instance.get_many(["1", "2", "3"])
+
+    # then
+    assert {item_id: item.body for item_id, item in items.items()} == {"1": b"one", "2": b"two"}
+    assert (instance.l2_hits, instance.l2_misses) == (2, 1)
+    assert instance.l1.get("2").body == b"two"
+
+    # when
+    instance.collect_many([CacheItem("1", b""), CacheItem("2", b"")])
+
+    # then
+    assert l2.is_empty
+    assert instance.get_many(["1", "2"]) == {}
+
+
+def test_touches_items_in_both_tiers() -> None:
+    # given
+    l2 = InMemoryCacheStorage()
+    instance = TieredCacheStorage(l2)
+    instance.set(CacheItem("1", b"test", -10))
+    refreshed = CacheItem("1", b"", 20)
+
+    # when
+    touched = instance.touch([refreshed])
+
+    # then
+    assert touched == 1
+    assert l2.get("1").expires_timestamp == refreshed.expires_timestamp
+    assert instance.l1.get("1").expires_timestamp == refreshed.expires_timestamp